@@ -0,0 +1,545 @@
+#!/usr/bin/env python
+
+"""Benchmarks for the hot paths of the error-monitor-db.
+
+The benchmarks that talk to Redis need a real redis-server, and use (and
+FLUSH!) a scratch db on it, by default db 15 on localhost:6379.  Don't point
+them at the production db.
+
+server_load instead sends requests to a running server.py, and records
+errors on it for a made-up "loadtest" version, so start that on a scratch db
+too, for instance with `server.py --redis-db 15 --workers 4`.
+
+Usage:
+    python benchmark.py write_modes [--occurrences N] [--db DB]
+    python benchmark.py parse [--messages N]
+    python benchmark.py summaries [--errors N [N ...]] [--versions N]
+    python benchmark.py recent_errors [--errors N] [--versions N]
+    python benchmark.py server_load [--server HOST:PORT] [--seconds S]
+                                    [--readers N] [--logs-per-post N]
+    python benchmark.py compression [--errors N] [--logs-per-post N]
+    python benchmark.py poisson [--counts N [N ...]]
+"""
+import argparse
+import decimal
+import json
+import md5
+import multiprocessing
+import random
+import re
+import resource
+import threading
+import time
+import urllib2
+
+import redis
+
+import models
+import server
+
+
+# A handful of error shapes, roughly like what we see during a deploy.
+_MESSAGES = [
+    "Exceeded soft private memory limit of 512 MB with 530 MB after "
+    "servicing 14 requests total",
+    "Error while parsing directive 1",
+    "'NoneType' object has no attribute 'key'\n"
+    "Traceback (most recent call last):\n"
+    '  File "/base/data/home/apps/s~khan-academy/1029-2305-f48a12e2b9ba.'
+    '379742046073152437/api/errors.py", line 12, in wrapped\n'
+    "    return func(*args, **kwargs)\n"
+    '  File "/base/data/home/apps/s~khan-academy/1029-2305-f48a12e2b9ba.'
+    '379742046073152437/api/internal/user.py", line 214, in get_user\n'
+    "    return user.key",
+    "Request was aborted after waiting too long to attempt to service your "
+    "request.",
+]
+
+
+# The frames of the tracebacks we make up for the parse benchmark.
+_FRAMES = [
+    ("api/errors.py", "wrapped", "return func(*args, **kwargs)"),
+    ("api/internal/user.py", "get_user", "return user.key"),
+    ("third_party/flask/app.py", "dispatch_request",
+     "return self.view_functions[rule.endpoint](**req.view_args)"),
+    ("/base/data/home/runtimes/python27/python27_lib/versions/1/google/"
+     "appengine/ext/ndb/tasklets.py", "get_result",
+     "return self.__get_result_cache()"),
+    ("content/models.py", "get_by_slug", "raise KeyError(slug)"),
+]
+
+_TITLES = [
+    u"'NoneType' object has no attribute 'key'",
+    u"KeyError: u'exercise-1234'",
+    u"Memcache set failed for get_user_data(12345, {'a': 1})",
+    u"Error in signature for /api/internal/user/exercises",
+    u"DeadlineExceededError: The overall deadline for responding to the "
+    u"HTTP request was exceeded after 60.1 seconds \u2014 retrying",
+    u"[promoted from WARNING] Datastore timeout after 3 attempts",
+]
+
+
+def _random_traceback(rand):
+    """Make up a message like App Engine logs for an uncaught exception."""
+    title = rand.choice(_TITLES)
+    if rand.random() < 0.1:
+        return title
+
+    lines = [title, u"Traceback (most recent call last):"]
+    for _ in xrange(rand.randint(3, 30)):
+        filename, function, code = rand.choice(_FRAMES)
+        if not filename.startswith("/"):
+            filename = (
+                "/base/data/home/apps/s~khan-academy/1029-2305-f48a12e2b9ba."
+                "379742046073152437/" + filename)
+        lines.append(u'  File "%s", line %d, in %s' % (
+            filename, rand.randint(1, 2000), function))
+        lines.append(u"    " + code)
+    lines.append(title)
+    message = u"\n".join(lines)
+
+    if rand.random() < 0.3:
+        # Long messages get truncated, often partway through a frame.
+        message = message[:rand.randint(len(title), len(message))]
+    if rand.random() < 0.05:
+        # Sometimes the first line is empty and the title comes last.
+        message = u"\n" + message
+    return message
+
+
+_LEGACY_VERSION_PATH_PREFIX_RE = re.compile(
+    r'^.*\d{4}-\d{4}-[a-f0-9]{12}\.\d+/')
+
+
+def _legacy_parse_message(message, status, level):
+    """models._parse_message_uncached as it was before the single-pass parser.
+
+    Kept here so we can check the new parser gives the same results, and see
+    how much faster it is.
+    """
+    error_def = {}
+    msg_lines = message.split("\n")
+
+    error_def['title'] = msg_lines[0].encode('utf-8')
+
+    promotion_prefix = '[promoted from WARNING] '
+    if error_def['title'].startswith(promotion_prefix):
+        error_def['title'] = error_def['title'][len(promotion_prefix):]
+
+    if not error_def['title']:
+        error_def['title'] = msg_lines[-1].encode('utf-8')
+
+    error_def['status'] = status
+    error_def['level'] = level
+
+    id_prefix = str("%s %s " % (status, level))
+    error_def['id0'] = (
+        id_prefix + re.sub(r'\d+', '%%', error_def['title']))
+
+    for regexp in models._NON_COMBINABLE_ERRORS:
+        m = regexp.search(error_def['title'])
+        if m:
+            error_def['id1'] = None
+            error_def['id2'] = None
+            error_def['id3'] = m.group(1) if m.groups() else None
+            break
+    else:
+        error_def['id1'] = (
+            id_prefix + " ".join(error_def['id0'].split(" ")[2:5]))
+        error_def['id2'] = (
+            id_prefix + " ".join(error_def['id0'].split(" ")[-3:]))
+        error_def['id3'] = None
+
+    h = md5.md5()
+    id_str = "%(id0)s%(id1)s%(id2)s%(id3)s" % error_def
+    h.update(id_str)
+    error_def['key'] = h.hexdigest()[:8]
+
+    stack = []
+
+    for line in msg_lines[1:]:
+        if line.startswith("Traceback"):
+            continue
+        if line.startswith("  File "):
+            match = re.match(
+                r'  File "([^"]*)", line (\d*), in (.*)', line)
+            if not match:
+                continue
+            (filename, lineno, function) = match.groups()
+            filename = _LEGACY_VERSION_PATH_PREFIX_RE.sub('', filename)
+            stack.append({
+                "filename": filename,
+                "lineno": lineno,
+                "function": function
+            })
+
+    h = md5.md5()
+    h.update("|".join("%(filename)s:%(function)s" % s
+                      for s in stack))
+    stack_key = h.hexdigest()
+
+    return (error_def, stack, stack_key)
+
+
+def _legacy_poisson_cdf(actual, mean):
+    """server.poisson_cdf as it was, summing the terms in Decimal."""
+    if actual < 0:
+        return 0.0
+
+    # We use Decimal so that long periods and high numbers of
+    # reports work -- a mean of 746 or higher would cause a zero
+    # to propagate and make us report a probability of 0 even
+    # if the actual probability was almost 1.
+    mean = decimal.Decimal(mean)
+
+    cum_prob = decimal.Decimal(0)
+
+    p = (-mean).exp()
+    cum_prob += p
+    for i in xrange(actual):
+        # We calculate the probability of each lesser value
+        # individually, and sum as we go.
+        p *= mean
+        p /= i + 1
+        cum_prob += p
+
+    return float(cum_prob)
+
+
+def _use_scratch_redis(args):
+    """Point models at a freshly flushed scratch db."""
+    models.r = redis.StrictRedis(host=args.host, port=args.port, db=args.db)
+    models.r.flushdb()
+    models._reset_caches()
+
+
+def _random_log(rand):
+    route = rand.choice(["/api/internal/user", "/math", "/profile"])
+    return {
+        "status": rand.choice([200, 500]),
+        "level": rand.choice([3, 4]),
+        "resource": route + "?_=%d" % rand.randint(0, 10 ** 6),
+        "ip": "10.0.%d.%d" % (rand.randint(0, 3), rand.randint(0, 255)),
+        "route": route,
+        "module_id": rand.choice(["default", "batch"]),
+        "message": rand.choice(_MESSAGES),
+    }
+
+
+def bench_write_modes(args):
+    """Time record_occurrence_during_monitoring in each WRITE_MODE."""
+    rand = random.Random(args.seed)
+    logs = [_random_log(rand) for _ in xrange(args.occurrences)]
+
+    print "Recording %d occurrences, one at a time:" % len(logs)
+    for write_mode in (models.WRITE_MODE_DIRECT, models.WRITE_MODE_PIPELINE,
+                       models.WRITE_MODE_LUA):
+        _use_scratch_redis(args)
+        models.WRITE_MODE = write_mode
+        start = time.time()
+        for log in logs:
+            models.record_occurrence_during_monitoring(
+                "bench", 0, str(log['status']), str(log['level']),
+                log['resource'], log['ip'], log['route'], log['module_id'],
+                log['message'])
+        elapsed = time.time() - start
+        print "  %-8s %8.3f ms/occurrence %10.0f occurrences/s" % (
+            write_mode, 1000.0 * elapsed / len(logs), len(logs) / elapsed)
+
+    models.r.flushdb()
+
+
+def bench_parse(args):
+    """Time parsing error messages against the old parser.  Needs no Redis."""
+    rand = random.Random(args.seed)
+    messages = [_random_traceback(rand) for _ in xrange(args.messages)]
+
+    mismatches = 0
+    for message in messages:
+        if (models._parse_message_uncached(message, "500", "4") !=
+                _legacy_parse_message(message, "500", "4")):
+            mismatches += 1
+    print "%d of %d messages parsed differently than before." % (
+        mismatches, len(messages))
+
+    print "Parsing %d messages (%d bytes on average), without caching:" % (
+        len(messages), sum(len(m) for m in messages) / len(messages))
+    for name, parse in (("legacy", _legacy_parse_message),
+                        ("current", models._parse_message_uncached)):
+        start = time.time()
+        for message in messages:
+            parse(message, "500", "4")
+        elapsed = time.time() - start
+        print "  %-8s %8.1f us/message %10.0f messages/s" % (
+            name, 1000000.0 * elapsed / len(messages),
+            len(messages) / elapsed)
+
+
+def _error_name(i):
+    """A distinct, digit-free name for the i'th error, like 'bcd'."""
+    name = ""
+    while True:
+        name += chr(ord("a") + i % 26)
+        i //= 26
+        if not i:
+            return name
+
+
+def bench_summaries(args):
+    """Time fetching error summaries one at a time and in bulk."""
+    _use_scratch_redis(args)
+    log_hour = time.strftime("%Y%m%d_%H", time.gmtime())
+    num_recorded = 0
+
+    print "Fetching summaries of errors seen on %d versions:" % args.versions
+    for num_errors in sorted(args.errors):
+        for i in xrange(num_recorded, num_errors):
+            for version in xrange(args.versions):
+                models.record_occurrence_from_errors(
+                    "v%03d" % version, log_hour, "500", "4", "/test",
+                    "10.0.0.1", "/test", "default",
+                    "%s failed in %s" % (_error_name(i), _error_name(i)))
+        num_recorded = num_errors
+        error_keys = list(models.get_error_keys())
+
+        timings = []
+        for get_summaries in (
+                lambda: [models.get_error_summary_info(k) for k in error_keys],
+                lambda: models.get_error_summaries(error_keys)):
+            # Start with cold caches, as after a restart.
+            models._reset_caches()
+            start = time.time()
+            get_summaries()
+            timings.append(time.time() - start)
+
+        print "  %6d errors: %8.1f ms one at a time %8.1f ms in bulk" % (
+            len(error_keys), 1000 * timings[0], 1000 * timings[1])
+
+    models.r.flushdb()
+
+
+def _fetch_recent_errors(url, results):
+    """Fetch 'url' from the server, and put how long it took in 'results'.
+
+    Along with the size of the response and our peak RSS, before and after.
+    This runs in a fresh process so the peak RSS is only from this request.
+    """
+    client = server.app.test_client()
+    start_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    start = time.time()
+    response = client.get(url, buffered=False)
+    num_bytes = sum(len(chunk) for chunk in response.response)
+    elapsed = time.time() - start
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    results.put((elapsed, num_bytes, start_rss, peak_rss))
+
+
+def bench_recent_errors(args):
+    """Time /recent_errors, and its peak RSS, with and without streaming."""
+    _use_scratch_redis(args)
+    log_hour = time.strftime("%Y%m%d_%H", time.gmtime())
+    for i in xrange(args.errors):
+        for version in xrange(args.versions):
+            models.record_occurrence_from_errors(
+                "v%03d" % version, log_hour, "500", "4", "/test",
+                "10.0.0.1", "/test", "default",
+                "%s failed in %s" % (_error_name(i), _error_name(i)))
+
+    print "Fetching %d errors seen on %d versions:" % (
+        args.errors, args.versions)
+    for url in ("/recent_errors", "/recent_errors?stream=1"):
+        results = multiprocessing.Queue()
+        process = multiprocessing.Process(
+            target=_fetch_recent_errors, args=(url, results))
+        process.start()
+        elapsed, num_bytes, start_rss, peak_rss = results.get()
+        process.join()
+        # ru_maxrss is in kilobytes on Linux.
+        print ("  %-24s %8.1f ms %8.1f MB sent %8.1f MB peak RSS "
+               "(+%.1f MB)" % (url, 1000 * elapsed, num_bytes / 1e6,
+                               peak_rss / 1e3, (peak_rss - start_rss) / 1e3))
+
+    models.r.flushdb()
+
+
+def _cpu_ms_per_call(func, repeats):
+    start = time.clock()
+    for _ in xrange(repeats):
+        func()
+    return 1000 * (time.clock() - start) / repeats
+
+
+def bench_compression(args):
+    """Measure the bytes and CPU time compressing requests/responses takes."""
+    rand = random.Random(args.seed)
+    monitor_body = json.dumps({
+        "version": "bench",
+        "minute": 0,
+        "logs": [dict(_random_log(rand), message=_random_traceback(rand))
+                 for _ in xrange(args.logs_per_post)],
+    })
+
+    _use_scratch_redis(args)
+    log_hour = time.strftime("%Y%m%d_%H", time.gmtime())
+    for i in xrange(args.errors):
+        models.record_occurrence_from_errors(
+            "v001", log_hour, "500", "4", "/test", "10.0.0.1", "/test",
+            "default", "%s failed in %s" % (_error_name(i), _error_name(i)))
+    recent_errors_body = server.app.test_client().get("/recent_errors").data
+    models.r.flushdb()
+
+    print "Compressing at level %d:" % server.COMPRESS_LEVEL
+    for name, body in (("/monitor post", monitor_body),
+                       ("/recent_errors response", recent_errors_body)):
+        print "  %s of %d bytes:" % (name, len(body))
+        # Repeat enough to time small bodies, but not forever on big ones.
+        repeats = max(1, 10 ** 7 / len(body))
+        for encoding in ("gzip", "deflate"):
+            compressed = server._compress(body, encoding)
+            compress_ms = _cpu_ms_per_call(
+                lambda: server._compress(body, encoding), repeats)
+            decompress_ms = _cpu_ms_per_call(
+                lambda: server._decompress(compressed, encoding, len(body)),
+                repeats)
+            print ("    %-8s %10d bytes (%5.1f%%) %8.2f ms CPU to compress "
+                   "%8.2f ms to decompress" % (
+                       encoding, len(compressed),
+                       100.0 * len(compressed) / len(body), compress_ms,
+                       decompress_ms))
+
+
+def bench_poisson(args):
+    """Time server.poisson_cdf against the old one.  Needs no Redis."""
+    print "Computing p(draw <= count) for means around the count:"
+    for count in args.counts:
+        means = [count * (0.8 + 0.05 * i) + 0.5 for i in xrange(9)]
+        timings = []
+        results = []
+        for poisson_cdf in (_legacy_poisson_cdf, server.poisson_cdf):
+            start = time.time()
+            results.append([poisson_cdf(count, mean) for mean in means])
+            timings.append((time.time() - start) / len(means))
+        max_error = max(abs(before - now)
+                        for before, now in zip(*results))
+        print ("  %6d: %10.1f us/call before %6.1f us/call now, "
+               "max difference %.1e" % (count, 1e6 * timings[0],
+                                        1e6 * timings[1], max_error))
+
+
+def _percentile(sorted_values, fraction):
+    return sorted_values[min(len(sorted_values) - 1,
+                             int(fraction * len(sorted_values)))]
+
+
+def bench_server_load(args):
+    """Time /monitor on a running server, with /recent_errors hammered."""
+    base_url = "http://%s" % args.server
+    rand = random.Random(args.seed)
+
+    print "Posting %d logs at a time to /monitor for %.0fs:" % (
+        args.logs_per_post, args.seconds)
+    for num_readers in (0, args.readers):
+        stop = threading.Event()
+        # How many /recent_errors requests each reader has finished.
+        num_reads = [0] * num_readers
+
+        def read_recent_errors(i):
+            while not stop.is_set():
+                urllib2.urlopen(base_url + "/recent_errors").read()
+                num_reads[i] += 1
+
+        readers = [threading.Thread(target=read_recent_errors, args=(i,))
+                   for i in xrange(num_readers)]
+        for reader in readers:
+            reader.daemon = True
+            reader.start()
+
+        latencies = []
+        deadline = time.time() + args.seconds
+        while time.time() < deadline:
+            data = json.dumps({
+                "version": "loadtest",
+                "minute": len(latencies) % 10,
+                "logs": [_random_log(rand)
+                         for _ in xrange(args.logs_per_post)],
+            })
+            start = time.time()
+            urllib2.urlopen(urllib2.Request(
+                base_url + "/monitor", data,
+                {"Content-Type": "application/json"})).read()
+            latencies.append(time.time() - start)
+
+        stop.set()
+        for reader in readers:
+            reader.join()
+
+        latencies.sort()
+        print ("  %2d readers (%5d reads): %6d posts, p50 %7.1f ms, "
+               "p99 %7.1f ms, max %7.1f ms" % (
+                   num_readers, sum(num_reads), len(latencies),
+                   1000 * _percentile(latencies, 0.5),
+                   1000 * _percentile(latencies, 0.99),
+                   1000 * latencies[-1]))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Benchmark the error-monitor-db.")
+    parser.add_argument("--host", default="localhost",
+                        help="Host of the scratch redis-server.")
+    parser.add_argument("--port", type=int, default=6379,
+                        help="Port of the scratch redis-server.")
+    parser.add_argument("--db", type=int, default=15,
+                        help="Scratch Redis db.  It is flushed!")
+    parser.add_argument("--seed", type=int, default=0,
+                        help="Random seed for generating test data.")
+    subparsers = parser.add_subparsers()
+
+    write_modes = subparsers.add_parser(
+        "write_modes", help=bench_write_modes.__doc__)
+    write_modes.add_argument("--occurrences", type=int, default=2000)
+    write_modes.set_defaults(func=bench_write_modes)
+
+    parse = subparsers.add_parser("parse", help=bench_parse.__doc__)
+    parse.add_argument("--messages", type=int, default=20000)
+    parse.set_defaults(func=bench_parse)
+
+    summaries = subparsers.add_parser(
+        "summaries", help=bench_summaries.__doc__)
+    summaries.add_argument("--errors", type=int, nargs="+",
+                           default=[100, 1000, 5000],
+                           help="Numbers of errors to time it with.")
+    summaries.add_argument("--versions", type=int, default=3)
+    summaries.set_defaults(func=bench_summaries)
+
+    recent_errors = subparsers.add_parser(
+        "recent_errors", help=bench_recent_errors.__doc__)
+    recent_errors.add_argument("--errors", type=int, default=20000)
+    recent_errors.add_argument("--versions", type=int, default=3)
+    recent_errors.set_defaults(func=bench_recent_errors)
+
+    server_load = subparsers.add_parser(
+        "server_load", help=bench_server_load.__doc__)
+    server_load.add_argument("--server", default="localhost:9340",
+                             help="host:port of the server.py to load.")
+    server_load.add_argument("--seconds", type=float, default=30)
+    server_load.add_argument("--readers", type=int, default=8,
+                             help="How many clients fetch /recent_errors "
+                                  "at once.")
+    server_load.add_argument("--logs-per-post", type=int, default=20)
+    server_load.set_defaults(func=bench_server_load)
+
+    compression = subparsers.add_parser(
+        "compression", help=bench_compression.__doc__)
+    compression.add_argument("--errors", type=int, default=5000,
+                             help="How many errors /recent_errors returns.")
+    compression.add_argument("--logs-per-post", type=int, default=20)
+    compression.set_defaults(func=bench_compression)
+
+    poisson = subparsers.add_parser("poisson", help=bench_poisson.__doc__)
+    poisson.add_argument("--counts", type=int, nargs="+",
+                         default=[10, 100, 1000, 10000, 50000])
+    poisson.set_defaults(func=bench_poisson)
+
+    args = parser.parse_args()
+    args.func(args)
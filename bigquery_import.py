@@ -24,12 +24,12 @@ When you've downloaded that json file, pass the credentials file location as an
 env variable:
 GOOGLE_APPLICATION_CREDENTIALS=/path/to/credentials.json bigquery_import.py ...
 """
+import argparse
 import calendar
 import datetime
 import httplib2
 import json
 import logging
-from optparse import OptionParser
 import pprint
 import re
 
@@ -306,25 +306,30 @@ if __name__ == "__main__":
     # because that hour is not available in BigQuery yet) and then stops.
     # Since we won't re-fetch the same hour twice, this can be called as often
     # as we like.
-    parser = OptionParser()
-    parser.add_option("-d", "--date", dest="date_str",
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-d", "--date", dest="date_str",
                       default=datetime.datetime.utcnow().strftime("%Y%m%d"),
                       help="Date (in UTC) to import logs for, in format "
                            "YYYYMMDD. If omitted, use today's date.")
-    parser.add_option("--use-daily-tables", dest="use_daily",
+    parser.add_argument("--use-daily-tables", dest="use_daily",
                       default=False, action="store_true",
                       help="Use the daily log tables to import logs, instead "
                       "of the hourly ones. This will happen automatically if "
                       "we're loading a date more than 7 days ago. (Within 7 "
                       "days, you might want to use this to backfill data "
                       "quickly.)")
-    (options, args) = parser.parse_args()
+    models.add_redis_arguments(parser)
+    options = parser.parse_args()
+    models.configure_redis_from_args(options)
 
     # If we're loading logs for more than 7 days ago, we won't have hourly
     # tables, so use daily ones instead.
     days_ago = (datetime.datetime.utcnow() -
                 datetime.datetime.strptime(options.date_str, '%Y%m%d')).days
 
+    # Other processes may change the error defs we cache while we run.
+    models.start_invalidation_listener()
+
     if options.use_daily or days_ago > 7:
         import_daily_logs(options.date_str)
     else:
@@ -0,0 +1,198 @@
+"""In-process caches for data we would otherwise fetch or compute repeatedly.
+
+The caches here are bounded so a long-running server.py process doesn't grow
+forever, and keep hit/miss counters so we can tell whether they are earning
+their keep (see the /stats handler in server.py).
+"""
+import collections
+import hashlib
+import math
+import struct
+import threading
+import time
+
+
+class LRUCache(object):
+    """A mapping that holds at most 'max_size' entries.
+
+    When the cache is full, setting a new key evicts the least recently used
+    entry.  Entries may also have a time-to-live in seconds, after which they
+    are treated as missing (and dropped).  'ttl' may be given per entry in
+    set(), or for all entries with 'default_ttl'; None means no expiry.
+
+    If 'on_evict' is given, it is called with the key and value of every entry
+    that leaves the cache other than by being overwritten, whether it was
+    evicted for space, expired, deleted or cleared.
+
+    The cache is safe to use from several threads.
+    """
+    def __init__(self, max_size, default_ttl=None, on_evict=None):
+        self.max_size = max_size
+        self.default_ttl = default_ttl
+        self._on_evict = on_evict
+        # Maps key -> (value, expiry time or None), least recently used
+        # first.
+        self._entries = collections.OrderedDict()
+        self._lock = threading.RLock()
+        # Replaced in tests.
+        self._clock = time.time
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, key):
+        """Whether 'key' has a live entry.  Doesn't count as a use."""
+        with self._lock:
+            entry = self._entries.get(key)
+            return entry is not None and not self._is_expired(entry)
+
+    def _is_expired(self, entry):
+        return entry[1] is not None and entry[1] <= self._clock()
+
+    def _remove(self, key):
+        value, _ = self._entries.pop(key)
+        if self._on_evict:
+            self._on_evict(key, value)
+
+    def get(self, key, default=None):
+        """Return the value for 'key', or 'default' if it isn't cached."""
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is None:
+                self.misses += 1
+                return default
+
+            # Re-insert the entry to mark it as the most recently used.
+            self._entries[key] = entry
+            if self._is_expired(entry):
+                self.misses += 1
+                self.expirations += 1
+                self._remove(key)
+                return default
+
+            self.hits += 1
+            return entry[0]
+
+    def peek(self, key, default=None):
+        """Like get(), but doesn't count as a use (or a hit or miss)."""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or self._is_expired(entry):
+                return default
+            return entry[0]
+
+    def set(self, key, value, ttl=None):
+        """Cache 'value' for 'key', for 'ttl' seconds if given."""
+        if ttl is None:
+            ttl = self.default_ttl
+        expires_at = None if ttl is None else self._clock() + ttl
+
+        with self._lock:
+            self._entries.pop(key, None)
+            self._entries[key] = (value, expires_at)
+            while len(self._entries) > self.max_size:
+                self.evictions += 1
+                self._remove(next(iter(self._entries)))
+
+    def delete(self, key):
+        """Remove 'key' from the cache, if it is there."""
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+
+    def clear(self):
+        """Remove every entry from the cache."""
+        with self._lock:
+            for key in self._entries.keys():
+                self._remove(key)
+
+    def stats(self):
+        """Return a dict of the cache's size and hit/miss counters."""
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "size": len(self._entries),
+                "max_size": self.max_size,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": float(self.hits) / lookups if lookups else None,
+                "evictions": self.evictions,
+                "expirations": self.expirations,
+            }
+
+
+class BloomFilter(object):
+    """A set that may have false positives, but takes very little memory.
+
+    'item in bloom_filter' is False only if the item was never added; if it is
+    True, the item was *probably* added.  The chance of a false positive stays
+    around 'error_rate' as long as no more than 'capacity' items are added,
+    and gets worse after that.  Items are strings; unicode is encoded as
+    UTF-8 so that it matches the equivalent str.
+
+    Items can't be removed.
+    """
+    def __init__(self, capacity, error_rate=0.01):
+        self.capacity = capacity
+        self.target_error_rate = error_rate
+        # The optimal sizes for the capacity and error rate we want.
+        self.num_bits = int(math.ceil(
+            -capacity * math.log(error_rate) / math.log(2) ** 2))
+        self.num_hashes = max(1, int(round(
+            math.log(2) * self.num_bits / capacity)))
+        self._bits = bytearray((self.num_bits + 7) // 8)
+        self._lock = threading.Lock()
+        # How many distinct items we've added, more or less: an item that is
+        # a false positive when added isn't counted.
+        self._num_items = 0
+
+    def __len__(self):
+        return self._num_items
+
+    def _bit_positions(self, item):
+        if isinstance(item, unicode):
+            item = item.encode('utf-8')
+        # Derive all our hash functions from two halves of one digest, per
+        # Kirsch and Mitzenmacher.
+        h1, h2 = struct.unpack("<QQ", hashlib.md5(item).digest())
+        return [(h1 + i * h2) % self.num_bits
+                for i in xrange(self.num_hashes)]
+
+    def __contains__(self, item):
+        bits = self._bits
+        return all(bits[pos >> 3] & (1 << (pos & 7))
+                   for pos in self._bit_positions(item))
+
+    def add(self, item):
+        """Add 'item' to the set."""
+        positions = self._bit_positions(item)
+        with self._lock:
+            added = False
+            for pos in positions:
+                mask = 1 << (pos & 7)
+                if not self._bits[pos >> 3] & mask:
+                    self._bits[pos >> 3] |= mask
+                    added = True
+            if added:
+                self._num_items += 1
+
+    def error_rate(self):
+        """The expected false positive rate, given how many items we have."""
+        return (1 - math.exp(-float(self.num_hashes) * self._num_items /
+                             self.num_bits)) ** self.num_hashes
+
+    def stats(self):
+        """Return a dict of the filter's size and expected error rate."""
+        return {
+            "items": self._num_items,
+            "capacity": self.capacity,
+            "num_bits": self.num_bits,
+            "num_hashes": self.num_hashes,
+            "memory_bytes": len(self._bits),
+            "expected_false_positive_rate": self.error_rate(),
+        }
@@ -0,0 +1,32 @@
+"""Fetching JSON from the error-monitor-db's HTTP API.
+
+This is shared by the reporting tools, which talk to the server only over
+HTTP; it uses nothing but the standard library, so they can still be run
+from anywhere.
+"""
+import json
+import urllib2
+import zlib
+
+
+def _decode(body, encoding):
+    """Undo the Content-Encoding 'encoding' of 'body'."""
+    if encoding == 'gzip':
+        return zlib.decompress(body, 16 + zlib.MAX_WBITS)
+    if encoding == 'deflate':
+        # This should be zlib data, but some servers send raw deflate data.
+        try:
+            return zlib.decompress(body)
+        except zlib.error:
+            return zlib.decompress(body, -zlib.MAX_WBITS)
+    if encoding in (None, 'identity'):
+        return body
+    raise ValueError("Unexpected Content-Encoding %r" % encoding)
+
+
+def fetch_json(url):
+    """Fetch and parse the JSON at 'url', asking for it to be compressed."""
+    response = urllib2.urlopen(
+        urllib2.Request(url, headers={'Accept-Encoding': 'gzip, deflate'}))
+    return json.loads(_decode(response.read(),
+                              response.info().get('Content-Encoding')))
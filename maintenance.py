@@ -0,0 +1,96 @@
+#!/usr/bin/env python
+
+"""Periodic clean-up of the error-monitor-db's data in Redis.
+
+Most of what we store in Redis expires by itself, but some of it can't (see
+models.py).  This is run from cron to tidy that up.  Each task works through
+the data in small batches, so it doesn't hold up Redis for long, and is safe
+to run while the server is recording errors.
+
+Usage:
+    python maintenance.py <task> [--batch-size N] [--max-seconds S] ...
+    python maintenance.py rebuild_error_rollups [--batch-size N] ...
+    python maintenance.py rebuild_error_registry [--batch-size N] ...
+
+where <task> is one of compact_errordef_ids, prune_error_versions or
+run_maintenance, which runs both of those.  The server can also run that
+every so often itself; see --maintenance-interval in server.py.  Each task
+also takes --redis-host and the other flags for which Redis to use, as
+server.py does.
+"""
+import argparse
+
+import models
+
+
+def compact_errordef_ids(args):
+    """Remove the IDs of expired errors from the errordef hashes."""
+    stats = models.compact_errordef_ids(batch_size=args.batch_size,
+                                        max_seconds=args.max_seconds)
+    print ("Scanned %(scanned)d errordef entries, deleted %(deleted)d "
+           "(%(bytes_reclaimed)d bytes)." % stats)
+    if not stats["complete"]:
+        print "Ran out of time; will continue from here next time."
+
+
+def prune_error_versions(args):
+    """Remove expired versions from each error's list of versions."""
+    stats = models.prune_error_versions(batch_size=args.batch_size,
+                                        max_seconds=args.max_seconds)
+    print ("Looked at %(errors)d errors, deleted %(versions_deleted)d "
+           "versions and %(first_seen_deleted)d old first_seen keys." % stats)
+    if not stats["complete"]:
+        print "Ran out of time; will continue from here next time."
+
+
+def run_maintenance(args):
+    """Run compact_errordef_ids and prune_error_versions, sharing the time."""
+    results = models.run_maintenance(batch_size=args.batch_size,
+                                     max_seconds=args.max_seconds)
+    if results is None:
+        print "Another process is running maintenance; not running it too."
+        return
+    for task in (compact_errordef_ids, prune_error_versions):
+        print "%s: %s" % (task.__name__, results[task.__name__])
+
+
+def rebuild_error_rollups(args):
+    """Recompute the rollups of error counts across versions."""
+    stats = models.rebuild_error_rollups(batch_size=args.batch_size)
+    print ("Rebuilt the rollups for %(errors)d errors over %(log_hours)d "
+           "log hours." % stats)
+
+
+def rebuild_error_registry(args):
+    """Add any errors missing from the registry of errors to it."""
+    stats = models.rebuild_error_registry(batch_size=args.batch_size)
+    print "Added %(errors)d errors to the registry." % stats
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Clean up the error-monitor-db's data in Redis.")
+    subparsers = parser.add_subparsers()
+
+    for task in (compact_errordef_ids, prune_error_versions,
+                 run_maintenance):
+        task_parser = subparsers.add_parser(task.__name__, help=task.__doc__)
+        task_parser.add_argument("--batch-size", type=int, default=1000,
+                                 help="How many entries to look at at once.")
+        task_parser.add_argument("--max-seconds", type=float, default=None,
+                                 help="Stop after about this long, and carry "
+                                      "on from there next time.")
+        models.add_redis_arguments(task_parser)
+        task_parser.set_defaults(func=task)
+
+    for task in (rebuild_error_rollups, rebuild_error_registry):
+        task_parser = subparsers.add_parser(task.__name__, help=task.__doc__)
+        task_parser.add_argument("--batch-size", type=int, default=1000,
+                                 help="How many keys to read or write at "
+                                      "once.")
+        models.add_redis_arguments(task_parser)
+        task_parser.set_defaults(func=task)
+
+    args = parser.parse_args()
+    models.configure_redis_from_args(args)
+    args.func(args)
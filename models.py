@@ -75,6 +75,10 @@ We write to the following Redis keys:
     errordef:id0 ... errordef:id3 - Hashtables of identifier -> error key for
         various identifier types
 
+    error_registry - Sorted set of error keys, by the last time (in seconds
+        since the epoch) we wrote or refreshed the expiry of error:<key>, so
+        we can list the errors without scanning for error:* keys
+
 
     // Error occurrence information by version
 
@@ -107,6 +111,16 @@ We write to the following Redis keys:
     ver:<version>:errors_by_minute:<minute> - Sorted set of error keys seen
         during a 60-second interval 'minute' minutes after monitoring has begun
 
+    ver:MON_<version>:pending:<minute> - How many snapshots of monitoring data
+        for the minute server.py has queued but not yet recorded
+
+    monitor:stream - A stream of snapshots of monitoring data for
+        monitor_worker.py to record, when server.py is run with
+        --monitor-stream; read through the "monitor-workers" consumer group
+
+    monitor:stream:processed:<id> - Set once the snapshot with that stream
+        entry ID is recorded, so that it is never counted twice
+
 
     // BigQuery logs only
 
@@ -118,13 +132,53 @@ We write to the following Redis keys:
         this error appeared in this version's logs and the occurrence count
         for that hour
 
+    (NOTE: The following are rollups of the hours_seen dictionaries across
+     versions, kept up to date as we record errors, so that we can summarize
+     an error and find the top errors without reading them all.  See
+     rebuild_error_rollups.)
+
+    <key>:log_hours - A dictionary of "<log_hour>:<version>" for each log
+        hour and version when this error appeared in the logs, and the
+        occurrence count for that hour and version
+
+    log_hour:<log_hour>:errors - Sorted set of error keys seen in the logs for
+        the log hour
+
+    ver:<version>:log_hour:<log_hour>:errors - The same, for one GAE version
+
+
+    // Readers
+
+    data_generations - A dictionary of counters that go up whenever we have
+        recorded new data: "logs" for each log hour imported from BigQuery,
+        "monitoring" for each snapshot received while monitoring and
+        "MON_<version>" for each one for that version.  server.py caches its
+        responses until the counters they depend on change.
+
+
+    // Maintenance
+
+    maintenance:<what>:cursor - Where an unfinished maintenance task got up to
+        in scanning <what>, so the next run can carry on from there
+
+    maintenance:lock - Which process is running run_maintenance, if any
+
 
 """
+import collections
 import datetime
+import hashlib
 import json
+import logging
 import md5
+import os
 import re
 import redis
+import socket
+import threading
+import time
+
+import cache_util
 
 # GAE uses numbers internally to denote error level. We only care about levels
 # 3 and 4.
@@ -151,13 +205,23 @@ def _get_log_hour_int_expiry():
 # busting param doesn't indicate anything semantic about the API call
 _CACHE_BUST_QUERY_PARAM_RE = re.compile(r'(?<=[?&])_=\d+')
 
-# Each different version has a different file path. When we're deciding
-# whether two stacks are unique or not, we don't care about those, so
-# get rid of them.
+# Matches a line of a stack trace, like
+#   File "/base/data/.../api/errors.py", line 12, in wrapped
+# capturing the filename, line number and function.  We run this over the
+# whole message at once rather than line by line.  Lines that don't match are
+# skipped; this happens often because of a truncated line when the error
+# message becomes too long.
 #
-# The original file paths start like this:
+# Each different version has a different file path. When we're deciding
+# whether two stacks are unique or not, we don't care about those, so the
+# filename we capture leaves them out.  The original file paths start like
+# this:
 # /base/data/home/apps/s~khan-academy/1029-2305-f48a12e2b9ba.379742046073152437/api/errors.py @Nolint
-_VERSION_PATH_PREFIX_RE = re.compile(r'^.*\d{4}-\d{4}-[a-f0-9]{12}\.\d+/')
+_STACK_FRAME_RE = re.compile(
+    r'^  File "(?:[^"\n]*\d{4}-\d{4}-[a-f0-9]{12}\.\d+/)?([^"\n]*)", '
+    r'line (\d*), in (.*)$', re.MULTILINE)
+
+_DIGITS_RE = re.compile(r'\d+')
 
 # Keys in the error def that represent identifiers
 _ERROR_ID_KEYS = ["id0", "id1", "id2", "id3"]
@@ -180,7 +244,159 @@ _NON_COMBINABLE_ERRORS = [
     re.compile(r"""^(Memcache set failed for [^([{'"]*)"""),
 ]
 
+
+def _combine_regexps(regexps):
+    """Compile a list of regexps into one that finds the first that matches.
+
+    Each regexp becomes a lookahead from the start of the string, wrapped in
+    a named group, so matching the combined regexp tries them in list order
+    just like calling search() with each in turn -- but in one call.
+
+    Returns the combined regexp and a dict mapping each wrapper group's name
+    to the number of the original regexp's first capturing group within the
+    combined one (or None if it has no groups).
+    """
+    alternatives = []
+    first_groups = {}
+    num_groups = 0
+    for i, regexp in enumerate(regexps):
+        name = "regexp%d" % i
+        alternatives.append("(?=.*?(?P<%s>%s))" % (name, regexp.pattern))
+        first_groups[name] = num_groups + 2 if regexp.groups else None
+        num_groups += 1 + regexp.groups
+
+    return re.compile("|".join(alternatives)), first_groups
+
+
+_NON_COMBINABLE_ERRORS_RE, _NON_COMBINABLE_ERRORS_GROUPS = (
+    _combine_regexps(_NON_COMBINABLE_ERRORS))
+
+# The Redis we write to, and read from unless we're told stale data will do.
 r = redis.StrictRedis(host='localhost', port=6379, db=0)
+# A replica of r to read from when stale data will do, or None to always use
+# r.  See configure_redis.
+r_replica = None
+
+
+def make_redis_client(host='localhost', port=6379, db=0,
+                      unix_socket_path=None, pool_size=None,
+                      socket_timeout=None):
+    """Return a Redis client for a server at host:port or a unix socket.
+
+    If 'pool_size' is given, at most that many connections are opened, and
+    commands wait for one to be free.  'socket_timeout' is in seconds, and
+    applies to connecting as well as to each command.
+    """
+    if unix_socket_path:
+        connection_kwargs = {
+            "connection_class": redis.UnixDomainSocketConnection,
+            "path": unix_socket_path,
+        }
+    else:
+        connection_kwargs = {
+            "host": host,
+            "port": port,
+            "socket_connect_timeout": socket_timeout,
+        }
+    connection_kwargs.update(db=db, socket_timeout=socket_timeout)
+
+    if pool_size:
+        pool = redis.BlockingConnectionPool(max_connections=pool_size,
+                                            **connection_kwargs)
+    else:
+        pool = redis.ConnectionPool(**connection_kwargs)
+    return redis.StrictRedis(connection_pool=pool)
+
+
+def configure_redis(primary, replica=None):
+    """Set the Redis clients to write to and read from.
+
+    'primary' and 'replica' are clients as returned by make_redis_client.
+    The functions that only read take a 'stale_ok' argument; if it is True,
+    they read from 'replica' (if given) instead of 'primary'.  Anything that
+    needs to see what was just written, like the monitoring reads during a
+    deploy, always reads from 'primary'.
+    """
+    global r, r_replica
+    r = primary
+    r_replica = replica
+
+
+def add_redis_arguments(parser, replica=False):
+    """Add the flags for which Redis to use to an argparse parser.
+
+    With 'replica', there are flags for a replica to read from too.  Every
+    script that uses Redis takes these, and passes what it is given to
+    configure_redis_from_args.
+    """
+    parser.add_argument('--redis-host', default='localhost',
+        help='Host of the Redis primary, which we write to.')
+
+    parser.add_argument('--redis-port', type=int, default=6379,
+        help='Port of the Redis primary.')
+
+    parser.add_argument('--redis-socket', default=None,
+        help='Unix socket of the Redis primary, instead of host and port.')
+
+    if replica:
+        parser.add_argument('--replica-host', default=None,
+            help='Host of a Redis replica of the primary, to read from when '
+                 'a request says stale data is ok. (Default: no replica.)')
+
+        parser.add_argument('--replica-port', type=int, default=6379,
+            help='Port of the Redis replica.')
+
+        parser.add_argument('--replica-socket', default=None,
+            help='Unix socket of the Redis replica, instead of host and '
+                 'port.')
+
+    parser.add_argument('--redis-db', type=int, default=0,
+        help='Redis db number%s.' % (
+            ', on the primary and replica' if replica else ''))
+
+    parser.add_argument('--redis-pool-size', type=int, default=None,
+        help='Open at most this many connections to each Redis. '
+             '(Default: no limit.)')
+
+    parser.add_argument('--redis-timeout', type=float, default=None,
+        help='Give up on Redis commands after this many seconds. '
+             '(Default: never.)')
+
+
+def configure_redis_from_args(args):
+    """Call configure_redis with the flags add_redis_arguments added."""
+    primary = make_redis_client(
+        host=args.redis_host, port=args.redis_port, db=args.redis_db,
+        unix_socket_path=args.redis_socket, pool_size=args.redis_pool_size,
+        socket_timeout=args.redis_timeout)
+    replica = None
+    if getattr(args, "replica_host", None) or getattr(
+            args, "replica_socket", None):
+        replica = make_redis_client(
+            host=args.replica_host, port=args.replica_port, db=args.redis_db,
+            unix_socket_path=args.replica_socket,
+            pool_size=args.redis_pool_size, socket_timeout=args.redis_timeout)
+    configure_redis(primary, replica)
+
+
+def _reader(stale_ok):
+    """The Redis client to read from; see configure_redis."""
+    if stale_ok and r_replica is not None:
+        return r_replica
+    return r
+
+# How the writes for a single occurrence are sent to Redis.  In "pipeline"
+# mode (the default) they are queued on a non-transactional pipeline and sent
+# in one round trip once the whole write set is known.  "lua" mode does the
+# same, but the occurrence counters are updated by server-side Lua scripts so
+# that each occurrence's counters are applied atomically (see
+# _ERROR_DETAILS_SCRIPT).  In "direct" mode each command is sent as soon as it
+# is issued, which is slower but can be handy when debugging against a live
+# Redis.
+WRITE_MODE_DIRECT = "direct"
+WRITE_MODE_PIPELINE = "pipeline"
+WRITE_MODE_LUA = "lua"
+WRITE_MODE = WRITE_MODE_PIPELINE
 
 
 def can_connect():
@@ -195,53 +411,688 @@ def can_connect():
 # Caches for error data from Redis.
 ####
 
+# How many error defs we keep in memory.  Each also accounts for up to one
+# entry in each of the error ID caches.
+ERROR_DEF_CACHE_SIZE = 10000
+
+
+def _forget_error_ids(error_key, err):
+    """Drop the error ID cache entries for an error def leaving the cache.
+
+    This keeps the ID caches from pointing at errors we no longer know about
+    (or which have expired from Redis).  An ID may since have been mapped to a
+    different error, in which case we leave it alone.
+    """
+    for id in _ERROR_ID_KEYS:
+        if err[id] and _error_id_cache[id].peek(err[id]) == error_key:
+            _error_id_cache[id].delete(err[id])
+
+
+def _make_error_def_caches():
+    """Return new, empty error def and error ID caches."""
+    return (cache_util.LRUCache(ERROR_DEF_CACHE_SIZE,
+                                on_evict=_forget_error_ids),
+            {key: cache_util.LRUCache(ERROR_DEF_CACHE_SIZE)
+             for key in _ERROR_ID_KEYS})
+
+
 # A cache of the error def (status, level, title, IDs, etc.)
 # This cache is not invalidated when the error count changes since the
-# data is completely static after creation
-# TODO(tom) Allow entries to expire here like they do in Redis (get expiry
-# information from Redis)
-_error_def_cache = {}
-
-# A cache of error ID -> error key dictionaries, one for each identifier we
-# want to be able to look up errors with
-_error_id_cache = {key: {} for key in _ERROR_ID_KEYS}
+# data is completely static after creation.  Entries expire when the error
+# would have expired from Redis, as of when we fetched it; if it has been
+# seen again since, we'll just fetch it again.
+#
+# And a cache of error ID -> error key dictionaries, one for each identifier
+# we want to be able to look up errors with.  These are kept consistent with
+# the error def cache: entries are added along with the error def and removed
+# when it is evicted or expires.
+_error_def_cache, _error_id_cache = _make_error_def_caches()
+
+
+# The error keys whose expiry we've refreshed recently (see
+# _create_or_update_error), and how many writes we've avoided as a result of
+# this and the error def cache.
+EXPIRY_REFRESH_SECONDS = 60 * 60
+_expiry_refreshed = cache_util.LRUCache(ERROR_DEF_CACHE_SIZE,
+                                        default_ttl=EXPIRY_REFRESH_SECONDS)
+_error_def_write_stats = {
+    "def_writes": 0,
+    "def_writes_skipped": 0,
+    "id_writes": 0,
+    "id_writes_skipped": 0,
+    "expiry_refreshes": 0,
+    "expiry_refreshes_skipped": 0,
+}
+
+
+# A cache of _parse_message results, keyed by a digest of its arguments.
+# The same messages tend to show up over and over, so this saves us
+# re-parsing and re-hashing them every time.
+PARSE_CACHE_SIZE = 10000
+_parse_cache = cache_util.LRUCache(PARSE_CACHE_SIZE)
 
 
 def _reset_caches():
     """Used for tests."""
-    _error_def_cache.clear()
-    for k in _error_id_cache:
-        _error_id_cache[k] = {}
+    global _parse_cache, _error_def_cache, _error_id_cache
+    global _errordef_filters
+    global _error_registry_pruned_at
+    _parse_cache = cache_util.LRUCache(PARSE_CACHE_SIZE)
+    _error_def_cache, _error_id_cache = _make_error_def_caches()
+    _expiry_refreshed.clear()
+    _error_registry_pruned_at = 0
+    for k in _error_def_write_stats:
+        _error_def_write_stats[k] = 0
+    _errordef_filters = _ErrorDefFilters({})
+    for k in _invalidation_stats:
+        _invalidation_stats[k] = 0
+    for id in _ERROR_ID_KEYS:
+        _errordef_filter_stats[id] = {"skipped": 0, "false_positives": 0}
+    _maintenance_stats.update(runs=0, runs_skipped=0, last_run=None)
+    _maintenance_stats["compact_errordef_ids"].clear()
+    _maintenance_stats["prune_error_versions"].clear()
+
+
+def get_cache_stats():
+    """Return size and hit/miss counters for our in-process caches."""
+    stats = {
+        "parse_message": _parse_cache.stats(),
+        "error_def": _error_def_cache.stats(),
+        "invalidation": dict(_invalidation_stats,
+                             subscribed=_invalidations_subscribed),
+        "warm_up": _warm_up_stats,
+        "error_def_writes": _error_def_write_stats,
+    }
+    for id, filter_stats in _get_errordef_filter_stats().iteritems():
+        stats["errordef_filter:%s" % id] = filter_stats
+    for id in _ERROR_ID_KEYS:
+        stats["error_id:%s" % id] = _error_id_cache[id].stats()
+    return stats
 
 
 def _get_cached_error_def(error_key):
     """Retrieve the error def information from cache or Redis."""
-    if error_key in _error_def_cache:
-        return _error_def_cache[error_key]
-
-    err = r.get("error:%s" % error_key)
+    err = _error_def_cache.get(error_key)
+    if err is not None:
+        return err
+
+    generation = _invalidation_generation
+    pipeline = r.pipeline(transaction=False)
+    pipeline.get("error:%s" % error_key)
+    pipeline.ttl("error:%s" % error_key)
+    err, ttl = pipeline.execute()
     if not err:
         return None
 
-    err = json.loads(err)
+    return _cache_error_def(error_key, json.loads(err), ttl,
+                            generation=generation)
 
+
+def _cache_error_def(error_key, err, ttl, cache=True, generation=None):
+    """Add an error def from Redis to the caches, and return it.
+
+    'err' is the error def dict and 'ttl' is the TTL of its key in Redis.
+    If 'cache' is False we only add level_readable to it.
+
+    'generation' is the value of _invalidation_generation from before we
+    read 'err'.  If we've had an invalidation since, 'err' may be the old
+    def it was about, so we don't cache it.
+    """
     # Add a readable version of "level" to the error def before it goes in the
     # cache
     err["level_readable"] = ERROR_LEVELS[int(err["level"])]
 
-    _error_def_cache[error_key] = err
-    for id in _ERROR_ID_KEYS:
-        _error_id_cache[id][err[id]] = error_key
+    # Errors without an expiry shouldn't exist, but if they do we check back
+    # as often as we would for one that was just seen.
+    if ttl is None or ttl < 0:
+        ttl = KEY_EXPIRY_SECONDS
+
+    if not cache or not _can_cache_error_defs():
+        return err
+
+    with _invalidation_lock:
+        if generation is not None and generation != _invalidation_generation:
+            return err
+        _error_def_cache.set(error_key, err, ttl=ttl)
+        for id in _ERROR_ID_KEYS:
+            if err[id]:
+                _error_id_cache[id].set(err[id], error_key, ttl=ttl)
     return err
 
 # TODO(tom) Cache summary statistics and drill-down information
 
 
+####
+# Keeping the error def caches coherent between processes
+####
+
+# Each process that records errors (server.py workers, bigquery_import.py,
+# monitor_worker.py) caches error defs, but any of them may rewrite one, e.g.
+# to update its title.  So whenever we write an error def we publish its key
+# and IDs on this channel, and processes that run
+# start_invalidation_listener() drop them from their caches.  A process that
+# doesn't run it caches error defs until they expire, and never hears about
+# changes, so every long-running process that records errors must run it.
+# (maintenance.py doesn't look up error defs, so it needn't.)
+ERROR_DEF_INVALIDATION_CHANNEL = "errordef:invalidations"
+
+# How long to wait before trying to resubscribe if we lose the subscription.
+INVALIDATION_RETRY_SECONDS = 5
+
+# The thread running _listen_for_invalidations, if any, and whether it is
+# currently subscribed.  While it isn't, we can't know what we've missed, so
+# we don't cache error defs at all.
+_invalidation_listener = None
+_invalidations_subscribed = False
+
+# Bumped for every invalidation from another process, so that a def read from
+# Redis isn't cached if it may have been invalidated while we read it (see
+# _cache_error_def).  The lock makes checking it and caching one step.
+_invalidation_generation = 0
+_invalidation_lock = threading.Lock()
+
+_invalidation_stats = {
+    "messages": 0,
+    "subscribes": 0,
+    "disconnects": 0,
+}
+
+
+def _clear_error_def_caches():
+    _error_def_cache.clear()
+    for id in _ERROR_ID_KEYS:
+        _error_id_cache[id].clear()
+
+
+def _can_cache_error_defs():
+    """Whether we would hear if an error def we cache were changed."""
+    return _invalidation_listener is None or _invalidations_subscribed
+
+
+def _process_id():
+    """Identify this process, to tell our own invalidations from others'."""
+    return "%s:%d" % (socket.gethostname(), os.getpid())
+
+
+def _publish_error_def_invalidation(writer, error_def):
+    """Queue a message telling other processes error_def has changed."""
+    writer.publish(ERROR_DEF_INVALIDATION_CHANNEL, json.dumps({
+        "origin": _process_id(),
+        "key": error_def["key"],
+        "ids": {id: error_def[id] for id in _ERROR_ID_KEYS if error_def[id]},
+    }))
+
+
+def _handle_invalidation_message(message):
+    """Update our caches for a message from the invalidation channel."""
+    global _invalidations_subscribed, _invalidation_generation
+
+    if message["type"] == "subscribe":
+        # We may have missed some messages before we (re)subscribed, so
+        # start from scratch.
+        with _invalidation_lock:
+            _invalidation_generation += 1
+            _clear_error_def_caches()
+        _rebuild_errordef_filters()
+        _invalidations_subscribed = True
+        _invalidation_stats["subscribes"] += 1
+    elif message["type"] == "message":
+        data = json.loads(message["data"])
+        if data.get("origin") == _process_id():
+            # Our caches are already up to date with our own writes.
+            return
+        with _invalidation_lock:
+            _invalidation_generation += 1
+            _error_def_cache.delete(data["key"])
+            for id, value in data["ids"].iteritems():
+                _error_id_cache[id].delete(value)
+        _note_error_ids(data["ids"])
+        _invalidation_stats["messages"] += 1
+
+
+def _invalidation_client():
+    """A client for r with its own connection for the subscription.
+
+    The subscription holds its connection for as long as we listen, so it
+    mustn't come out of r's pool, which may be a fixed size (see
+    make_redis_client).  Nor should it time out while nothing is changing.
+    """
+    pool = getattr(r, "connection_pool", None)
+    if pool is None:
+        # fakeredis, in tests.
+        return r
+    connection_kwargs = dict(pool.connection_kwargs, socket_timeout=None)
+    return redis.StrictRedis(connection_pool=redis.ConnectionPool(
+        connection_class=pool.connection_class, max_connections=1,
+        **connection_kwargs))
+
+
+def _listen_for_invalidations():
+    """Subscribe to the invalidation channel and handle messages forever."""
+    global _invalidations_subscribed
+
+    while True:
+        pubsub = _invalidation_client().pubsub()
+        try:
+            pubsub.subscribe(ERROR_DEF_INVALIDATION_CHANNEL)
+            for message in pubsub.listen():
+                _handle_invalidation_message(message)
+        except (redis.exceptions.ConnectionError,
+                redis.exceptions.TimeoutError) as e:
+            logging.warning("Lost error def invalidation subscription: %s" % e)
+        except Exception:
+            # Whatever it was, we resubscribe rather than stop listening,
+            # which would leave us never caching error defs again.
+            logging.exception("Failed handling error def invalidations")
+        finally:
+            _invalidations_subscribed = False
+            _errordef_filters.ready = False
+            pubsub.close()
+
+        # Stop using the caches until we are subscribed again.
+        _clear_error_def_caches()
+        _invalidation_stats["disconnects"] += 1
+        time.sleep(INVALIDATION_RETRY_SECONDS)
+
+
+####
+# Filters for error IDs we have never seen
+####
+
+# For each error ID, a Bloom filter of all the values in errordef:<id>, so
+# that we can tell a brand-new error apart without asking Redis.  These are
+# only kept up to date while we are subscribed to the invalidation channel,
+# which tells us about IDs other processes add, so they are rebuilt from Redis
+# each time we (re)subscribe and only trusted once that is done.
+ERRORDEF_FILTERS_ENABLED = True
+ERRORDEF_FILTER_MIN_CAPACITY = 100000
+ERRORDEF_FILTER_ERROR_RATE = 0.01
+
+
+class _ErrorDefFilters(dict):
+    """The filter for each error ID, and whether they are filled yet.
+
+    A rebuild replaces the whole object, so code that takes one reference to
+    it sees filters and a 'ready' flag that belong together.
+    """
+    def __init__(self, filters):
+        dict.__init__(self, filters)
+        self.ready = False
+
+
+_errordef_filters = _ErrorDefFilters({})
+_errordef_filter_thread = None
+
+# How many lookups the filters have answered, per ID.  A false positive is
+# when the filter says the ID may be there but Redis doesn't have it.
+_errordef_filter_stats = {id: {"skipped": 0, "false_positives": 0}
+                          for id in _ERROR_ID_KEYS}
+
+
+def _errordef_filters_usable(filters):
+    """Whether we can trust 'filters', a value of _errordef_filters."""
+    return (ERRORDEF_FILTERS_ENABLED and filters.ready and
+            _invalidations_subscribed)
+
+
+def _note_error_ids(ids):
+    """Add the error ID values in 'ids' (e.g. an error def) to the filters."""
+    filters = _errordef_filters
+    needs_rebuild = False
+    for id in _ERROR_ID_KEYS:
+        value = ids.get(id)
+        if value and id in filters:
+            filters[id].add(value)
+            needs_rebuild |= len(filters[id]) > filters[id].capacity
+
+    if needs_rebuild and filters.ready:
+        # We've outgrown the filter, and its error rate will start to climb.
+        _rebuild_errordef_filters()
+
+
+def _fill_errordef_filters(filters):
+    """Add every ID in Redis to the filters, and start using them."""
+    for id, bloom_filter in filters.iteritems():
+        cursor = 0
+        while True:
+            cursor, ids = r.hscan(
+                "errordef:%s" % id, cursor=cursor, count=1000)
+            for value in ids:
+                bloom_filter.add(value)
+            if cursor == 0:
+                break
+
+    # If a newer rebuild has replaced them in the meantime, this does no
+    # harm: no one looks at them any more.
+    filters.ready = True
+
+
+def _rebuild_errordef_filters():
+    """Replace the filters with new ones filled from Redis in the background.
+
+    The new filters are installed right away, so that IDs added while we are
+    scanning Redis make it into them, but are not used until filled.
+    """
+    global _errordef_filters, _errordef_filter_thread
+
+    if not ERRORDEF_FILTERS_ENABLED:
+        return
+
+    pipeline = r.pipeline(transaction=False)
+    for id in _ERROR_ID_KEYS:
+        pipeline.hlen("errordef:%s" % id)
+    sizes = pipeline.execute()
+
+    _errordef_filters = _ErrorDefFilters({
+        id: cache_util.BloomFilter(
+            max(ERRORDEF_FILTER_MIN_CAPACITY, 2 * size),
+            ERRORDEF_FILTER_ERROR_RATE)
+        for id, size in zip(_ERROR_ID_KEYS, sizes)})
+
+    _errordef_filter_thread = threading.Thread(
+        target=_fill_errordef_filters, args=(_errordef_filters,),
+        name="errordef-filter-rebuild")
+    _errordef_filter_thread.daemon = True
+    _errordef_filter_thread.start()
+
+
+def _get_errordef_filter_stats():
+    filters = _errordef_filters
+    stats = {}
+    for id in _ERROR_ID_KEYS:
+        stats[id] = dict(_errordef_filter_stats[id],
+                         ready=_errordef_filters_usable(filters))
+        if id in filters:
+            stats[id].update(filters[id].stats())
+        lookups = (stats[id]["skipped"] + stats[id]["false_positives"])
+        stats[id]["false_positive_rate"] = (
+            float(stats[id]["false_positives"]) / lookups if lookups
+            else None)
+    return stats
+
+
+def start_invalidation_listener():
+    """Keep this process's error def caches coherent with other processes.
+
+    Starts a background thread listening for changes to error defs.  Until it
+    has subscribed, and whenever it has lost its subscription, error defs are
+    not cached.
+    """
+    global _invalidation_listener
+    if _invalidation_listener is not None:
+        return
+
+    _invalidation_listener = threading.Thread(
+        target=_listen_for_invalidations, name="invalidation-listener")
+    _invalidation_listener.daemon = True
+    _invalidation_listener.start()
+
+
+####
+# Warming up the error def caches
+####
+
+# How many error defs to fetch from Redis per round trip.
+WARM_UP_BATCH_SIZE = 500
+
+# The results of the last warm-up, for /stats.
+_warm_up_stats = {}
+
+
+def warm_error_def_caches(max_seconds, max_entries=None):
+    """Fill the error def caches from Redis, so the first lookups hit.
+
+    Every error has an id0, so we find them all by scanning errordef:id0, and
+    fetch the live ones in batches.  We stop after 'max_seconds' or once we
+    have cached 'max_entries' error defs (by default, as many as the cache
+    holds).  If an invalidation listener has been started, we wait for it to
+    subscribe first, since until it has we can't cache anything.
+
+    Returns (and records for get_cache_stats) how many error defs we cached,
+    how long it took and whether we got through all of them.
+    """
+    start = time.time()
+    deadline = start + max_seconds
+    if max_entries is None:
+        max_entries = ERROR_DEF_CACHE_SIZE
+
+    while not _can_cache_error_defs() and time.time() < deadline:
+        time.sleep(0.1)
+
+    seen_keys = set()
+    num_cached = 0
+    cursor = 0
+    scanned_all = full = False
+    while _can_cache_error_defs() and time.time() < deadline:
+        cursor, ids = r.hscan("errordef:id0", cursor=cursor,
+                              count=WARM_UP_BATCH_SIZE)
+        scanned_all = cursor == 0
+        error_keys = list(set(ids.itervalues()) - seen_keys)
+        seen_keys.update(error_keys)
+
+        if error_keys:
+            generation = _invalidation_generation
+            pipeline = r.pipeline(transaction=False)
+            pipeline.mget(["error:%s" % k for k in error_keys])
+            for error_key in error_keys:
+                pipeline.ttl("error:%s" % error_key)
+            results = pipeline.execute()
+            for error_key, err, ttl in zip(error_keys, results[0],
+                                           results[1:]):
+                if num_cached >= max_entries:
+                    full = True
+                    break
+                # The IDs of expired errors stay in errordef:id0.
+                if err:
+                    _cache_error_def(error_key, json.loads(err), ttl,
+                                     generation=generation)
+                    num_cached += 1
+
+        if scanned_all or full:
+            break
+
+    _warm_up_stats.update({
+        "entries": num_cached,
+        "seconds": time.time() - start,
+        "complete": scanned_all and not full,
+    })
+    return dict(_warm_up_stats)
+
+
+def start_cache_warm_up(max_seconds, max_entries=None):
+    """Run warm_error_def_caches in a background thread."""
+    thread = threading.Thread(target=warm_error_def_caches,
+                              args=(max_seconds, max_entries),
+                              name="cache-warm-up")
+    thread.daemon = True
+    thread.start()
+    return thread
+
+
+####
+# Batching of Redis writes
+####
+
+
+class _DirectWriter(object):
+    """A stand-in for a Redis pipeline that sends each command immediately.
+
+    This lets the write paths queue commands and call execute() the same way
+    regardless of WRITE_MODE; the results of the commands are collected and
+    returned from execute() just like a pipeline would.
+    """
+    def __init__(self, redis_client):
+        self._redis = redis_client
+        self._results = []
+
+    def __getattr__(self, name):
+        command = getattr(self._redis, name)
+
+        def send(*args, **kwargs):
+            self._results.append(command(*args, **kwargs))
+            return self
+
+        return send
+
+    def execute(self):
+        results, self._results = self._results, []
+        return results
+
+
+class _LuaScript(object):
+    """A Lua script that we run on the Redis server.
+
+    We SCRIPT LOAD the script the first time it is used in this process and
+    then run it by its SHA1.  If Redis has lost it since (for instance after
+    a restart), _ScriptWriter falls back to sending the whole script with
+    EVAL, which also puts it back in Redis's script cache.
+    """
+    def __init__(self, source):
+        self.source = source
+        self.sha = hashlib.sha1(source).hexdigest()
+        self.loaded = False
+
+    def load(self, redis_client):
+        if not self.loaded:
+            redis_client.script_load(self.source)
+            self.loaded = True
+
+
+# Updates the occurrence counters gathered by _add_error_details (see
+# _queue_error_details).
+#
+# KEYS: the sorted sets to increment, then the hashes of stacks to set
+# ARGV: expiry, how many of KEYS are sorted sets, then for each key its
+#     member and increment, or field and value
+_ERROR_DETAILS_SCRIPT = _LuaScript("""
+local expiry = ARGV[1]
+local num_sorted_sets = tonumber(ARGV[2])
+for i = 1, #KEYS do
+    if i <= num_sorted_sets then
+        redis.call('ZINCRBY', KEYS[i], ARGV[2 * i + 2], ARGV[2 * i + 1])
+    else
+        redis.call('HSET', KEYS[i], ARGV[2 * i + 1], ARGV[2 * i + 2])
+    end
+    redis.call('EXPIRE', KEYS[i], expiry)
+end
+""")
+
+# Adds 'count' occurrences of an error from a single IP during a monitoring
+# minute, and bumps the error's unique-IP count if they are the first from
+# that IP.  Doing this on the server avoids a race between two workers
+# handling the same IP.
+#
+# KEYS: ip_<ip>:errors_by_minute:<minute>, unique_errors_by_minute:<minute>
+# ARGV: error key, count, expiry, per-IP key expiry
+_MONITORING_IP_SCRIPT = _LuaScript("""
+local count = tonumber(ARGV[2])
+local ip_count = tonumber(redis.call('ZINCRBY', KEYS[1], count, ARGV[1]))
+redis.call('EXPIRE', KEYS[1], ARGV[4])
+if ip_count == count then
+    redis.call('ZINCRBY', KEYS[2], 1, ARGV[1])
+    redis.call('EXPIRE', KEYS[2], ARGV[3])
+end
+return ip_count
+""")
+
+
+class _ScriptWriter(object):
+    """A non-transactional pipeline that can also run our Lua scripts.
+
+    Commands are queued on the pipeline as usual; run_script() queues an
+    EVALSHA, and execute() retries any script Redis didn't know with EVAL.
+    """
+    def __init__(self, redis_client):
+        self._redis = redis_client
+        self._pipe = redis_client.pipeline(transaction=False)
+        self._num_commands = 0
+        self._scripts = []
+
+    def __getattr__(self, name):
+        command = getattr(self._pipe, name)
+
+        def queue(*args, **kwargs):
+            command(*args, **kwargs)
+            self._num_commands += 1
+            return self
+
+        return queue
+
+    def run_script(self, script, keys, args):
+        script.load(self._redis)
+        self._pipe.evalsha(script.sha, len(keys), *(keys + args))
+        self._scripts.append((self._num_commands, script, keys, args))
+        self._num_commands += 1
+        return self
+
+    def execute(self):
+        results = self._pipe.execute(raise_on_error=False)
+        for i, script, keys, args in self._scripts:
+            if isinstance(results[i], redis.exceptions.NoScriptError):
+                results[i] = self._redis.eval(
+                    script.source, len(keys), *(keys + args))
+        self._num_commands = 0
+        self._scripts = []
+
+        for result in results:
+            if isinstance(result, Exception):
+                raise result
+        return results
+
+
+def _get_writer():
+    """Return an object to queue writes on, according to WRITE_MODE.
+
+    Callers issue Redis commands on the returned object and then call its
+    execute() method, which returns the list of command results.  In "lua"
+    mode the object also has a run_script() method.
+    """
+    if WRITE_MODE == WRITE_MODE_PIPELINE:
+        return r.pipeline(transaction=False)
+    elif WRITE_MODE == WRITE_MODE_LUA:
+        return _ScriptWriter(r)
+    return _DirectWriter(r)
+
+
+def _after_writes(writer, callback):
+    """Call 'callback' once the writes queued on 'writer' have succeeded.
+
+    This is for updating our caches to say what is in Redis: if we did that
+    before the writes went out, and they failed, we would believe writes we
+    then skip had been made.  The writer must be sent with _execute_writes.
+    """
+    callbacks = getattr(writer, "_after_write_callbacks", None)
+    if callbacks is None:
+        callbacks = writer._after_write_callbacks = []
+    callbacks.append(callback)
+
+
+def _execute_writes(writer):
+    """Send the writes queued on 'writer', then run its _after_writes.
+
+    Returns what writer.execute() does.  If it raises, the callbacks are
+    dropped along with the writes.
+    """
+    callbacks = getattr(writer, "_after_write_callbacks", None) or []
+    writer._after_write_callbacks = []
+    results = writer.execute()
+    for callback in callbacks:
+        callback()
+    return results
+
+
 ####
 # General-purpose error tracking methods
 ####
 
 
+# Errors whose score in error_registry is more than KEY_EXPIRY_SECONDS ago
+# have expired.  We remove them from it every REGISTRY_PRUNE_SECONDS or so,
+# as we write errors; _error_registry_pruned_at is when we last did.
+REGISTRY_PRUNE_SECONDS = 60
+_error_registry_pruned_at = 0
+
+
 def _find_error_by_def(error_def):
     """Find an existing error by the identifying information in error_def.
 
@@ -250,8 +1101,29 @@ def _find_error_by_def(error_def):
     Note that just because we have an error key doesn't mean that the error
     information is still in Redis - since we cannot expire individual entries
     from the errordef hashtables, we will still return an error key even if
-    all other information about it has expired.
+    all other information about it has expired, until compact_errordef_ids
+    has cleaned up after it.
     """
+    # If none of the IDs have ever been seen, this must be a new error: its
+    # key is derived from them.
+    # The filters may be replaced at any time by a rebuild in another
+    # thread, so we only look at the ones we checked were usable.
+    filters = _errordef_filters
+    use_filters = _errordef_filters_usable(filters)
+    if use_filters:
+        maybe_seen_ids = []
+        for id in _ERROR_ID_KEYS:
+            if not error_def[id]:
+                continue
+            if error_def[id] in filters[id]:
+                maybe_seen_ids.append(id)
+            else:
+                _errordef_filter_stats[id]["skipped"] += 1
+        if not maybe_seen_ids:
+            return None
+    else:
+        maybe_seen_ids = [id for id in _ERROR_ID_KEYS if error_def[id]]
+
     # Try to match by hash
     if (error_def['key'] in _error_def_cache or
             r.get("error:%s" % error_def['key'])):
@@ -260,32 +1132,39 @@ def _find_error_by_def(error_def):
     # Try to match by each ID in turn
 
     # Look up in in-memory cache first
-    for id in _ERROR_ID_KEYS:
-        if not error_def[id]:
-            continue
+    for id in maybe_seen_ids:
         error_key = _error_id_cache[id].get(error_def[id])
         if error_key:
             return error_key
 
     # Fall back to Redis
-    for id in _ERROR_ID_KEYS:
-        if not error_def[id]:
-            continue
+    for id in maybe_seen_ids:
         error_key = r.hget("errordef:%s" % id, error_def[id])
         if error_key:
             return error_key
+        if use_filters:
+            _errordef_filter_stats[id]["false_positives"] += 1
 
     return None
 
 
-def _create_or_update_error(error_def, expiry):
+def _create_or_update_error(error_def, expiry, pipe=None):
     """Write identifying error info to Redis.
 
     'error_def' is the error information dict returned by _parse_message.
 
     'expiry' is the timeout in seconds until all these keys expire (or -1
     for no expiration). Existing errors will have their expiration lease
-    renewed.
+    renewed, at most once every EXPIRY_REFRESH_SECONDS.
+
+    Nothing is written that we know to be there already: the error def is
+    only written if its title, status or level have changed since the copy in
+    our cache, and the IDs only if our cache doesn't already map them to it.
+
+    'pipe' is an optional writer returned by _get_writer() to queue the
+    writes on, in which case the caller is responsible for executing it with
+    _execute_writes, which also updates our caches once the writes are made.
+    Otherwise the writes are sent before we return.
 
     This stores the *most recent* error-message for a given key.
     That results in more redis operations than the alternative
@@ -297,14 +1176,16 @@ def _create_or_update_error(error_def, expiry):
 
     # Attempt to match an existing error
     error_key = _find_error_by_def(error_def)
+    existing_error_def = None
     if not error_key:
         # If we do not have an error key, then this is a brand-new error.
         error_def_to_put = error_def
         error_key = error_def['key']
     else:
-        existing_error_def = r.get("error:%s" % error_key)
+        existing_error_def = _get_cached_error_def(error_key)
         if existing_error_def:
-            error_def_to_put = json.loads(existing_error_def)
+            error_def_to_put = dict(existing_error_def)
+            del error_def_to_put['level_readable']
             # Update the error-def's error-message with the most-recent error.
             error_def_to_put['title'] = error_def['title']
             error_def_to_put['status'] = error_def['status']
@@ -314,23 +1195,65 @@ def _create_or_update_error(error_def, expiry):
             # error_def, but has expired from Redis.  Now that is has
             # recurred we should recreate it, though sadly the key may
             # have changed.
-            error_def_to_put = error_def
-            error_def_to_put['key'] = error_key
-
-    # Store the error def information as one key.
-    r.set("error:%s" % error_key, json.dumps(error_def_to_put))
+            error_def_to_put = dict(error_def, key=error_key)
 
-    # Store the IDs in the lookup tables
-    # TODO(tom) Since these are all in big hashtables, we can't expire
-    # them automatically. We could however rebuild the hashtables from
-    # all the unexpired errors.
-    # TODO(csilvers): avoid doing this if error_def[id] == r.get()[id]
+    if pipe is None:
+        writer = _get_writer()
+    else:
+        writer = pipe
+
+    # Store the error def information as one key, unless it hasn't changed.
+    # (We compare the JSON since the existing def has unicode strings.)
+    if existing_error_def and not any(
+            json.dumps(existing_error_def[field]) !=
+            json.dumps(error_def_to_put[field])
+            for field in ("title", "status", "level")):
+        _error_def_write_stats["def_writes_skipped"] += 1
+        wrote_def = False
+    else:
+        writer.set("error:%s" % error_key, json.dumps(error_def_to_put))
+        _error_def_write_stats["def_writes"] += 1
+        wrote_def = True
+
+        # Update our own copy once it's written, and tell other processes
+        # theirs is stale.
+        def_to_cache = dict(error_def_to_put)
+        generation = _invalidation_generation
+        _after_writes(writer, lambda: _cache_error_def(
+            error_key, def_to_cache,
+            expiry if expiry > 0 else KEY_EXPIRY_SECONDS,
+            generation=generation))
+        _publish_error_def_invalidation(writer, error_def_to_put)
+
+    # Store the IDs in the lookup tables, unless we know they're there.
+    # Since these are all in big hashtables, we can't expire them
+    # automatically; instead maintenance.py removes the IDs of expired errors.
     for id in ["id0", "id1", "id2", "id3"]:
-        if error_def_to_put[id]:
-            r.hset("errordef:%s" % id, error_def_to_put[id], error_key)
+        if not error_def_to_put[id]:
+            continue
+        if (existing_error_def and _error_id_cache[id].peek(
+                error_def_to_put[id]) == error_key):
+            _error_def_write_stats["id_writes_skipped"] += 1
+        else:
+            writer.hset("errordef:%s" % id, error_def_to_put[id], error_key)
+            _error_def_write_stats["id_writes"] += 1
+    _note_error_ids(error_def_to_put)
+
+    # Bump the expiry time for the error information.  Setting the key clears
+    # its expiry, so then we must; otherwise we only do it every so often,
+    # since losing up to EXPIRY_REFRESH_SECONDS off the end of its life is a
+    # small price to pay for not doing it on every occurrence.
+    if wrote_def or error_key not in _expiry_refreshed:
+        writer.expire("error:%s" % error_key, expiry)
+        writer.zadd("error_registry", time.time(), error_key)
+        _after_writes(writer, lambda: _expiry_refreshed.set(error_key, True))
+        _error_def_write_stats["expiry_refreshes"] += 1
+    else:
+        _error_def_write_stats["expiry_refreshes_skipped"] += 1
+    _prune_error_registry(writer)
 
-    # Bump the expiry time for the error information
-    r.expire("error:%s" % error_key, expiry)
+    if pipe is None:
+        _execute_writes(writer)
 
     return error_key
 
@@ -357,12 +1280,37 @@ def _parse_message(message, status, level):
             'function': "parse_file"
         }],
         1234092)
+
+    The results are cached, and callers get their own copy of them, so they
+    are free to modify it.
     """
+    if isinstance(message, unicode):
+        digest_input = message.encode('utf-8')
+    else:
+        digest_input = message
+    # status and level are repr'd since callers pass both ints and strings,
+    # and we must give them back the type they passed in.
+    cache_key = md5.md5(
+        "%r\0%r\0%s" % (status, level, digest_input)).digest()
+    result = _parse_cache.get(cache_key)
+    if result is None:
+        result = _parse_message_uncached(message, status, level)
+        _parse_cache.set(cache_key, result)
+
+    error_def, stack, stack_key = result
+    return (dict(error_def), [dict(frame) for frame in stack], stack_key)
+
+
+def _parse_message_uncached(message, status, level):
+    """The implementation of _parse_message, without any caching."""
     error_def = {}
-    msg_lines = message.split("\n")
+    first_newline = message.find("\n")
 
     # The first line of the message is *usually* the visible error message
-    error_def['title'] = msg_lines[0].encode('utf-8')
+    if first_newline == -1:
+        error_def['title'] = message.encode('utf-8')
+    else:
+        error_def['title'] = message[:first_newline].encode('utf-8')
 
     # When a warning gets promoted to an error, we insert an indicator
     # of that, which should be removed for id-ing purposes.
@@ -373,7 +1321,8 @@ def _parse_message(message, status, level):
     if not error_def['title']:
         # For some errors, the first line is empty and the interesting message
         # is only found at the end :P
-        error_def['title'] = msg_lines[-1].encode('utf-8')
+        error_def['title'] = (
+            message[message.rfind("\n") + 1:].encode('utf-8'))
 
     # Copy over status & level
     error_def['status'] = status
@@ -384,24 +1333,22 @@ def _parse_message(message, status, level):
     # id0 is the title with numbers removed
     id_prefix = str("%s %s " % (status, level))
     error_def['id0'] = (
-        id_prefix + re.sub(r'\d+', '%%', error_def['title']))
-
-    for regexp in _NON_COMBINABLE_ERRORS:
-        m = regexp.search(error_def['title'])
-        if m:
-            # If this error is special-cased, don't use id1 and id2, and use
-            # the first group, if any, for id3.
-            error_def['id1'] = None
-            error_def['id2'] = None
-            error_def['id3'] = m.group(1) if m.groups() else None
-            break
+        id_prefix + _DIGITS_RE.sub('%%', error_def['title']))
+
+    m = _NON_COMBINABLE_ERRORS_RE.match(error_def['title'])
+    if m:
+        # If this error is special-cased, don't use id1 and id2, and use
+        # the first group, if any, for id3.
+        first_group = _NON_COMBINABLE_ERRORS_GROUPS[m.lastgroup]
+        error_def['id1'] = None
+        error_def['id2'] = None
+        error_def['id3'] = m.group(first_group) if first_group else None
     else:
         # Otherwisse, id1 and id2 are, respectively, the first and last 3 words
         # of the title, and we don't use id3.
-        error_def['id1'] = (
-            id_prefix + " ".join(error_def['id0'].split(" ")[2:5]))
-        error_def['id2'] = (
-            id_prefix + " ".join(error_def['id0'].split(" ")[-3:]))
+        id0_words = error_def['id0'].split(" ")
+        error_def['id1'] = id_prefix + " ".join(id0_words[2:5])
+        error_def['id2'] = id_prefix + " ".join(id0_words[-3:])
         error_def['id3'] = None
 
     # Build a hash of the identifiers to serve as a single unique
@@ -413,19 +1360,9 @@ def _parse_message(message, status, level):
 
     # Parse the rest of the message, which we expect to be a stack trace
     stack = []
-
-    for line in msg_lines[1:]:
-        if line.startswith("Traceback"):
-            continue
-        if line.startswith("  File "):
-            match = re.match(
-                r'  File "([^"]*)", line (\d*), in (.*)', line)
-            if not match:
-                # This case happens often because of a truncated line when the
-                # error message becomes too long.
-                continue
+    if first_newline != -1:
+        for match in _STACK_FRAME_RE.finditer(message, first_newline + 1):
             (filename, lineno, function) = match.groups()
-            filename = _VERSION_PATH_PREFIX_RE.sub('', filename)
             stack.append({
                 "filename": filename,
                 "lineno": lineno,
@@ -442,25 +1379,117 @@ def _parse_message(message, status, level):
     return (error_def, stack, stack_key)
 
 
-def get_error_keys():
-    """Scans Redis for a list of all unexpired error keys."""
-    cursor = 0
-    error_keys = set()  # The same error key can be returned twice
-    while True:
-        cursor, keys = r.scan(cursor=cursor, match="error:*", count=1000)
-        error_keys.update(k.split(":")[1] for k in keys)
-        if cursor == 0:
-            break
+def get_data_generation(fields, stale_ok=False):
+    """Return how many times we've recorded new data of the given kinds.
 
-    return error_keys
+    'fields' are the names of counters in data_generations (see the top of
+    this file).  The return value is a tuple of their values, which changes
+    whenever any of that data does.  'stale_ok' is as for configure_redis.
+    """
+    return tuple(int(generation or 0) for generation in
+                 _reader(stale_ok).hmget("data_generations", fields))
+
+
+def _prune_error_registry(writer):
+    """Queue removing expired errors from error_registry, every so often."""
+    global _error_registry_pruned_at
+    now = time.time()
+    if now - _error_registry_pruned_at >= REGISTRY_PRUNE_SECONDS:
+        writer.zremrangebyscore("error_registry", "-inf",
+                                "(%f" % (now - KEY_EXPIRY_SECONDS))
+        _error_registry_pruned_at = now
 
 
-def get_error_keys_by_version(version):
+def get_error_keys(stale_ok=False):
+    """Returns the set of all unexpired error keys, from error_registry."""
+    return set(_reader(stale_ok).zrangebyscore(
+        "error_registry", time.time() - KEY_EXPIRY_SECONDS, "+inf"))
+
+
+def get_error_keys_by_version(version, stale_ok=False):
     """Gets the list of all errors seen on a single GAE version."""
-    return r.zrevrange("ver:%s:errors" % version, 0, 1000, withscores=False)
+    return _reader(stale_ok).zrevrange("ver:%s:errors" % version, 0, 1000,
+                                       withscores=False)
+
+
+def _log_hours_between(start, end):
+    """The log hours from 'start' up to but not including 'end'."""
+    hour = datetime.datetime.strptime(start, "%Y%m%d_%H")
+    end = datetime.datetime.strptime(end, "%Y%m%d_%H")
+    log_hours = []
+    while hour < end:
+        log_hours.append(hour.strftime("%Y%m%d_%H"))
+        hour += datetime.timedelta(hours=1)
+    return log_hours
+
+
+def recent_log_hour_bounds():
+    """The log hours we may have data for, as a (start, end) pair.
+
+    That is from KEY_EXPIRY_SECONDS ago up to but not including the next
+    hour, which allows for a little clock skew.
+    """
+    now = time.time()
+    return (time.strftime("%Y%m%d_%H", time.gmtime(now - KEY_EXPIRY_SECONDS)),
+            time.strftime("%Y%m%d_%H", time.gmtime(now + 3600)))
 
 
-def get_error_summary_info(error_key):
+# How long get_top_errors keeps the counts for a range of log hours around,
+# so that fetching the next page of them is cheap and consistent.
+TOP_ERRORS_CACHE_SECONDS = 60
+
+
+def get_top_errors(start=None, end=None, limit=None, offset=0, version=None,
+                   stale_ok=False):
+    """Find the errors seen most often in the logs between two log hours.
+
+    'start' and 'end' are log hours ('YYYYMMDD_HH'); we count occurrences from
+    'start' up to but not including 'end'.  If they are omitted we count
+    everything we have (the last KEY_EXPIRY_SECONDS, more or less).  Only
+    errors from the logs count, not those seen while monitoring, unless
+    'version' is given with no range: then we count everything seen on that
+    version, which for a "MON_" version is what we saw while monitoring.
+
+    Returns a list of up to 'limit' (or all) (error key, count) pairs, most
+    frequent first, skipping the first 'offset'.  When counting a range, we
+    keep the counts around for TOP_ERRORS_CACHE_SECONDS, so pages fetched
+    within that time of each other are consistent, unless we have recorded
+    logs since (see get_data_generation): then we count them again, so that
+    the counts are never older than the summaries they come with.
+
+    'stale_ok' is as for configure_redis, except that counting a range
+    always uses the primary, since we have to write the counts somewhere.
+    """
+    stop = -1 if limit is None else offset + limit - 1
+    prefix = "" if version is None else "ver:%s:" % version
+    if start is None and end is None and version is not None:
+        return [(k, int(count)) for k, count in _reader(stale_ok).zrevrange(
+            prefix + "errors", offset, stop, withscores=True)]
+
+    earliest, latest = recent_log_hour_bounds()
+    log_hours = _log_hours_between(start or earliest, end or latest)
+    if not log_hours:
+        return []
+
+    generation, = get_data_generation(["logs"])
+    union_key = "tmp:%stop_errors:%s:%s:%d" % (prefix, log_hours[0],
+                                               log_hours[-1], generation)
+    pipeline = r.pipeline(transaction=False)
+    pipeline.exists(union_key)
+    pipeline.zrevrange(union_key, offset, stop, withscores=True)
+    exists, top_errors = pipeline.execute()
+    if not exists:
+        pipeline = r.pipeline(transaction=True)
+        pipeline.zunionstore(union_key, ["%slog_hour:%s:errors"
+                                         % (prefix, log_hour)
+                                         for log_hour in log_hours])
+        pipeline.expire(union_key, TOP_ERRORS_CACHE_SECONDS)
+        pipeline.zrevrange(union_key, offset, stop, withscores=True)
+        _, __, top_errors = pipeline.execute()
+    return [(k, int(count)) for k, count in top_errors]
+
+
+def get_error_summary_info(error_key, stale_ok=False):
     """Retrieve error summary information from Redis.
 
     The format of the summary information is:
@@ -481,20 +1510,146 @@ def get_error_summary_info(error_key):
             "hour" that we observed the error on, and the occurrence "count"
             (not including errors observed while monitoring)
 
+    'stale_ok' is as for configure_redis.
     """
-    error_def = _get_cached_error_def(error_key)
-    if not error_def:
-        return None
+    return get_error_summaries([error_key], stale_ok=stale_ok)[0]
+
+
+# How many errors get_error_summaries fetches the data for at once.
+SUMMARY_CHUNK_SIZE = 500
+
+
+def get_error_summaries(error_keys, start=None, end=None, stale_ok=False):
+    """Retrieve summary information for many errors at once.
 
-    versions = r.zrevrange("%s:versions" % error_key, 0, -1, withscores=True)
+    Returns a list of summaries, in the format described in
+    get_error_summary_info, in the same order as 'error_keys'.  Errors that
+    don't exist (any more) get None.
 
-    by_hour_and_version = []
-    total_count = 0
-    for version, version_count in versions:
-        hours_seen = r.hgetall("ver:%s:error:%s:hours_seen" % (
-            version, error_key))
-        if hours_seen:
-            for hour, count in hours_seen.iteritems():
+    If 'start' and/or 'end' log hours are given, "by_hour_and_version" and
+    "count" only include occurrences from 'start' up to but not including
+    'end'.  The other fields are the same either way.  'stale_ok' is as for
+    configure_redis.
+
+    We fetch the data for SUMMARY_CHUNK_SIZE errors at a time, in two round
+    trips per chunk.
+    """
+    return list(iter_error_summaries(error_keys, start, end, stale_ok))
+
+
+def iter_error_summaries(error_keys, start=None, end=None, stale_ok=False):
+    """Like get_error_summaries, but yields the summaries as we fetch them.
+
+    So we only hold SUMMARY_CHUNK_SIZE of them in memory at once.
+    """
+    error_keys = list(error_keys)
+    for i in xrange(0, len(error_keys), SUMMARY_CHUNK_SIZE):
+        for summary in _get_error_summaries_chunk(
+                error_keys[i:i + SUMMARY_CHUNK_SIZE], start, end, stale_ok):
+            yield summary
+
+
+def _get_error_summaries_chunk(error_keys, start, end, stale_ok):
+    """The implementation of get_error_summaries, for one chunk of errors."""
+    error_defs = [_error_def_cache.get(error_key) for error_key in error_keys]
+    uncached_keys = [error_key for error_key, error_def
+                     in zip(error_keys, error_defs) if error_def is None]
+
+    # First fetch the error defs we don't have, and everything else we can
+    # get knowing only the error key.
+    expiry_log_hour_int = _get_log_hour_int_expiry()
+    generation = _invalidation_generation
+    reader = _reader(stale_ok)
+    pipeline = reader.pipeline(transaction=False)
+    if uncached_keys:
+        pipeline.mget(["error:%s" % error_key for error_key in uncached_keys])
+        for error_key in uncached_keys:
+            pipeline.ttl("error:%s" % error_key)
+    for error_key in error_keys:
+        pipeline.zrevrange("%s:versions" % error_key, 0, -1, withscores=True)
+        # The first unexpired element of the sorted set is the first hour we
+        # saw it.  (maintenance.py removes the expired ones.)
+        pipeline.zrangebyscore("first_seen:%s" % error_key,
+                               "(%d" % expiry_log_hour_int, "+inf",
+                               start=0, num=1)
+        pipeline.get("last_seen:%s" % error_key)
+        pipeline.hgetall("%s:log_hours" % error_key)
+    results = pipeline.execute(raise_on_error=False)
+
+    if uncached_keys:
+        uncached_defs = dict(zip(uncached_keys, results[0]))
+        ttls = dict(zip(uncached_keys, results[1:len(uncached_keys) + 1]))
+        results = results[len(uncached_keys) + 1:]
+        for i, error_key in enumerate(error_keys):
+            if error_defs[i] is None and uncached_defs[error_key]:
+                # A replica may be behind the invalidations we've had, so
+                # we don't cache what we read from it.
+                error_defs[i] = _cache_error_def(
+                    error_key, json.loads(uncached_defs[error_key]),
+                    ttls[error_key], cache=reader is r,
+                    generation=generation)
+
+    all_versions = results[::4]
+    all_first_seen = results[1::4]
+    all_last_seen = results[2::4]
+    all_log_hours = results[3::4]
+    for result in all_versions + all_last_seen + all_log_hours:
+        if isinstance(result, Exception):
+            raise result
+
+    # The hours seen for each version come from the error's rollup.  Errors
+    # recorded before we kept it have none until rebuild_error_rollups runs,
+    # so for those we read the hours seen for each version.  (Monitoring
+    # doesn't record hours, so there's nothing to read for "MON_" versions.)
+    pipeline = reader.pipeline(transaction=False)
+    fallback_keys = []
+    for error_key, error_def, versions, log_hours in zip(
+            error_keys, error_defs, all_versions, all_log_hours):
+        if error_def and not log_hours and any(
+                not version.startswith("MON_") for version, _ in versions):
+            fallback_keys.append(error_key)
+            for version, _ in versions:
+                pipeline.hgetall(
+                    "ver:%s:error:%s:hours_seen" % (version, error_key))
+    all_hours_seen = iter(pipeline.execute() if fallback_keys else [])
+    fallback_keys = set(fallback_keys)
+
+    summaries = []
+    for error_key, error_def, versions, first_seen, last_seen, log_hours in (
+            zip(error_keys, error_defs, all_versions, all_first_seen,
+                all_last_seen, all_log_hours)):
+        if not error_def:
+            summaries.append(None)
+            continue
+
+        # Versions whose data has expired are left in :versions until
+        # maintenance.py removes them; they just have no hours seen.
+        if error_key in fallback_keys:
+            hours_by_version = dict(
+                (version, next(all_hours_seen)) for version, _ in versions)
+        else:
+            hours_by_version = collections.defaultdict(dict)
+            for field, count in log_hours.iteritems():
+                hour, version = field.split(":", 1)
+                hours_by_version[version][hour] = count
+
+        if isinstance(first_seen, redis.exceptions.ResponseError):
+            # This is an old first_seen key from before it was a sorted set;
+            # maintenance.py deletes these.
+            first_seen = None
+        elif first_seen:
+            first_seen = first_seen[0]
+        else:
+            first_seen = None
+
+        by_hour_and_version = []
+        total_count = 0
+        for version, _ in versions:
+            for hour, count in hours_by_version.get(version, {}).iteritems():
+                # Luckily we can compare YYYYMMDD_HH entries lexicographically!
+                if ((start is not None and hour < start) or
+                        (end is not None and hour >= end)):
+                    continue
                 by_hour_and_version.append({
                     "hour": hour,
                     "version": version,
@@ -502,43 +1657,27 @@ def get_error_summary_info(error_key):
                 })
 
                 total_count += int(count)
-        else:
-            # The ver:<version_id> keys are properly expired, but we do not
-            # have a redis way of expiring the members of the :versions sorted
-            # set, so we do it manually here by removing the :versions keys
-            # that which do not have a corresponding ver:<version_id> key.
-            r.zrem("%s:versions" % error_key, version)
-
-    # TODO(mattfaus): Remove after 5/5/2015 when all keys are migrated
-    if r.type("first_seen:%s" % error_key) != "zset":
-        r.delete("first_seen:%s" % error_key)
-
-    # Pop the first element off the list
-    first_seen = r.zrange("first_seen:%s" % error_key, start=0, end=0)
-    if first_seen:
-        first_seen = first_seen[0]
-    else:
-        first_seen = None
-
-    error_info = {
-        "error_def": error_def,
-        "versions": dict(versions),
-        "first_seen": first_seen,
-        "last_seen": r.get("last_seen:%s" % error_key) or None,
-        "by_hour_and_version": by_hour_and_version,
-        "count": total_count
-    }
 
-    return error_info
+        summaries.append({
+            "error_def": error_def,
+            "versions": dict(versions),
+            "first_seen": first_seen,
+            "last_seen": last_seen or None,
+            "by_hour_and_version": by_hour_and_version,
+            "count": total_count
+        })
+
+    return summaries
 
 
-def get_error_extended_information(version, error_key):
+def get_error_extended_information(version, error_key, stale_ok=False):
     """Return routes & stack traces for this error with their hitcounts.
 
     The data returned pertains only to the GAE version specified.
 
     This is fairly expensive in terms of Redis calls but we assume that only
-    one error is being viewed at a time.
+    one error is being viewed at a time.  'stale_ok' is as for
+    configure_redis.
 
     The return format is a list of routes, as all the other information is
     aggregated by route. Each route looks like:
@@ -564,12 +1703,13 @@ def get_error_extended_information(version, error_key):
             ]
         }
     """
+    reader = _reader(stale_ok)
     ret = []
     key_prefix = "ver:%s:error:%s" % (version, error_key)
-    routes = r.zrevrange("%s:routes" % key_prefix, 0, -1, withscores=True)
+    routes = reader.zrevrange("%s:routes" % key_prefix, 0, -1, withscores=True)
     for route, count in routes:
         # Get stack trace information for the route
-        stack_counts = r.zrevrange(
+        stack_counts = reader.zrevrange(
             "%s:stacks:%s:counts" % (key_prefix, route),
             0, -1, withscores=True)
         stacks = []
@@ -579,13 +1719,13 @@ def get_error_extended_information(version, error_key):
             stacks.append({
                 "count": stack_count,
                 "stack": json.loads(
-                    r.hget("%s:stacks:msgs" % key_prefix, stack_key))
+                    reader.hget("%s:stacks:msgs" % key_prefix, stack_key))
             })
 
         ret.append({
             "route": route,
             "count": count,
-            "urls": r.zrevrange(
+            "urls": reader.zrevrange(
                 "%s:uris:%s" % (key_prefix, route), 0, -1, withscores=True),
             "stacks": stacks
         })
@@ -598,7 +1738,7 @@ def get_error_extended_information(version, error_key):
 ####
 
 def _update_error_details(version, status, level, resource, ip, route,
-                          module, message):
+                          module, message, pipe=None):
     """Store a new error instance which was seen while monitoring a deploy.
 
     All the Redis keys for the data is prefixed with the version so they
@@ -625,6 +1765,11 @@ def _update_error_details(version, status, level, resource, ip, route,
 
     'message' is the recorded error message, including the stack in the case
     of an exception (in which case it contains multiple lines).
+
+    'pipe' is an optional writer returned by _get_writer() that callers can
+    pass in to add writes of their own to the same round trip, in which case
+    they are responsible for executing it with _execute_writes.  Otherwise
+    all the writes for this occurrence are sent together before we return.
     """
     if any(resource.startswith(uri) for uri in URI_BLACKLIST):
         # Ignore particularly spammy URIs
@@ -637,56 +1782,105 @@ def _update_error_details(version, status, level, resource, ip, route,
     # Look up the identifying information to see if we already have an
     # error that matches, in which case we use that error's key. If not,
     # write the new error to Redis.
-    error_key = _create_or_update_error(error_def, KEY_EXPIRY_SECONDS)
+    if pipe is None:
+        writer = _get_writer()
+    else:
+        writer = pipe
 
-    # All the occurrence-statistic Redis keys share a common prefix to keep
-    # them separate from other error classes and versions
-    key_prefix = "ver:%s:error:%s" % (version, error_key)
+    error_key = _create_or_update_error(error_def, KEY_EXPIRY_SECONDS,
+                                        pipe=writer)
 
     # webapp appends a cache-busting query param e.g. _=131231 for API calls
     # made from the JS code. We want to ignore them because a different cache
     # busting param doesn't indicate anything semantic about the API call
     resource = _CACHE_BUST_QUERY_PARAM_RE.sub('', resource)
 
+    increments = collections.Counter()
+    stacks = {}
+    _add_error_details(increments, stacks, version, error_key, ip, route,
+                       resource, module, stack, stack_key)
+    _queue_error_details(writer, increments, stacks,
+                         use_script=WRITE_MODE == WRITE_MODE_LUA)
+
+    if pipe is None:
+        _execute_writes(writer)
+
+    return error_key
+
+
+def _add_error_details(increments, stacks, version, error_key, ip, route,
+                       resource, module, stack, stack_key):
+    """Add the counters for one occurrence of an error to those given.
+
+    'increments' is a Counter of how much to add to each (sorted set key,
+    member), and 'stacks' a dict of the stack to store for each (hash key,
+    stack key); see _queue_error_details.  The other arguments are as for
+    _update_error_details, with the resource's cache-busting parameter
+    already stripped, and the error's key and parsed stack.
+    """
+    # All the occurrence-statistic Redis keys share a common prefix to keep
+    # them separate from other error classes and versions
+    key_prefix = "ver:%s:error:%s" % (version, error_key)
+
     # Record how many unique IPs have hit this endpoint, and also how many
     # times each of them hit the error.
-    r.zincrby("%s:ips" % key_prefix, ip)
-    r.expire("%s:ips" % key_prefix, KEY_EXPIRY_SECONDS)
+    increments["%s:ips" % key_prefix, ip] += 1
 
     # Record all the unique stack traces we get, and count how many times each
     # of them is hit. The stack IDs are stored by route so we can show them
     # grouped that way in the UI.
-    r.hset("%s:stacks:msgs" % key_prefix, stack_key, json.dumps(stack))
-    r.expire("%s:stacks:msgs" % key_prefix, KEY_EXPIRY_SECONDS)
-    r.zincrby("%s:stacks:%s:counts" % (key_prefix, route), stack_key)
-    r.expire("%s:stacks:%s:counts" % (key_prefix, route), KEY_EXPIRY_SECONDS)
+    stacks["%s:stacks:msgs" % key_prefix, stack_key] = stack
+    increments["%s:stacks:%s:counts" % (key_prefix, route), stack_key] += 1
 
     # Record all of the routes causing this error, and also how many times
     # each of them is being hit.
-    r.zincrby("%s:routes" % key_prefix, route)
-    r.expire("%s:routes" % key_prefix, KEY_EXPIRY_SECONDS)
+    increments["%s:routes" % key_prefix, route] += 1
 
     # Record hits for a specific URL. We classify URLs hierarchically under
     # routes.
-    r.zincrby("%s:uris:%s" % (key_prefix, route), resource)
-    r.expire("%s:uris:%s" % (key_prefix, route), KEY_EXPIRY_SECONDS)
+    increments["%s:uris:%s" % (key_prefix, route), resource] += 1
 
     # Record a hit for a specific module id
-    r.zincrby("%s:modules" % key_prefix, module)
-    r.expire("%s:modules" % key_prefix, KEY_EXPIRY_SECONDS)
+    increments["%s:modules" % key_prefix, module] += 1
 
     # Track how many times each error has been seen by version overall
-    # and by the time elapsed since we started monitoring
-    r.zincrby("ver:%s:errors" % version, error_key)
-    r.expire("ver:%s:errors" % version, KEY_EXPIRY_SECONDS)
+    increments["ver:%s:errors" % version, error_key] += 1
 
     # Record a hit for the version
-    # NOTE: The keys of this sorted set are manually expired out within
-    # get_error_summary_info()
-    r.zincrby("%s:versions" % error_key, version)
-    r.expire("%s:versions" % error_key, KEY_EXPIRY_SECONDS)
+    # NOTE: The keys of this sorted set are manually expired out by
+    # prune_error_versions()
+    increments["%s:versions" % error_key, version] += 1
 
-    return error_key
+
+def _queue_error_details(writer, increments, stacks, use_script):
+    """Queue the writes for counters gathered by _add_error_details.
+
+    Every key written gets an expiry of KEY_EXPIRY_SECONDS.  If 'use_script'
+    is set, 'writer' must be a _ScriptWriter, and the writes are applied
+    atomically by _ERROR_DETAILS_SCRIPT; otherwise they are queued as
+    separate commands.
+    """
+    if use_script:
+        keys = []
+        args = [KEY_EXPIRY_SECONDS, len(increments)]
+        for (redis_key, member), count in increments.iteritems():
+            keys.append(redis_key)
+            args.extend([member, count])
+        for (redis_key, stack_key), stack in stacks.iteritems():
+            keys.append(redis_key)
+            args.extend([stack_key, json.dumps(stack)])
+        writer.run_script(_ERROR_DETAILS_SCRIPT, keys, args)
+        return
+
+    expiries = collections.OrderedDict()
+    for (redis_key, member), count in increments.iteritems():
+        writer.zincrby(redis_key, member, count)
+        expiries[redis_key] = True
+    for (redis_key, stack_key), stack in stacks.iteritems():
+        writer.hset(redis_key, stack_key, json.dumps(stack))
+        expiries[redis_key] = True
+    for redis_key in expiries:
+        writer.expire(redis_key, KEY_EXPIRY_SECONDS)
 
 
 ####
@@ -733,8 +1927,16 @@ def record_monitoring_data_received(version, minute):
     We use these "seen" flags to determine whether we have data for this
     version to compare future versions against.
     """
-    r.hset("ver:MON_%s:seen" % version, minute, 1)
-    r.expire("ver:MON_%s:seen" % version, KEY_EXPIRY_SECONDS)
+    pipeline = r.pipeline(transaction=False)
+    _queue_monitoring_data_received(pipeline, version, minute)
+    pipeline.execute()
+
+
+def _queue_monitoring_data_received(writer, version, minute):
+    writer.hset("ver:MON_%s:seen" % version, minute, 1)
+    writer.expire("ver:MON_%s:seen" % version, KEY_EXPIRY_SECONDS)
+    writer.hincrby("data_generations", "monitoring", 1)
+    writer.hincrby("data_generations", "MON_%s" % version, 1)
 
 
 def check_monitoring_data_received(version, minute):
@@ -742,6 +1944,34 @@ def check_monitoring_data_received(version, minute):
     return r.hget("ver:MON_%s:seen" % version, minute) is not None
 
 
+# If a process dies with monitoring data queued, we stop waiting for it after
+# this long.
+MONITORING_PENDING_EXPIRY_SECONDS = 10 * 60
+
+
+def record_monitoring_writes_pending(version, minute, num_snapshots):
+    """Track that we've queued snapshots of monitoring data to record.
+
+    'num_snapshots' is negative once we've recorded them.
+    """
+    pipeline = r.pipeline(transaction=False)
+    _queue_monitoring_writes_pending(pipeline, version, minute, num_snapshots)
+    pipeline.execute()
+
+
+def _queue_monitoring_writes_pending(writer, version, minute, num_snapshots):
+    key = "ver:MON_%s:pending:%s" % (version, minute)
+    writer.incrby(key, num_snapshots)
+    writer.expire(key, MONITORING_PENDING_EXPIRY_SECONDS)
+
+
+def count_monitoring_writes_pending(versions, minute):
+    """How many snapshots for this minute of 'versions' we've yet to record."""
+    pending = r.mget(["ver:MON_%s:pending:%s" % (version, minute)
+                      for version in versions])
+    return sum(max(0, int(num_snapshots or 0)) for num_snapshots in pending)
+
+
 def record_occurrence_during_monitoring(version, minute, status, level,
                                         resource, ip, route, module, message):
     """Store error details for an occurrence seen while monitoring GAE logs.
@@ -753,49 +1983,364 @@ def record_occurrence_during_monitoring(version, minute, status, level,
     started that we are fetching errors for, so 0 is the first 60 seconds after
     monitoring, 1 is the next 60 seconds, etc.
     """
+    # The counters below go out in the same round trip as the rest of the
+    # occurrence's writes.
+    writer = _get_writer()
     error_key = _update_error_details(
         "MON_%s" % version, status, level, resource, ip, route, module,
-        message)
+        message, pipe=writer)
 
     if error_key:
-        r.zincrby("ver:MON_%s:errors_by_minute:%d" % (version, minute),
-                  error_key)
-        r.expire("ver:MON_%s:errors_by_minute:%d" % (version, minute),
-                 KEY_EXPIRY_SECONDS)
+        writer.zincrby("ver:MON_%s:errors_by_minute:%d" % (version, minute),
+                       error_key)
+        writer.expire("ver:MON_%s:errors_by_minute:%d" % (version, minute),
+                      KEY_EXPIRY_SECONDS)
 
         fast_key_expiry_seconds = 60 * 60  # expire in one hour
+        if WRITE_MODE == WRITE_MODE_LUA:
+            # The script also bumps the number of unique errors if need be.
+            writer.run_script(
+                _MONITORING_IP_SCRIPT,
+                ["ver:MON_%s:ip_%s:errors_by_minute:%d"
+                 % (version, ip, minute),
+                 "ver:MON_%s:unique_errors_by_minute:%d" % (version, minute)],
+                [error_key, 1, KEY_EXPIRY_SECONDS, fast_key_expiry_seconds])
+            _execute_writes(writer)
+            return
+
         # errors from the last minute from a single ip
-        r.zincrby("ver:MON_%s:ip_%s:errors_by_minute:%d"
-                  % (version, ip, minute), error_key)
-        r.expire("ver:MON_%s:ip_%s:errors_by_minute:%d"
-                 % (version, ip, minute), fast_key_expiry_seconds)
+        writer.zincrby("ver:MON_%s:ip_%s:errors_by_minute:%d"
+                       % (version, ip, minute), error_key)
+        writer.expire("ver:MON_%s:ip_%s:errors_by_minute:%d"
+                      % (version, ip, minute), fast_key_expiry_seconds)
 
-        num_ip_errors = r.zscore("ver:MON_%s:ip_%s:errors_by_minute:%d"
-                                 % (version, ip, minute), error_key)
+        # ZINCRBY returns the new score, which saves us reading it back.
+        num_ip_errors = _execute_writes(writer)[-2]
         if num_ip_errors == 1:
             # if first time seeing error from this ip, increment
             # number of unique errors
-            r.zincrby("ver:MON_%s:unique_errors_by_minute:%d"
-                      % (version, minute), error_key)
-            r.expire("ver:MON_%s:unique_errors_by_minute:%d"
-                     % (version, minute), KEY_EXPIRY_SECONDS)
+            writer.zincrby("ver:MON_%s:unique_errors_by_minute:%d"
+                           % (version, minute), error_key)
+            writer.expire("ver:MON_%s:unique_errors_by_minute:%d"
+                          % (version, minute), KEY_EXPIRY_SECONDS)
+            writer.execute()
+
+
+# The fields every log record posted to /monitor must have.
+MONITORING_LOG_FIELDS = ("status", "level", "resource", "ip", "route",
+                         "module_id", "message")
+
+
+def record_occurrences_during_monitoring_batch(version, minute, logs,
+                                               processed_key=None):
+    """Store error details for a batch of occurrences seen while monitoring.
+
+    This has the same effect as calling `record_occurrence_during_monitoring`
+    for each log in turn, but each message is parsed once and the occurrence
+    counters are summed up in memory before being sent to Redis, so the
+    number of writes depends on how many distinct errors the batch contains
+    rather than on how many log lines it has.
+
+    'version' and 'minute' are documented in
+    `record_occurrence_during_monitoring`.
+
+    'logs' is a list of log records as posted to /monitor, each a dict with
+    the MONITORING_LOG_FIELDS, 'status', 'level', 'resource', 'ip', 'route',
+    'module_id' and 'message' (documented in `_update_error_details`).
+
+    If 'processed_key' is given, we record the batch only if that key
+    doesn't exist, and set it in the same transaction as the counters,
+    along with marking the minute as received and the batch as no longer
+    pending (see record_monitoring_data_received and
+    record_monitoring_writes_pending).  So however many times we're called
+    with the same batch and key, even at once, it is counted once.  The
+    error defs aren't counters, so writing them again does no harm.  This
+    always uses a transaction, whatever WRITE_MODE is, and needs Redis to
+    run Lua scripts, to count unique errors within it.
+
+    Returns whether we recorded the batch, which is only False if
+    'processed_key' existed.
+    """
+    mon_version = "MON_%s" % version
+    if processed_key is not None and r.exists(processed_key):
+        return False
+
+    # Parse every message, keeping the most recent error def for each
+    # distinct def key in the order the keys were first seen.
+    occurrences = []
+    error_defs = collections.OrderedDict()
+    last_def_key_seen = []
+    for log in logs:
+        resource = log['resource']
+        if any(resource.startswith(uri) for uri in URI_BLACKLIST):
+            # Ignore particularly spammy URIs
+            continue
+
+        error_def, stack, stack_key = _parse_message(
+            log['message'], str(log['status']), str(log['level']))
+        error_defs[error_def['key']] = error_def
+        last_def_key_seen.append(error_def['key'])
+        occurrences.append((error_def['key'], log['ip'], log['route'],
+                            _CACHE_BUST_QUERY_PARAM_RE.sub('', resource),
+                            log['module_id'], stack, stack_key))
+
+    # Look up or create each distinct error.  Doing this in the order the
+    # defs were first seen groups them the same way as recording the logs
+    # one at a time would.
+    error_keys = {}
+    def_written = {}
+    for def_key, error_def in error_defs.iteritems():
+        error_key = _create_or_update_error(error_def, KEY_EXPIRY_SECONDS)
+        error_keys[def_key] = error_key
+        def_written[error_key] = def_key
+
+    # Several defs can map to the same error, in which case the error should
+    # end up with the title, status and level of the most recent of them.
+    last_def_key_for_error = {}
+    for def_key in last_def_key_seen:
+        last_def_key_for_error[error_keys[def_key]] = def_key
+    for error_key, def_key in last_def_key_for_error.iteritems():
+        if def_written[error_key] != def_key:
+            _create_or_update_error(error_defs[def_key], KEY_EXPIRY_SECONDS)
+
+    # Sum up the occurrence counters by Redis key and member.
+    increments = collections.Counter()
+    stacks = {}
+    ip_increments = collections.Counter()
+    for (def_key, ip, route, resource, module, stack,
+            stack_key) in occurrences:
+        error_key = error_keys[def_key]
+        _add_error_details(increments, stacks, mon_version, error_key, ip,
+                           route, resource, module, stack, stack_key)
+        increments["ver:MON_%s:errors_by_minute:%d" % (version, minute),
+                   error_key] += 1
+        ip_increments["ver:MON_%s:ip_%s:errors_by_minute:%d"
+                      % (version, ip, minute), error_key] += 1
+
+    # Send all the counters in one round trip.  The per-IP counts go first
+    # so we can find their results (the new scores) below.
+    fast_key_expiry_seconds = 60 * 60  # expire in one hour
+    unique_key = ("ver:MON_%s:unique_errors_by_minute:%d"
+                  % (version, minute))
+    ip_increments = ip_increments.items()
+    if processed_key is None:
+        writer = _get_writer()
+        use_lua = WRITE_MODE == WRITE_MODE_LUA
+    else:
+        writer = r.pipeline(transaction=True)
+        writer.watch(processed_key)
+        if writer.exists(processed_key):
+            writer.reset()
+            return False
+        writer.multi()
+        use_lua = False
+    for (redis_key, error_key), count in ip_increments:
+        if processed_key is not None:
+            # We can't see the per-IP counts until the transaction is done,
+            # so the script has to bump the unique errors inside it; EVAL
+            # rather than EVALSHA since we can't retry it if Redis doesn't
+            # have the script.
+            writer.eval(_MONITORING_IP_SCRIPT.source, 2, redis_key,
+                        unique_key, error_key, count, KEY_EXPIRY_SECONDS,
+                        fast_key_expiry_seconds)
+        elif use_lua:
+            # The script also bumps the number of unique errors if need be.
+            writer.run_script(
+                _MONITORING_IP_SCRIPT, [redis_key, unique_key],
+                [error_key, count, KEY_EXPIRY_SECONDS,
+                 fast_key_expiry_seconds])
+        else:
+            writer.zincrby(redis_key, error_key, count)
+            writer.expire(redis_key, fast_key_expiry_seconds)
+    _queue_error_details(writer, increments, stacks, use_script=use_lua)
+    if processed_key is not None:
+        _queue_monitoring_data_received(writer, version, minute)
+        _queue_monitoring_writes_pending(writer, version, minute, -1)
+        writer.set(processed_key, 1,
+                   ex=MONITOR_STREAM_PROCESSED_EXPIRY_SECONDS)
+        try:
+            writer.execute()
+        except redis.exceptions.WatchError:
+            # Someone else recorded it while we were at it.
+            return False
+        return True
+
+    results = writer.execute()
+    if use_lua:
+        return True
+
+    # If this batch contains the first time we've seen an error from an IP,
+    # increment the number of unique errors.
+    unique_increments = collections.Counter()
+    for ((_, error_key), count), new_count in zip(ip_increments,
+                                                  results[::2]):
+        if new_count == count:
+            unique_increments[error_key] += 1
+
+    if unique_increments:
+        for error_key, count in unique_increments.iteritems():
+            writer.zincrby(unique_key, error_key, count)
+        writer.expire(unique_key, KEY_EXPIRY_SECONDS)
+        writer.execute()
+
+    return True
+
+
+####
+# Recording monitoring data through a Redis stream (see monitor_worker.py)
+####
+
+MONITOR_STREAM = "monitor:stream"
+MONITOR_STREAM_GROUP = "monitor-workers"
+# How long we remember that we've recorded a snapshot from the stream.  This
+# must be longer than a snapshot could be waiting to be claimed from a
+# consumer that died.
+MONITOR_STREAM_PROCESSED_EXPIRY_SECONDS = 24 * 60 * 60
+# How many times a snapshot may fail to be recorded before we give up on it
+# and move it to MONITOR_DEAD_LETTER_STREAM, which keeps about the last
+# MONITOR_DEAD_LETTER_MAX_LENGTH of them for someone to look at.
+MONITOR_STREAM_MAX_DELIVERIES = 5
+MONITOR_DEAD_LETTER_STREAM = "monitor:stream:dead"
+MONITOR_DEAD_LETTER_MAX_LENGTH = 1000
+
+
+def add_monitoring_snapshot_to_stream(version, minute, logs, max_length):
+    """Add a snapshot of monitoring data to MONITOR_STREAM to be recorded.
+
+    The arguments are as for record_occurrences_during_monitoring_batch.
+    The snapshot counts as pending until a worker has recorded it.
+
+    Returns the ID of the new stream entry, or None if the stream already
+    has 'max_length' entries or more waiting.
+    """
+    if int(r.execute_command("XLEN", MONITOR_STREAM)) >= max_length:
+        return None
+    pipeline = r.pipeline(transaction=False)
+    _queue_monitoring_writes_pending(pipeline, version, minute, 1)
+    pipeline.execute_command("XADD", MONITOR_STREAM, "*",
+                             "version", version, "minute", minute,
+                             "logs", json.dumps(logs))
+    return pipeline.execute()[-1]
+
+
+def create_monitoring_stream_group():
+    """Create MONITOR_STREAM and its consumer group, unless they exist."""
+    try:
+        # Starting from "0" means nothing added before the group is lost.
+        r.execute_command("XGROUP", "CREATE", MONITOR_STREAM,
+                          MONITOR_STREAM_GROUP, "0", "MKSTREAM")
+    except redis.exceptions.ResponseError as e:
+        if "BUSYGROUP" not in str(e):
+            raise
+
+
+def _record_monitoring_stream_entry(entry_id, fields):
+    fields = dict(zip(fields[::2], fields[1::2]))
+    return record_occurrences_during_monitoring_batch(
+        fields["version"], int(fields["minute"]), json.loads(fields["logs"]),
+        processed_key="%s:processed:%s" % (MONITOR_STREAM, entry_id))
+
+
+def _give_up_on_monitoring_stream_entry(entry_id, fields):
+    """Move a snapshot we can't record to MONITOR_DEAD_LETTER_STREAM.
+
+    It no longer counts as pending, so monitor_results doesn't wait for it.
+    """
+    logging.error("Giving up on recording monitoring data %s after %d tries"
+                  % (entry_id, MONITOR_STREAM_MAX_DELIVERIES))
+    fields_dict = dict(zip(fields[::2], fields[1::2]))
+    pipeline = r.pipeline(transaction=True)
+    pipeline.execute_command(
+        "XADD", MONITOR_DEAD_LETTER_STREAM, "MAXLEN", "~",
+        MONITOR_DEAD_LETTER_MAX_LENGTH, "*", "entry_id", entry_id, *fields)
+    try:
+        _queue_monitoring_writes_pending(
+            pipeline, fields_dict["version"], int(fields_dict["minute"]), -1)
+    except (KeyError, ValueError):
+        # Too broken to say what it was for.
+        pass
+    pipeline.execute_command("XACK", MONITOR_STREAM, MONITOR_STREAM_GROUP,
+                             entry_id)
+    pipeline.execute_command("XDEL", MONITOR_STREAM, entry_id)
+    pipeline.execute()
+
+
+def _monitoring_stream_deliveries(entry_id):
+    """How many times the pending snapshot 'entry_id' has been handed out."""
+    pending = r.execute_command("XPENDING", MONITOR_STREAM,
+                                MONITOR_STREAM_GROUP, entry_id, entry_id, 1)
+    # Each is [entry ID, consumer, milliseconds idle, times delivered].
+    return int(pending[0][3]) if pending else 0
+
+
+def process_monitoring_stream(consumer, count=10, block_seconds=5,
+                              claim_idle_seconds=60):
+    """Record the next few snapshots from MONITOR_STREAM as 'consumer'.
+
+    First we claim up to 'count' snapshots that other consumers have held
+    for over 'claim_idle_seconds' without acknowledging them, presumably
+    because they died; if there are none, we read up to 'count' new ones,
+    waiting up to 'block_seconds' for some to arrive.  (So the Redis
+    client's socket timeout must be longer than that.)
+
+    Each snapshot is recorded once, however many consumers end up with it:
+    see 'processed_key' in record_occurrences_during_monitoring_batch.  It
+    is acknowledged and deleted from the stream only once it is recorded.
+    If recording one fails, we log it and leave it to be claimed again,
+    unless it has failed MONITOR_STREAM_MAX_DELIVERIES times: then we move it
+    to MONITOR_DEAD_LETTER_STREAM, since it will presumably never work.
+
+    Returns how many snapshots we recorded, not counting any that turned out
+    to be recorded already.
+    """
+    entries = r.execute_command(
+        "XAUTOCLAIM", MONITOR_STREAM, MONITOR_STREAM_GROUP, consumer,
+        int(claim_idle_seconds * 1000), "0-0", "COUNT", count)[1]
+    if not entries:
+        response = r.execute_command(
+            "XREADGROUP", "GROUP", MONITOR_STREAM_GROUP, consumer,
+            "COUNT", count, "BLOCK", int(block_seconds * 1000),
+            "STREAMS", MONITOR_STREAM, ">")
+        entries = response[0][1] if response else []
+
+    num_recorded = 0
+    for entry_id, fields in entries:
+        # The fields are missing if the entry was deleted from the stream
+        # while still pending, in which case all we can do is acknowledge it.
+        try:
+            if fields and _record_monitoring_stream_entry(entry_id, fields):
+                num_recorded += 1
+        except Exception:
+            logging.exception("Failed to record monitoring data %s"
+                              % entry_id)
+            if (_monitoring_stream_deliveries(entry_id) >=
+                    MONITOR_STREAM_MAX_DELIVERIES):
+                _give_up_on_monitoring_stream_entry(entry_id, fields)
+            continue
+        pipeline = r.pipeline(transaction=False)
+        pipeline.execute_command("XACK", MONITOR_STREAM,
+                                 MONITOR_STREAM_GROUP, entry_id)
+        pipeline.execute_command("XDEL", MONITOR_STREAM, entry_id)
+        pipeline.execute()
+    return num_recorded
+
 
 # Anomaly detection methods
 
 
-def get_routes():
+def get_routes(stale_ok=False):
     """Get all routes that have been seen."""
-    return list(r.smembers("seen_routes"))
+    return list(_reader(stale_ok).smembers("seen_routes"))
 
 
-def get_statuses():
+def get_statuses(stale_ok=False):
     """Get all status codes that have been seen."""
-    return list(r.smembers("seen_statuses"))
+    return list(_reader(stale_ok).smembers("seen_statuses"))
 
 
-def get_responses_count(route, status_code, log_hour):
+def get_responses_count(route, status_code, log_hour, stale_ok=False):
     """Get the number of requests for a specific date."""
-    count = r.get("route:%s:status:%s:log_hour:%s:num_seen" %
+    count = _reader(stale_ok).get("route:%s:status:%s:log_hour:%s:num_seen" %
                   (route, status_code, log_hour))
     if count is None:
         count = 0
@@ -805,20 +2350,21 @@ def get_responses_count(route, status_code, log_hour):
     return count
 
 
-def get_hourly_responses_count(route, status_code):
+def get_hourly_responses_count(route, status_code, stale_ok=False):
     """Get a list of hours and a list of counts for a specific request.
 
     The first list consists of all timestamps since we started seeing this
     particular request, the second list consists of the number of times
     we have seen a specific response occur for the corresponding log hour.
-    Both lists are sorted from least recent to most recent.
+    Both lists are sorted from least recent to most recent.  'stale_ok' is
+    as for configure_redis.
     """
-    log_hours = r.zrange("available_logs", 0, -1)
+    log_hours = _reader(stale_ok).zrange("available_logs", 0, -1)
     dates_seen = []
     hourly_responses = []
     seen_instance = False
     for log_hour in log_hours:
-        count = get_responses_count(route, status_code, log_hour)
+        count = get_responses_count(route, status_code, log_hour, stale_ok)
         if not seen_instance and count == 0:
             # Ignore all of the earliest requests with a count of 0.
             continue
@@ -836,7 +2382,10 @@ def get_hourly_responses_count(route, status_code):
 
 def record_log_data_received(log_hour):
     """Track that we've received error data from the GAE logs (via BigQuery)."""
-    r.zadd("available_logs", 1, log_hour)
+    pipeline = r.pipeline(transaction=False)
+    pipeline.zadd("available_logs", 1, log_hour)
+    pipeline.hincrby("data_generations", "logs", 1)
+    pipeline.execute()
 
 
 def check_log_data_received(log_hour):
@@ -864,21 +2413,31 @@ def record_occurrence_from_errors(version, log_hour, status, level, resource,
         # Record a hit for a specific hour on a specific version, to get more
         # granular time stats
 
-        r.hincrby("ver:%s:error:%s:hours_seen" % (version, error_key),
-                  log_hour, 1)
-        r.expire("ver:%s:error:%s:hours_seen" % (version, error_key),
-                 KEY_EXPIRY_SECONDS)
-
-        # Manage the running list of first_seen. If the first first_seen falls
-        # out of the KEY_EXPIRY_SECONDS window, remove it.
+        pipeline = r.pipeline(transaction=False)
+        pipeline.hincrby("ver:%s:error:%s:hours_seen" % (version, error_key),
+                         log_hour, 1)
+        pipeline.expire("ver:%s:error:%s:hours_seen" % (version, error_key),
+                        KEY_EXPIRY_SECONDS)
+
+        # And the same across all versions, for summarizing the error and
+        # finding the top errors.
+        pipeline.hincrby("%s:log_hours" % error_key,
+                         "%s:%s" % (log_hour, version), 1)
+        pipeline.expire("%s:log_hours" % error_key, KEY_EXPIRY_SECONDS)
+        pipeline.zincrby("log_hour:%s:errors" % log_hour, error_key)
+        pipeline.expire("log_hour:%s:errors" % log_hour, KEY_EXPIRY_SECONDS)
+        pipeline.zincrby("ver:%s:log_hour:%s:errors" % (version, log_hour),
+                         error_key)
+        pipeline.expire("ver:%s:log_hour:%s:errors" % (version, log_hour),
+                        KEY_EXPIRY_SECONDS)
+        pipeline.execute()
+
+        # Manage the running list of first_seen.  The entries that fall out
+        # of the KEY_EXPIRY_SECONDS window are removed by maintenance.py, and
+        # ignored by readers until then.
         first_seen = r.zrange("first_seen:%s" % error_key, start=0, end=0)
         if not first_seen:
             is_new = True
-        else:
-            # Remove all of the expired entries
-            expiry_log_hour_int = _get_log_hour_int_expiry()
-            r.zremrangebyscore("first_seen:%s" % error_key,
-                               0, expiry_log_hour_int)
 
         # Always call add, since it will either overwrite or append
         log_hour_int = int(log_hour.replace("_", ""))
@@ -911,3 +2470,456 @@ def record_occurrences_from_requests(log_hour, status, route, num_seen):
     r.sadd("seen_statuses", status)
     r.set("route:%s:status:%s:log_hour:%s:num_seen" %
           (route, status, log_hour), num_seen)
+
+
+####
+# Maintenance (see maintenance.py)
+####
+
+# How long to remember where an unfinished maintenance task got up to.
+MAINTENANCE_CURSOR_EXPIRY_SECONDS = 60 * 60 * 24
+
+
+def _compact_errordef_batch(hash_key, entries):
+    """Remove the entries of an errordef hash whose errors have expired.
+
+    'entries' is a dict of entries from the hash 'hash_key', ID -> error key.
+    Returns the entries we deleted.
+
+    Ingestion may recreate an error, or point an ID at a new error, while we
+    work; we WATCH for that and leave the batch for next time if it happens.
+    """
+    if not entries:
+        return {}
+
+    # Most errors will still be around, so first find candidates cheaply.
+    ids = entries.keys()
+    pipeline = r.pipeline(transaction=False)
+    for id in ids:
+        pipeline.exists("error:%s" % entries[id])
+    stale = {id: entries[id]
+             for id, exists in zip(ids, pipeline.execute()) if not exists}
+    if not stale:
+        return {}
+
+    stale_ids = stale.keys()
+    error_keys = ["error:%s" % stale[id] for id in stale_ids]
+    with r.pipeline() as pipeline:
+        try:
+            pipeline.watch(hash_key, *set(error_keys))
+            current_keys = pipeline.hmget(hash_key, stale_ids)
+            current_defs = pipeline.mget(error_keys)
+            to_delete = {
+                id: stale[id]
+                for id, current_key, current_def
+                in zip(stale_ids, current_keys, current_defs)
+                if current_key == stale[id] and current_def is None}
+            if not to_delete:
+                return {}
+
+            pipeline.multi()
+            pipeline.hdel(hash_key, *to_delete.keys())
+            pipeline.execute()
+        except redis.WatchError:
+            return {}
+
+    return to_delete
+
+
+def _run_resumable_scan(cursor_key, scan, process_batch, max_seconds):
+    """Process everything 'scan' returns in batches, over one or more runs.
+
+    'scan' is called with a cursor and returns the next cursor and a batch,
+    like r.scan or r.hscan; we pass each batch to 'process_batch'.  We start
+    from where the last run stopped, if it didn't finish.  If we've been at it
+    longer than 'max_seconds' (if given) we stop, saving our cursor in
+    'cursor_key' for the next run, and return False.  Otherwise we return True
+    once we've been through everything.
+    """
+    start = time.time()
+    cursor = int(r.get(cursor_key) or 0)
+    while True:
+        cursor, batch = scan(cursor)
+        process_batch(batch)
+
+        if cursor == 0:
+            r.delete(cursor_key)
+            return True
+        if max_seconds is not None and time.time() - start > max_seconds:
+            r.set(cursor_key, cursor, ex=MAINTENANCE_CURSOR_EXPIRY_SECONDS)
+            return False
+
+
+def compact_errordef_ids(batch_size=1000, max_seconds=None):
+    """Remove entries for expired errors from the errordef:<id> hashes.
+
+    These hashes never expire, so without this they grow forever, and
+    _find_error_by_def keeps finding errors that are long gone.  We HSCAN
+    through them 'batch_size' entries at a time.  If we run out of time (after
+    'max_seconds', if given) we remember where we got to, and pick up from
+    there next time.  This is safe to run while errors are being recorded.
+
+    Returns a dict of how many entries we looked at and deleted, roughly how
+    many bytes of data that freed up (not counting Redis's overhead per
+    entry), and whether we got through all the hashes.
+    """
+    start = time.time()
+    stats = {"scanned": 0, "deleted": 0, "bytes_reclaimed": 0,
+             "complete": False}
+
+    for id in _ERROR_ID_KEYS:
+        hash_key = "errordef:%s" % id
+
+        def scan(cursor):
+            return r.hscan(hash_key, cursor=cursor, count=batch_size)
+
+        def process_batch(entries):
+            deleted = _compact_errordef_batch(hash_key, entries)
+            stats["scanned"] += len(entries)
+            stats["deleted"] += len(deleted)
+            stats["bytes_reclaimed"] += sum(
+                len(id_value) + len(error_key)
+                for id_value, error_key in deleted.iteritems())
+
+        if max_seconds is not None:
+            time_left = max_seconds - (time.time() - start)
+        else:
+            time_left = None
+        if not _run_resumable_scan("maintenance:%s:cursor" % hash_key,
+                                   scan, process_batch, time_left):
+            return stats
+
+    stats["complete"] = True
+    return stats
+
+
+def _prune_error_versions_batch(versions_keys):
+    """Prune the versions sorted sets in 'versions_keys'; see below.
+
+    Returns how many versions, first_seen keys and first_seen hours we
+    deleted.
+    """
+    error_keys = [k[:-len(":versions")] for k in versions_keys]
+
+    pipeline = r.pipeline(transaction=False)
+    for error_key in error_keys:
+        pipeline.zrange("%s:versions" % error_key, 0, -1)
+        pipeline.type("first_seen:%s" % error_key)
+    results = pipeline.execute()
+    all_versions = results[::2]
+    first_seen_types = results[1::2]
+
+    # Monitoring doesn't record hours_seen, and BigQuery imports always
+    # record routes, so we check both.
+    pipeline = r.pipeline(transaction=False)
+    for error_key, versions in zip(error_keys, all_versions):
+        for version in versions:
+            pipeline.exists(
+                "ver:%s:error:%s:hours_seen" % (version, error_key))
+            pipeline.exists("ver:%s:error:%s:routes" % (version, error_key))
+    results = pipeline.execute()
+    # Whether there's any data for each version, in order.
+    has_data = iter(hours_seen or routes
+                    for hours_seen, routes in zip(results[::2], results[1::2]))
+
+    expiry_log_hour_int = _get_log_hour_int_expiry()
+    num_versions = num_first_seen = 0
+    pipeline = r.pipeline(transaction=False)
+    # Where the results of our ZREMRANGEBYSCOREs will be.
+    first_seen_hours_results = []
+    for error_key, versions, first_seen_type in zip(
+            error_keys, all_versions, first_seen_types):
+        expired_versions = [version for version in versions
+                            if not next(has_data)]
+        if expired_versions:
+            pipeline.zrem("%s:versions" % error_key, *expired_versions)
+            num_versions += len(expired_versions)
+
+        if first_seen_type == "zset":
+            first_seen_hours_results.append(len(pipeline))
+            pipeline.zremrangebyscore("first_seen:%s" % error_key,
+                                      0, expiry_log_hour_int)
+        elif first_seen_type != "none":
+            pipeline.delete("first_seen:%s" % error_key)
+            num_first_seen += 1
+    results = pipeline.execute()
+    num_first_seen_hours = sum(results[i] for i in first_seen_hours_results)
+
+    return num_versions, num_first_seen, num_first_seen_hours
+
+
+def prune_error_versions(batch_size=1000, max_seconds=None):
+    """Remove expired versions from each <key>:versions sorted set.
+
+    The ver:<version> keys are properly expired, but we do not have a redis
+    way of expiring the members of the :versions sorted sets, so we do it
+    here by removing the versions that no longer have any data.  Likewise we
+    remove the hours more than KEY_EXPIRY_SECONDS ago from first_seen:<key>.
+    We also delete any first_seen:<key> that isn't a sorted set, which it
+    was before 5/5/2015.
+
+    Works in batches of (about) 'batch_size' errors, and can stop after
+    'max_seconds' and pick up from there next time, like
+    compact_errordef_ids.
+    """
+    stats = {"errors": 0, "versions_deleted": 0, "first_seen_deleted": 0,
+             "first_seen_hours_deleted": 0}
+
+    def scan(cursor):
+        return r.scan(cursor=cursor, match="*:versions", count=batch_size)
+
+    def process_batch(versions_keys):
+        num_versions, num_first_seen, num_first_seen_hours = (
+            _prune_error_versions_batch(versions_keys))
+        stats["errors"] += len(versions_keys)
+        stats["versions_deleted"] += num_versions
+        stats["first_seen_deleted"] += num_first_seen
+        stats["first_seen_hours_deleted"] += num_first_seen_hours
+
+    stats["complete"] = _run_resumable_scan(
+        "maintenance:versions:cursor", scan, process_batch, max_seconds)
+    return stats
+
+
+# How long a process may hold the lock on running maintenance for, in case
+# it dies while holding it.
+MAINTENANCE_LOCK_SECONDS = 60 * 60
+
+# Releases a lock if we still hold it.  Checking and deleting in one go means
+# we can't delete a lock that expired and another process took in between.
+#
+# KEYS: the lock
+# ARGV: the value we set it to
+_RELEASE_LOCK_SCRIPT = _LuaScript("""
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('DEL', KEYS[1])
+end
+return 0
+""")
+
+# The totals of what run_maintenance has cleaned up in this process, and how
+# many times it found another process running it.
+_maintenance_stats = {
+    "runs": 0,
+    "runs_skipped": 0,
+    "last_run": None,
+    "compact_errordef_ids": collections.Counter(),
+    "prune_error_versions": collections.Counter(),
+}
+
+
+def run_maintenance(batch_size=1000, max_seconds=None):
+    """Run compact_errordef_ids and prune_error_versions, if no one else is.
+
+    These can both stop part-way and carry on from there next time, so this
+    is meant to be run every so often, with 'max_seconds' split between
+    them.  Only one process runs them at a time: if another is, we do
+    nothing and return None.  Otherwise we return a dict of each task's
+    name to its results.
+    """
+    lock_owner = _process_id()
+    if not r.set("maintenance:lock", lock_owner, nx=True,
+                 ex=MAINTENANCE_LOCK_SECONDS):
+        _maintenance_stats["runs_skipped"] += 1
+        return None
+
+    tasks = (compact_errordef_ids, prune_error_versions)
+    task_seconds = (None if max_seconds is None
+                    else float(max_seconds) / len(tasks))
+    results = {}
+    try:
+        for task in tasks:
+            results[task.__name__] = task(batch_size=batch_size,
+                                          max_seconds=task_seconds)
+    finally:
+        _ScriptWriter(r).run_script(
+            _RELEASE_LOCK_SCRIPT, ["maintenance:lock"], [lock_owner]
+        ).execute()
+
+    _maintenance_stats["runs"] += 1
+    _maintenance_stats["last_run"] = dict(results, time=time.time())
+    for name, task_results in results.iteritems():
+        _maintenance_stats[name].update(
+            {k: v for k, v in task_results.iteritems() if k != "complete"})
+    return results
+
+
+def get_maintenance_stats():
+    """Return what run_maintenance has done in this process."""
+    return {k: dict(v) if isinstance(v, collections.Counter) else v
+            for k, v in _maintenance_stats.iteritems()}
+
+
+def _run_maintenance_periodically(interval_seconds, max_seconds):
+    """Call run_maintenance every 'interval_seconds', forever."""
+    while True:
+        try:
+            results = run_maintenance(max_seconds=max_seconds)
+            if results is not None:
+                logging.info("Maintenance: %s" % results)
+        except Exception:
+            # Whatever it was, we try again next time rather than stop.
+            logging.exception("Maintenance failed")
+        time.sleep(interval_seconds)
+
+
+def start_maintenance_worker(interval_seconds, max_seconds=60):
+    """Run run_maintenance every so often in a background thread.
+
+    This does what running `maintenance.py run_maintenance` from cron
+    would.  Every process can do this; only one will run the maintenance at
+    a time.
+    """
+    thread = threading.Thread(target=_run_maintenance_periodically,
+                              args=(interval_seconds, max_seconds),
+                              name="maintenance")
+    thread.daemon = True
+    thread.start()
+    return thread
+
+
+def rebuild_error_rollups(batch_size=1000):
+    """Recompute the rollups of the hours_seen dictionaries from scratch.
+
+    That is <key>:log_hours, log_hour:<log_hour>:errors and
+    ver:<version>:log_hour:<log_hour>:errors.  This drops counts from log
+    hours more than KEY_EXPIRY_SECONDS ago, and fills in the rollups for
+    errors recorded before we kept them.  Occurrences recorded while this
+    runs may not be counted, so run it between runs of bigquery_import.py.
+
+    We go through the errors 'batch_size' at a time, so we only hold one
+    batch of them in memory.  Each error's <key>:log_hours is replaced as we
+    go; the per-hour sorted sets are built up under temporary keys and
+    swapped in at the end, so readers never see them half-built.
+
+    Returns how many errors and log hours we wrote rollups for.
+    """
+    oldest_log_hour_int = _get_log_hour_int_expiry()
+    rebuild_prefix = "tmp:rebuild:"
+
+    def scan_keys(pattern):
+        cursor = 0
+        while True:
+            cursor, keys = r.scan(cursor=cursor, match=pattern,
+                                  count=batch_size)
+            yield keys
+            if cursor == 0:
+                break
+
+    # Clear out anything left over from a rebuild that didn't finish.
+    for keys in scan_keys(rebuild_prefix + "*"):
+        if keys:
+            r.delete(*keys)
+
+    # The per-hour sorted sets we've built, without rebuild_prefix.
+    hour_keys = set()
+    log_hours_seen = set()
+    error_keys_seen = set()
+    # SCAN may return a key more than once, but rebuilding an error's
+    # rollups twice does no harm: we write its total counts, not increments.
+    for versions_keys in scan_keys("*:versions"):
+        error_keys = [key[:-len(":versions")] for key in versions_keys]
+        pipeline = r.pipeline(transaction=False)
+        for error_key in error_keys:
+            pipeline.zrange("%s:versions" % error_key, 0, -1)
+        all_versions = pipeline.execute()
+
+        pipeline = r.pipeline(transaction=False)
+        for error_key, versions in zip(error_keys, all_versions):
+            for version in versions:
+                pipeline.hgetall(
+                    "ver:%s:error:%s:hours_seen" % (version, error_key))
+        all_hours_seen = iter(pipeline.execute())
+
+        pipeline = r.pipeline(transaction=True)
+        for error_key, versions in zip(error_keys, all_versions):
+            log_hours = collections.Counter()
+            log_hours_by_version = {}
+            for version in versions:
+                for log_hour, count in next(all_hours_seen).iteritems():
+                    if int(log_hour.replace("_", "")) <= oldest_log_hour_int:
+                        continue
+                    log_hours[log_hour] += int(count)
+                    log_hours_by_version["%s:%s" % (log_hour, version)] = (
+                        count)
+                    key = "ver:%s:log_hour:%s:errors" % (version, log_hour)
+                    pipeline.zadd(rebuild_prefix + key, int(count),
+                                  error_key)
+                    hour_keys.add(key)
+
+            for log_hour, count in log_hours.iteritems():
+                key = "log_hour:%s:errors" % log_hour
+                pipeline.zadd(rebuild_prefix + key, count, error_key)
+                hour_keys.add(key)
+            pipeline.delete("%s:log_hours" % error_key)
+            if log_hours_by_version:
+                pipeline.hmset("%s:log_hours" % error_key,
+                               log_hours_by_version)
+                pipeline.expire("%s:log_hours" % error_key,
+                                KEY_EXPIRY_SECONDS)
+                error_keys_seen.add(error_key)
+            log_hours_seen.update(log_hours)
+        pipeline.execute()
+
+    # Swap in the new per-hour sorted sets, and delete the old ones that have
+    # no new counterpart, along with the rollups of errors that are gone.
+    old_keys = set()
+    for pattern in ("log_hour:*:errors", "ver:*:log_hour:*:errors"):
+        for keys in scan_keys(pattern):
+            old_keys.update(keys)
+    hour_keys = list(hour_keys)
+    for i in xrange(0, len(hour_keys), batch_size):
+        pipeline = r.pipeline(transaction=True)
+        for key in hour_keys[i:i + batch_size]:
+            pipeline.rename(rebuild_prefix + key, key)
+            pipeline.expire(key, KEY_EXPIRY_SECONDS)
+        pipeline.execute()
+
+    stale_keys = list(old_keys - set(hour_keys))
+    for keys in scan_keys("*:log_hours"):
+        pipeline = r.pipeline(transaction=False)
+        for key in keys:
+            pipeline.exists("%s:versions" % key[:-len(":log_hours")])
+        stale_keys.extend(key for key, exists in zip(keys, pipeline.execute())
+                          if not exists)
+    # We used to keep a running total of each error's count here.
+    stale_keys.append("error_counts")
+    for i in xrange(0, len(stale_keys), batch_size):
+        r.delete(*stale_keys[i:i + batch_size])
+
+    return {"errors": len(error_keys_seen), "log_hours": len(log_hours_seen)}
+
+
+def rebuild_error_registry(batch_size=1000):
+    """Add every error:<key> in Redis to error_registry.
+
+    _create_or_update_error keeps error_registry up to date, but errors
+    written before we had it aren't in it until they recur.  This finds
+    them the slow way, by scanning the whole keyspace, and gives them the
+    score they would have had from their TTL.
+
+    Returns how many errors we found.
+    """
+    num_errors = 0
+    cursor = 0
+    while True:
+        cursor, keys = r.scan(cursor=cursor, match="error:*",
+                              count=batch_size)
+        pipeline = r.pipeline(transaction=False)
+        for key in keys:
+            pipeline.ttl(key)
+        now = time.time()
+        scores = []
+        for key, ttl in zip(keys, pipeline.execute()):
+            if ttl == -2:
+                continue      # it expired (or was deleted) while we looked
+            if ttl is None or ttl < 0:      # it doesn't expire
+                ttl = KEY_EXPIRY_SECONDS
+            scores.extend((now - KEY_EXPIRY_SECONDS + ttl, key.split(":")[1]))
+        if scores:
+            r.zadd("error_registry", *scores)
+            num_errors += len(scores) // 2
+        if cursor == 0:
+            break
+
+    return {"errors": num_errors}
@@ -0,0 +1,89 @@
+#!/usr/bin/env python
+
+"""Record the monitoring data server.py adds to a Redis stream.
+
+When server.py is run with --monitor-stream, /monitor doesn't record the
+snapshots of error logs it is sent itself, but adds them to a Redis stream
+(see models.py).  Run as many of these as it takes to keep up: they share
+the snapshots out between them through a consumer group, and if one dies
+part-way through a snapshot, another one claims and records it.  Each
+snapshot is counted only once, however that goes.  A snapshot that fails to
+be recorded several times over is moved to a dead-letter stream (see
+models.process_monitoring_stream) rather than retried forever.
+
+This takes the same flags for which Redis to use as server.py, except that
+--redis-timeout is at least --block-seconds plus 30 seconds, so that we don't
+give up while waiting for snapshots.
+
+Usage:
+    python monitor_worker.py [--name NAME] [--redis-host HOST] ...
+"""
+import argparse
+import logging
+import os
+import signal
+import socket
+import time
+
+import models
+
+
+_stopping = False
+
+
+def _stop(signum, frame):
+    global _stopping
+    _stopping = True
+
+
+def run(args):
+    """Record snapshots from the stream until we get SIGTERM or SIGINT."""
+    # Other processes may change the error defs we cache while we run.
+    models.start_invalidation_listener()
+    models.create_monitoring_stream_group()
+    signal.signal(signal.SIGTERM, _stop)
+    signal.signal(signal.SIGINT, _stop)
+
+    while not _stopping:
+        try:
+            models.process_monitoring_stream(
+                args.name, count=args.count,
+                block_seconds=args.block_seconds,
+                claim_idle_seconds=args.claim_idle_seconds)
+        except Exception:
+            # Whatever we didn't acknowledge will be claimed again later,
+            # by us or someone else.
+            logging.exception("Failed to record monitoring data")
+            time.sleep(1)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Record the monitoring data server.py adds to Redis.")
+
+    parser.add_argument('--name',
+        default="%s-%d" % (socket.gethostname(), os.getpid()),
+        help='Our name in the consumer group; must be unique. '
+             '(Default: the hostname and process ID.)')
+
+    parser.add_argument('--count', type=int, default=10,
+        help='How many snapshots to take from the stream at once.')
+
+    parser.add_argument('--block-seconds', type=float, default=5,
+        help='How long to wait for new snapshots before checking for '
+             'ones to claim.')
+
+    parser.add_argument('--claim-idle-seconds', type=float, default=60,
+        help='Claim snapshots another worker has had for this long '
+             'without recording them.')
+
+    models.add_redis_arguments(parser)
+
+    args = parser.parse_args()
+
+    # The socket timeout must allow for blocking on the stream.
+    if args.redis_timeout is None or (
+            args.redis_timeout < args.block_seconds + 30):
+        args.redis_timeout = args.block_seconds + 30
+    models.configure_redis_from_args(args)
+    run(args)
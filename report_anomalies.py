@@ -4,20 +4,21 @@
 
 This tool is purposefully written not to use any of the
 error-monitor-db internals, to show that it can be run from any
-anywhere.
+anywhere.  (http_util.py, which it shares with the other reporting tools,
+only uses the standard library and the server's HTTP API.)
 """
 
 import datetime
-import json
 import logging
-import urllib2
 
 import alertlib
 
+import http_util
+
 
 def _fetch_anomaly_json(hostport, date):
     url = 'http://%s/anomalies/%s' % (hostport, date)
-    return json.load(urllib2.urlopen(url))["anomalies"]
+    return http_util.fetch_json(url)["anomalies"]
 
 
 def _send_alerts(slack_attachments, slack_channel):
@@ -4,19 +4,21 @@
 
 This tool is purposefully written not to use any of the
 error-monitor-db internals, to show that it can be run from any
-anywhere.
+anywhere.  (http_util.py, which it shares with the other reporting tools,
+only uses the standard library and the server's HTTP API.)
 """
 
 import cgi
 import collections
 import datetime
-import json
 import logging
 import re
-import urllib2
+import urllib
 
 import alertlib
 
+import http_util
+
 
 # A list of error message to ignore (that is, to not alert about).
 # These are errors that are either:
@@ -64,9 +66,13 @@ def _matches_blacklist(logline):
     return False
 
 
-def _fetch_error_json(hostport):
-    url = 'http://%s/recent_errors' % hostport
-    return json.load(urllib2.urlopen(url))
+def _fetch_error_json(hostport, start_date, end_date):
+    # Have the server leave out errors, and hours, we don't care about.  We
+    # don't mind if it's a little behind.
+    url = 'http://%s/recent_errors?%s' % (
+        hostport, urllib.urlencode({'start': start_date, 'end': end_date,
+                                    'stale_ok': 1}))
+    return http_util.fetch_json(url)
 
 
 def _send_alert_to_bugtracker(error_info):
@@ -159,6 +165,9 @@ def _parse_error_info(error_dict, start_date, end_date):
     first time this error was seen even if it was before start_date,
     while dates_seen is only dates between start_date and end_date.
 
+    The server only sends us counts in [start_date, end_date) already, but
+    we check again in case it is an old server that sends everything.
+
     The start_date and end_date should be YYYYMMDD_HH.
     """
     dates_seen = set()     # to figure out the *actual* time range covered
@@ -235,7 +244,7 @@ def send_alerts_for_errors(hostport,
         slack_channel: the name of the slack room to send the error report to.
             Can be None, in which case we won't send to Slack.
     """
-    error_json = _fetch_error_json(hostport)
+    error_json = _fetch_error_json(hostport, start_date, end_date)
     errors = error_json['errors']
     categories = _categorize_errors(errors, start_date, end_date)
 
@@ -2,23 +2,30 @@
 # pep8-disable:E128
 """A server that stores & retrieves error information from app logs."""
 import argparse
-import decimal
+import atexit
+import datetime
+import functools
+import hashlib
+import itertools
 import json
+import Queue
 import re
+import sys
+import threading
+import time
+import zlib
 
 import flask
 import logging
 import logging.handlers
 import math
 import numpy
-import redis
 
+import cache_util
 import models
 
 app = flask.Flask("Khan Academy Error Monitor")
 
-r = redis.StrictRedis(host='localhost', port=6379, db=0)
-
 HTTP_OK_CODE = 200
 
 # A list of tuples (error, threshold).  We blacklist these errors unless the
@@ -62,6 +69,186 @@ _ERROR_BLACKLIST_THRESHOLDS = [
 ]
 
 
+# Responses of the read-only handlers, which only change when we record new
+# data.  They're keyed by the request and the data generations (see
+# models.get_data_generation) they depend on, so recording new data makes
+# the old entries unreachable and they age out.  Errors also expire without
+# any new data, so we don't keep entries for more than RESPONSE_CACHE_SECONDS.
+RESPONSE_CACHE_SIZE = 1000
+RESPONSE_CACHE_SECONDS = 5 * 60
+_response_cache = cache_util.LRUCache(RESPONSE_CACHE_SIZE,
+                                      default_ttl=RESPONSE_CACHE_SECONDS)
+_response_cache_stats = {"not_modified": 0}
+
+
+def _cache_until_new_data(generation_fields):
+    """Decorator for a handler whose output only changes with new data.
+
+    'generation_fields' is a function of the handler's arguments that
+    returns the data generations the output depends on.  We answer repeated
+    requests from _response_cache, and send an ETag so that clients can
+    send If-None-Match and get a 304 if they have the current output.
+    Responses other than a plain string (errors) aren't cached.
+    """
+    def decorator(handler):
+        @functools.wraps(handler)
+        def cached_handler(**kwargs):
+            # We get the generation from where we'll read the data from, so
+            # the data is at least as new as the generation.
+            cache_key = (
+                flask.request.path,
+                tuple(sorted(flask.request.args.items(multi=True))),
+                models.get_data_generation(generation_fields(**kwargs),
+                                           stale_ok=_stale_ok()))
+            cached = _response_cache.get(cache_key)
+            if cached is None:
+                body = handler(**kwargs)
+                if not isinstance(body, basestring):
+                    return body
+                cached = (hashlib.md5(body).hexdigest(), body)
+                _response_cache.set(cache_key, cached)
+
+            etag, body = cached
+            response = flask.make_response(body)
+            response.set_etag(etag)
+            response = response.make_conditional(flask.request)
+            if response.status_code == 304:
+                _response_cache_stats["not_modified"] += 1
+            return response
+
+        return cached_handler
+
+    return decorator
+
+
+# Response bodies at least this long are compressed for clients that say
+# they accept it (see _compress_response); for shorter ones the bytes saved
+# aren't worth the CPU.
+COMPRESS_MIN_BYTES = 1024
+COMPRESS_LEVEL = 6
+# The compressed bodies of responses with an ETag (those from
+# _response_cache), keyed by the ETag and encoding, so we compress each once.
+_compressed_response_cache = cache_util.LRUCache(
+    100, default_ttl=RESPONSE_CACHE_SECONDS)
+_compression_stats = {"responses_compressed": 0, "bytes_before": 0,
+                      "bytes_after": 0, "requests_decompressed": 0}
+# We won't decompress a request body to more than this.
+MAX_REQUEST_BYTES = 64 * 1024 * 1024
+
+
+def _compress(data, encoding):
+    """Compress 'data' for the Content-Encoding 'encoding'.
+
+    'encoding' is "gzip" or "deflate" (which in HTTP means zlib format).
+    """
+    if encoding == "gzip":
+        wbits = 16 + zlib.MAX_WBITS
+    else:
+        wbits = zlib.MAX_WBITS
+    compressor = zlib.compressobj(COMPRESS_LEVEL, zlib.DEFLATED, wbits)
+    return compressor.compress(data) + compressor.flush()
+
+
+def _decompress(data, encoding, max_bytes):
+    """Undo _compress, raising ValueError if the data isn't valid.
+
+    We also accept raw deflate data for "deflate", since some clients send
+    that.  If the data decompresses to more than 'max_bytes', we give up and
+    raise ValueError too.
+    """
+    if encoding == "gzip":
+        all_wbits = (16 + zlib.MAX_WBITS,)
+    else:
+        all_wbits = (zlib.MAX_WBITS, -zlib.MAX_WBITS)
+    for wbits in all_wbits:
+        decompressor = zlib.decompressobj(wbits)
+        try:
+            data = decompressor.decompress(data, max_bytes)
+        except zlib.error:
+            continue
+        if decompressor.unconsumed_tail:
+            raise ValueError("Decompresses to over %d bytes" % max_bytes)
+        return data
+    raise ValueError("Not valid %s data" % encoding)
+
+
+def _get_request_json():
+    """Like flask.request.get_json(), but the body may be compressed.
+
+    Clients sending a lot, like the deploy pollers posting to /monitor, may
+    gzip or deflate the body and say so with a Content-Encoding header.  We
+    abort with 400 if it doesn't decompress to JSON, or 415 if we don't know
+    the encoding.
+    """
+    encoding = flask.request.headers.get(
+        "Content-Encoding", "identity").strip().lower()
+    if encoding == "identity":
+        return flask.request.get_json()
+    if encoding not in ("gzip", "deflate"):
+        flask.abort(415)
+    if flask.request.mimetype != "application/json":
+        return None
+
+    try:
+        params = json.loads(_decompress(flask.request.get_data(), encoding,
+                                        MAX_REQUEST_BYTES))
+    except ValueError:
+        flask.abort(400)
+    _compression_stats["requests_decompressed"] += 1
+    return params
+
+
+@app.after_request
+def _compress_response(response):
+    """Compress the response if it's big enough and the client accepts it.
+
+    We use gzip or deflate, whichever the client's Accept-Encoding prefers.
+    Streamed responses (see _error_summaries_page) are sent as they are.
+    Compressing a response changes its ETag to a weak one, since the bytes
+    are different; If-None-Match still matches it.
+    """
+    if (response.status_code != HTTP_OK_CODE or response.is_streamed or
+            response.direct_passthrough or
+            "Content-Encoding" in response.headers):
+        return response
+    body = response.get_data()
+    if len(body) < COMPRESS_MIN_BYTES:
+        return response
+
+    response.vary.add("Accept-Encoding")
+    encoding = flask.request.accept_encodings.best_match(("gzip", "deflate"))
+    if not encoding:
+        return response
+
+    etag, _ = response.get_etag()
+    compressed = None
+    if etag:
+        compressed = _compressed_response_cache.get((etag, encoding))
+    if compressed is None:
+        compressed = _compress(body, encoding)
+        if etag:
+            _compressed_response_cache.set((etag, encoding), compressed)
+        _compression_stats["responses_compressed"] += 1
+        _compression_stats["bytes_before"] += len(body)
+        _compression_stats["bytes_after"] += len(compressed)
+
+    response.set_data(compressed)
+    response.headers["Content-Encoding"] = encoding
+    if etag:
+        response.set_etag(etag, weak=True)
+    return response
+
+
+def _stale_ok():
+    """Whether this request said it doesn't mind slightly stale data.
+
+    The reporting handlers take a "stale_ok=1" query parameter, which lets
+    us answer from the Redis replica if there is one (see --replica-host),
+    keeping the load off the primary, which is busy recording errors.
+    """
+    return flask.request.args.get('stale_ok') == '1'
+
+
 def poisson_cdf(actual, mean):
     """Return p(draw <= actual) when drawing from a poisson distribution.
 
@@ -69,32 +256,205 @@ def poisson_cdf(actual, mean):
     smaller in a random measurement of a variable with a poisson
     distribution with mean mean.
 
-    (Stolen from statistics_util.py in webapp to avoid a scipy dependency.)
+    This is Q(actual + 1, mean), where Q is the regularized upper
+    incomplete gamma function, which we compute as in Numerical Recipes
+    (3rd edition, section 6.2).  Everything is done in floats, in log space
+    where the terms would under- or overflow, so it works for long periods
+    and high numbers of reports without resorting to Decimal, and the time
+    it takes hardly grows with 'actual'.
 
     Arguments:
        mean: a float.
     """
     if actual < 0:
         return 0.0
+    if mean <= 0:
+        return 1.0
+
+    a = actual + 1.0
+    if a >= _GAMMA_QUADRATURE_MIN_A:
+        return _gamma_q_by_quadrature(a, mean)
+    elif mean < a + 1:
+        return 1.0 - _gamma_p_by_series(a, mean)
+    else:
+        return _gamma_q_by_continued_fraction(a, mean)
+
+
+def _gauss_legendre(num_points):
+    """The abscissas and weights of Gauss-Legendre quadrature on [0, 1]."""
+    abscissas, weights = numpy.polynomial.legendre.leggauss(num_points)
+    return (abscissas + 1) / 2, weights / 2
 
-    # We use Decimal so that long periods and high numbers of
-    # reports work -- a mean of 746 or higher would cause a zero
-    # to propagate and make us report a probability of 0 even
-    # if the actual probability was almost 1.
-    mean = decimal.Decimal(mean)
 
-    cum_prob = decimal.Decimal(0)
+# For a at least this big, summing the series or continued fraction for the
+# incomplete gamma function takes too many terms, and we integrate the
+# gamma density numerically instead, with _GAMMA_QUADRATURE_POINTS-point
+# Gauss-Legendre quadrature.
+_GAMMA_QUADRATURE_MIN_A = 100
+_GAMMA_QUADRATURE_POINTS = 24
+_GAMMA_QUADRATURE_ABSCISSAS, _GAMMA_QUADRATURE_WEIGHTS = _gauss_legendre(
+    _GAMMA_QUADRATURE_POINTS)
+_FLOAT_EPSILON = sys.float_info.epsilon
+# Near the smallest float, to stop the continued fraction dividing by zero.
+_FLOAT_TINY = sys.float_info.min / sys.float_info.epsilon
 
-    p = (-mean).exp()
-    cum_prob += p
-    for i in xrange(actual):
-        # We calculate the probability of each lesser value
-        # individually, and sum as we go.
-        p *= mean
-        p /= i + 1
-        cum_prob += p
 
-    return float(cum_prob)
+def _gamma_log_prefactor(a, x):
+    """log(x^a e^-x / Gamma(a)), a factor of both P(a, x) and Q(a, x)."""
+    return a * math.log(x) - x - math.lgamma(a)
+
+
+def _gamma_p_by_series(a, x):
+    """P(a, x) = 1 - Q(a, x), by its series, which converges for x < a + 1."""
+    term = total = 1.0 / a
+    denominator = a
+    while abs(term) >= abs(total) * _FLOAT_EPSILON:
+        denominator += 1
+        term *= x / denominator
+        total += term
+    return total * math.exp(_gamma_log_prefactor(a, x))
+
+
+def _gamma_q_by_continued_fraction(a, x):
+    """Q(a, x) by its continued fraction, which converges for x > a + 1.
+
+    We evaluate it with the modified Lentz's method.
+    """
+    b = x + 1 - a
+    c = 1 / _FLOAT_TINY
+    d = 1 / b
+    fraction = d
+    i = 1
+    while True:
+        an = -i * (i - a)
+        b += 2
+        d = an * d + b
+        if abs(d) < _FLOAT_TINY:
+            d = _FLOAT_TINY
+        c = b + an / c
+        if abs(c) < _FLOAT_TINY:
+            c = _FLOAT_TINY
+        d = 1 / d
+        delta = d * c
+        fraction *= delta
+        if abs(delta - 1) < _FLOAT_EPSILON:
+            break
+        i += 1
+    return math.exp(_gamma_log_prefactor(a, x)) * fraction
+
+
+def _gamma_q_by_quadrature(a, x):
+    """Q(a, x) for large a, by integrating the gamma density numerically.
+
+    The density is negligible more than a few standard deviations (sqrt(a))
+    from its peak, so we integrate from x to there: away from the peak if
+    that's closer, giving Q, or else towards it, giving -P.
+    """
+    a1 = a - 1
+    log_a1 = math.log(a1)
+    sqrt_a1 = math.sqrt(a1)
+    if x > a1:
+        bound = max(a1 + 11.5 * sqrt_a1, x + 6 * sqrt_a1)
+    else:
+        bound = max(0, min(a1 - 7.5 * sqrt_a1, x - 5 * sqrt_a1))
+    # The density over its value at the peak, a1, to keep this in range.
+    # (log1p keeps it accurate for large a, where t / a1 is close to 1.)
+    u = (x + (bound - x) * _GAMMA_QUADRATURE_ABSCISSAS - a1) / a1
+    total = numpy.dot(_GAMMA_QUADRATURE_WEIGHTS,
+                      numpy.exp(a1 * (numpy.log1p(u) - u)))
+    integral = float(total * (bound - x) *
+                     math.exp(a1 * (log_a1 - 1) - math.lgamma(a)))
+    if bound > x:
+        return integral
+    return 1 + integral
+
+
+# In "async" mode (see --async-monitor-workers), /monitor puts the snapshots
+# it is sent on this queue, for a pool of threads to record, and returns
+# right away.  Otherwise it's None, and /monitor records them itself.
+_monitor_queue = None
+# Set when we're shutting down, and stop queueing snapshots.
+_monitor_queue_closed = threading.Event()
+_monitor_queue_stats = {"accepted": 0, "rejected": 0, "recorded": 0,
+                        "failed": 0}
+
+# In "stream" mode (see --monitor-stream), /monitor adds the snapshots it is
+# sent to a Redis stream, for monitor_worker.py processes to record, as long
+# as the stream has fewer than this many waiting.  Otherwise it's None.
+_monitor_stream_max_length = None
+
+# How long monitor_results waits for snapshots of the minute it's asked
+# about to be recorded, checking every MONITOR_RESULTS_POLL_SECONDS.
+MONITOR_RESULTS_WAIT_SECONDS = 30
+MONITOR_RESULTS_POLL_SECONDS = 0.1
+
+
+def _record_monitor_snapshot(version, minute, error_logs):
+    models.record_occurrences_during_monitoring_batch(version, minute,
+                                                      error_logs)
+
+    # Track that we've seen at least some logs from this GAE version and minute
+    models.record_monitoring_data_received(version, minute)
+
+
+def _record_queued_monitor_snapshot():
+    """Take a snapshot off _monitor_queue and record it."""
+    version, minute, error_logs = _monitor_queue.get()
+    try:
+        _record_monitor_snapshot(version, minute, error_logs)
+        _monitor_queue_stats["recorded"] += 1
+    except Exception:
+        logging.exception("Failed to record monitoring data for %s, minute %s"
+                          % (version, minute))
+        _monitor_queue_stats["failed"] += 1
+    finally:
+        try:
+            models.record_monitoring_writes_pending(version, minute, -1)
+        finally:
+            _monitor_queue.task_done()
+
+
+def _record_queued_monitor_snapshots_forever():
+    while True:
+        _record_queued_monitor_snapshot()
+
+
+def _flush_monitor_queue():
+    """Stop queueing snapshots, and wait for the queued ones to be recorded."""
+    _monitor_queue_closed.set()
+    _monitor_queue.join()
+
+
+def start_monitor_workers(num_workers, max_queued):
+    """Have /monitor queue snapshots for 'num_workers' threads to record.
+
+    If more than 'max_queued' snapshots are waiting, /monitor answers 429 so
+    the client will try again later.  We record everything queued before we
+    exit.
+    """
+    global _monitor_queue
+    _monitor_queue = Queue.Queue(max_queued)
+    for i in xrange(num_workers):
+        thread = threading.Thread(
+            target=_record_queued_monitor_snapshots_forever,
+            name="monitor-worker-%d" % i)
+        thread.daemon = True
+        thread.start()
+    atexit.register(_flush_monitor_queue)
+
+
+def _wait_for_monitor_snapshots(versions, minute):
+    """Wait until we've recorded all queued snapshots for the minute.
+
+    They may have been queued by any server process.  Returns False if we
+    gave up after MONITOR_RESULTS_WAIT_SECONDS.
+    """
+    deadline = time.time() + MONITOR_RESULTS_WAIT_SECONDS
+    while models.count_monitoring_writes_pending(versions, minute):
+        if time.time() > deadline:
+            return False
+        time.sleep(MONITOR_RESULTS_POLL_SECONDS)
+    return True
 
 
 def _matches_blacklist(logline, count):
@@ -173,11 +533,21 @@ def monitor():
              subsequently monitored versions
 
     logs:    A list of log records from a short time window (< 1 min) that
-             occurred on the version we're monitoring.
+             occurred on the version we're monitoring, each an object with
+             the fields in models.MONITORING_LOG_FIELDS.
+
+    The body may be gzip- or deflate-compressed, with a Content-Encoding
+    header to say so.
+
+    In async or stream mode we return 200 once we've queued the logs to be
+    recorded, as the deploy scripts expect the same response whichever mode
+    we're in; monitor_results waits for queued logs to be recorded.  We
+    return 429 if too many are queued already, or (in async mode) 503 if
+    we're shutting down.
     """
     # TODO(tom) Secret key for security?
     # Fetch the request parameters
-    params = flask.request.get_json()
+    params = _get_request_json()
     if not params:
         return "Invalid parameters", 400
 
@@ -187,15 +557,39 @@ def monitor():
 
     if error_logs is None or minute is None or version is None:
         return "Invalid parameters", 400
-
-    for log in error_logs:
-        models.record_occurrence_during_monitoring(version, minute,
-            str(log['status']), str(log['level']), log['resource'], log['ip'],
-            log['route'], log['module_id'], log['message'])
-
-    # Track that we've seen at least some logs from this GAE version and minute
-    models.record_monitoring_data_received(version, minute)
-
+    # Check these now, since in async or stream mode we record them after
+    # we've replied, when it's too late to tell the client.
+    if not isinstance(error_logs, list) or not all(
+            isinstance(log, dict) and
+            all(field in log for field in models.MONITORING_LOG_FIELDS)
+            for log in error_logs):
+        return "Invalid log records", 400
+
+    if _monitor_stream_max_length is not None:
+        if models.add_monitoring_snapshot_to_stream(
+                version, minute, error_logs,
+                _monitor_stream_max_length) is None:
+            return "Too much monitoring data queued; try again later", 429
+        return "OK"
+
+    if _monitor_queue is None:
+        _record_monitor_snapshot(version, minute, error_logs)
+        return "OK"
+
+    if _monitor_queue_closed.is_set():
+        return "Shutting down", 503
+
+    # We count it as pending first, so that monitor_results never sees it
+    # neither pending nor recorded.
+    models.record_monitoring_writes_pending(version, minute, 1)
+    try:
+        _monitor_queue.put_nowait((version, minute, error_logs))
+    except Queue.Full:
+        models.record_monitoring_writes_pending(version, minute, -1)
+        _monitor_queue_stats["rejected"] += 1
+        return "Too much monitoring data queued; try again later", 429
+
+    _monitor_queue_stats["accepted"] += 1
     return "OK"
 
 
@@ -221,8 +615,10 @@ def monitor_results(version_id, minute):
         return "Invalid parameters", 400
 
     # Parse verify_versions and skip any versions we haven't actually received
-    # log data for
+    # log data for, once we've recorded any that's queued.
     orig_versions = verify_versions.split(",")
+    if not _wait_for_monitor_snapshots([version_id] + orig_versions, minute):
+        return "Still recording monitoring data; try again later", 503
     verify_versions = [
             v for v in orig_versions
             if models.check_monitoring_data_received(v, minute)]
@@ -303,43 +699,195 @@ def monitor_results(version_id, minute):
     })
 
 
-@app.route("/recent_errors", methods=["get"])
-def view_recent_errors():
-    """Summary information for all errors seen in the past week.
+_LOG_HOUR_RE = re.compile(r'^\d{8}_\d{2}$')
+
+
+def _error_summaries_page(version=None):
+    """The errors for /recent_errors or /version_errors, as a JSON response.
+
+    With no query parameters, we return summary information for every error
+    (for 'version' if given), most frequent first.  Otherwise we return a
+    page of the errors seen most often in a range of log hours, with their
+    counts restricted to that range.  The query parameters are:
+
+    start:  Only count occurrences in or after this log hour (YYYYMMDD_HH)
 
-    See `get_error_summary_info` for more information.
+    end:    Only count occurrences before this log hour (YYYYMMDD_HH)
+
+            We only keep the last KEY_EXPIRY_SECONDS of log hours, so we
+            move these into that range (see models.recent_log_hour_bounds).
+
+    limit:  Return at most this many errors
+
+    cursor: Where to carry on from; the "next_cursor" of the previous page.
+            The response has a "next_cursor" of null on the last page.
+
+    stream: If 1, send the errors as we fetch them rather than all at once,
+            so that we don't need to hold them all in memory.  On its own,
+            we can't sort the summaries before sending them, so we rank the
+            errors by the counts we keep for finding the top errors (see
+            models.get_top_errors): those seen in the logs over the last
+            KEY_EXPIRY_SECONDS for /recent_errors, followed by those seen
+            only while monitoring, and those seen on the version for
+            /version_errors.  That is usually the same order.
+
+    stale_ok: If 1, we may answer from the Redis replica; see _stale_ok.
+
+    The range only applies to errors from the logs: errors seen while
+    monitoring have no log hours, so /version_errors/MON_<version> returns
+    nothing if one is given.
+
+    With any of these parameters, each error's "count" is the count we
+    ranked it by (see models.get_top_errors): with no range that is every
+    occurrence on the version for /version_errors, including those seen
+    while monitoring, and the occurrences in the logs over the last
+    KEY_EXPIRY_SECONDS for /recent_errors.
     """
-    errors = sorted(
-        [models.get_error_summary_info(error_key)
-         for error_key in models.get_error_keys()],
-        key=lambda error: error["count"],
-        reverse=True)
+    args = flask.request.args
+    stream = args.get('stream') == '1'
+    params = ('start', 'end', 'limit', 'cursor')
+    if not any(param in args for param in params):
+        if version is None:
+            error_keys = models.get_error_keys(stale_ok=_stale_ok())
+        else:
+            error_keys = models.get_error_keys_by_version(
+                version, stale_ok=_stale_ok())
+        if stream:
+            # get_error_keys_by_version is already in order.
+            if version is None:
+                ranked = [key for key, _ in models.get_top_errors(
+                              stale_ok=_stale_ok())
+                          if key in error_keys]
+                error_keys = ranked + sorted(error_keys - set(ranked))
+            return flask.Response(_stream_errors_json(
+                models.iter_error_summaries(
+                    error_keys, stale_ok=_stale_ok())))
+
+        errors = sorted(
+            filter(
+              lambda x: x is not None,
+              models.get_error_summaries(error_keys, stale_ok=_stale_ok())),
+            key=lambda error: error["count"],
+            reverse=True)
+
+        return json.dumps({
+            "errors": errors
+        })
+
+    start = args.get('start') or None
+    end = args.get('end') or None
+    try:
+        for log_hour in (start, end):
+            if log_hour is not None:
+                if not _LOG_HOUR_RE.match(log_hour):
+                    return "Invalid parameters", 400
+                # This catches hours that are the right shape but don't
+                # exist, like 20231399_99.
+                datetime.datetime.strptime(log_hour, "%Y%m%d_%H")
+    except ValueError:
+        return "Invalid parameters", 400
+    # Log hours sort as strings, and anything outside these has expired or
+    # is yet to come, so there is no point counting it.
+    earliest, latest = models.recent_log_hour_bounds()
+    if start is not None:
+        start = max(start, earliest)
+    if end is not None:
+        end = min(end, latest)
+
+    try:
+        limit = int(args['limit']) if args.get('limit') else None
+        offset = int(args['cursor']) if args.get('cursor') else 0
+    except ValueError:
+        return "Invalid parameters", 400
+    if (limit is not None and limit < 1) or offset < 0:
+        return "Invalid parameters", 400
+
+    top_errors = models.get_top_errors(start, end, limit, offset, version,
+                                       stale_ok=_stale_ok())
+    if limit is not None and len(top_errors) == limit:
+        next_cursor = str(offset + limit)
+    else:
+        next_cursor = None
+
+    # These are already sorted by their count in the range.
+    error_keys = [k for k, _ in top_errors]
+    if stream:
+        return flask.Response(_stream_errors_json(
+            _with_top_error_counts(
+                models.iter_error_summaries(error_keys, start, end,
+                                            stale_ok=_stale_ok()),
+                top_errors),
+            next_cursor))
+
+    errors = list(_with_top_error_counts(
+        models.get_error_summaries(error_keys, start, end,
+                                   stale_ok=_stale_ok()),
+        top_errors))
 
     return json.dumps({
-        "errors": errors
+        "errors": errors,
+        "next_cursor": next_cursor
     })
 
 
+# Tells _stream_errors_json that the errors aren't paged.
+_NO_CURSOR = object()
+
+
+def _with_top_error_counts(summaries, top_errors):
+    """Give the summaries the counts get_top_errors ranked them by.
+
+    'summaries' are for the keys of 'top_errors', in the same order.  We skip
+    any that are None.
+    """
+    for summary, (_, count) in itertools.izip(summaries, top_errors):
+        if summary is not None:
+            summary["count"] = count
+            yield summary
+
+
+def _stream_errors_json(summaries, next_cursor=_NO_CURSOR):
+    """Yield the JSON for _error_summaries_page a piece at a time.
+
+    This gives the same JSON as json.dumps would, but we only need one
+    summary at a time.  We leave out "next_cursor" if it isn't given.
+    """
+    yield '{"errors": ['
+    separator = ''
+    for summary in summaries:
+        if summary is not None:
+            yield separator + json.dumps(summary)
+            separator = ', '
+    if next_cursor is _NO_CURSOR:
+        yield ']}'
+    else:
+        yield '], "next_cursor": %s}' % json.dumps(next_cursor)
+
+
+@app.route("/recent_errors", methods=["get"])
+@_cache_until_new_data(lambda: ("logs", "monitoring"))
+def view_recent_errors():
+    """Summary information for all errors seen in the past week.
+
+    See `get_error_summary_info` for more information, and
+    `_error_summaries_page` for the parameters for fetching part of it.
+    """
+    return _error_summaries_page()
+
+
 @app.route("/version_errors/<version>", methods=["get"])
+@_cache_until_new_data(lambda version: ("logs", version))
 def view_version_errors(version):
     """Summary information for all errors seen in the specified version.
 
-    See `get_error_summary_info` for more information.
+    See `get_error_summary_info` for more information, and
+    `_error_summaries_page` for the parameters for fetching part of it.
     """
-    errors = sorted(
-        filter(
-          lambda x: x is not None,
-          [models.get_error_summary_info(error_key)
-           for error_key in models.get_error_keys_by_version(version)]),
-        key=lambda error: error["count"],
-        reverse=True)
-
-    return json.dumps({
-        "errors": errors
-    })
+    return _error_summaries_page(version)
 
 
 @app.route("/error/<error_key>", methods=["get"])
+@_cache_until_new_data(lambda error_key: ("logs", "monitoring"))
 def view_error(error_key):
     """Summary information for a single error.
 
@@ -347,17 +895,37 @@ def view_error(error_key):
     information. Extended error information is only retrieved for the latest
     GAE version this error occurred on.
     """
-    info = models.get_error_summary_info(error_key)
+    info = models.get_error_summary_info(error_key, stale_ok=_stale_ok())
     if not info:
         return "Error not found", 404
 
     # Get latest version and return route/stack information for that version
     version = sorted(info["versions"].keys(), key=_version_sort_key)[-1]
-    info["routes"] = models.get_error_extended_information(version, error_key)
+    info["routes"] = models.get_error_extended_information(
+        version, error_key, stale_ok=_stale_ok())
 
     return json.dumps(info)
 
 
+@app.route("/stats", methods=["get"])
+def view_stats():
+    """Hit/miss counters and sizes of this process's in-memory caches.
+
+    Also what the maintenance worker, if any, has cleaned up, and how the
+    /monitor queue, if any, is doing.
+    """
+    stats = models.get_cache_stats()
+    stats["response"] = dict(_response_cache.stats(), **_response_cache_stats)
+    stats["compression"] = dict(_compressed_response_cache.stats(),
+                                **_compression_stats)
+    stats["maintenance"] = models.get_maintenance_stats()
+    if _monitor_queue is not None:
+        stats["monitor_queue"] = dict(_monitor_queue_stats,
+                                      queued=_monitor_queue.qsize(),
+                                      max_queued=_monitor_queue.maxsize)
+    return json.dumps(stats)
+
+
 @app.route('/ping')
 def ping():
     """Simple handler used to check if the server is running.
@@ -369,6 +937,50 @@ def ping():
     return flask.Response('pong', mimetype='text/plain')
 
 
+def _start_background_threads(args):
+    """Start the threads each server process runs alongside the handlers."""
+    models.start_invalidation_listener()
+    if args.async_monitor_workers:
+        start_monitor_workers(args.async_monitor_workers,
+                              args.async_monitor_queue_size)
+    if args.warm_up_seconds:
+        models.start_cache_warm_up(args.warm_up_seconds)
+    if args.maintenance_interval:
+        models.start_maintenance_worker(args.maintenance_interval)
+
+
+def _run_prefork_server(args):
+    """Serve the app with gunicorn, in args.workers worker processes.
+
+    Unlike app.run(), a slow request only holds up the worker handling it,
+    not every other request.
+    """
+    # Only needed in production, so we don't require it for development.
+    import gunicorn.app.base
+
+    def post_fork(server, worker):
+        # Threads don't survive the fork, so each worker starts its own
+        # (and warms up its own caches).
+        _start_background_threads(args)
+
+    def worker_exit(server, worker):
+        if _monitor_queue is not None:
+            _flush_monitor_queue()
+
+    class PreforkServer(gunicorn.app.base.BaseApplication):
+        def load_config(self):
+            self.cfg.set('bind', '0.0.0.0:%d' % args.port)
+            self.cfg.set('workers', args.workers)
+            self.cfg.set('timeout', args.worker_timeout)
+            self.cfg.set('post_fork', post_fork)
+            self.cfg.set('worker_exit', worker_exit)
+
+        def load(self):
+            return app
+
+    PreforkServer().run()
+
+
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description='Serve the error-monitor-db.')
 
@@ -378,6 +990,43 @@ if __name__ == "__main__":
     parser.add_argument('--debug', action='store_true', default=False,
         help='Enable debug mode.')
 
+    parser.add_argument('--workers', type=int, default=0,
+        help='Serve with gunicorn, in this many worker processes. '
+             '(Default: use the single-process Flask development server.)')
+
+    parser.add_argument('--worker-timeout', type=int, default=120,
+        help='Restart a gunicorn worker if a request takes longer than '
+             'this many seconds.')
+
+    parser.add_argument('--warm-up-seconds', type=float, default=0,
+        help='Spend up to this long loading error data from Redis into '
+             'memory in the background at startup. (Default: don\'t.)')
+
+    models.add_redis_arguments(parser, replica=True)
+
+    parser.add_argument('--async-monitor-workers', type=int, default=0,
+        help='Have /monitor queue what it is sent for this many threads to '
+             'record, rather than record it before returning. '
+             '(Default: don\'t.)')
+
+    parser.add_argument('--async-monitor-queue-size', type=int, default=100,
+        help='How many /monitor requests may be queued, in async mode, '
+             'before we ask clients to try again later.')
+
+    parser.add_argument('--monitor-stream', action='store_true',
+        default=False,
+        help='Have /monitor add what it is sent to a Redis stream for '
+             'monitor_worker.py processes to record.')
+
+    parser.add_argument('--monitor-stream-max-length', type=int,
+        default=10000,
+        help='How many /monitor requests may be waiting in the stream, with '
+             '--monitor-stream, before we ask clients to try again later.')
+
+    parser.add_argument('--maintenance-interval', type=float, default=0,
+        help='Run the clean-up that maintenance.py does every this many '
+             'seconds in the background. (Default: don\'t.)')
+
     args = parser.parse_args()
 
     # Start the server running
@@ -390,4 +1039,13 @@ if __name__ == "__main__":
         file_handler.setLevel(logging.WARNING)
         app.logger.addHandler(file_handler)
 
-    app.run(host="0.0.0.0", port=args.port)
+    models.configure_redis_from_args(args)
+
+    if args.monitor_stream:
+        _monitor_stream_max_length = args.monitor_stream_max_length
+
+    if args.workers:
+        _run_prefork_server(args)
+    else:
+        _start_background_threads(args)
+        app.run(host="0.0.0.0", port=args.port)
@@ -0,0 +1,123 @@
+"""Unit tests for the caches in cache_util.py."""
+import unittest
+
+import cache_util
+
+
+class LRUCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.now = 1000.0
+        self.evicted = []
+        self.cache = cache_util.LRUCache(
+            3, on_evict=lambda k, v: self.evicted.append((k, v)))
+        self.cache._clock = lambda: self.now
+
+    def test_get_and_set(self):
+        self.assertEqual(self.cache.get("a"), None)
+        self.assertEqual(self.cache.get("a", 5), 5)
+        self.cache.set("a", 1)
+        self.assertEqual(self.cache.get("a"), 1)
+        self.assertTrue("a" in self.cache)
+        self.assertFalse("b" in self.cache)
+        self.assertEqual(len(self.cache), 1)
+
+        stats = self.cache.stats()
+        self.assertEqual(stats["hits"], 1)
+        self.assertEqual(stats["misses"], 2)
+        self.assertEqual(stats["hit_rate"], 1 / 3.0)
+
+    def test_peek(self):
+        self.cache.set("a", 1)
+        self.cache.set("b", 2)
+        self.cache.set("c", 3)
+        self.assertEqual(self.cache.peek("a"), 1)
+        self.assertEqual(self.cache.peek("z", 5), 5)
+        # Peeking at "a" didn't make it recently used.
+        self.cache.set("d", 4)
+        self.assertEqual(self.evicted, [("a", 1)])
+
+        stats = self.cache.stats()
+        self.assertEqual(stats["hits"], 0)
+        self.assertEqual(stats["misses"], 0)
+
+    def test_evicts_least_recently_used(self):
+        self.cache.set("a", 1)
+        self.cache.set("b", 2)
+        self.cache.set("c", 3)
+        # Using "a" makes "b" the least recently used.
+        self.cache.get("a")
+        self.cache.set("d", 4)
+
+        self.assertEqual(self.evicted, [("b", 2)])
+        self.assertEqual(self.cache.get("b"), None)
+        self.assertEqual(self.cache.get("a"), 1)
+        self.assertEqual(self.cache.get("c"), 3)
+        self.assertEqual(self.cache.get("d"), 4)
+        self.assertEqual(self.cache.stats()["evictions"], 1)
+
+    def test_overwrite(self):
+        self.cache.set("a", 1)
+        self.cache.set("a", 2)
+        self.assertEqual(self.cache.get("a"), 2)
+        self.assertEqual(len(self.cache), 1)
+        self.assertEqual(self.evicted, [])
+
+    def test_ttl(self):
+        self.cache.default_ttl = 10
+        self.cache.set("a", 1)
+        self.cache.set("b", 2, ttl=60)
+
+        self.now += 10
+        self.assertFalse("a" in self.cache)
+        self.assertEqual(self.cache.get("a"), None)
+        self.assertEqual(self.evicted, [("a", 1)])
+        self.assertEqual(self.cache.get("b"), 2)
+
+        self.now += 50
+        self.assertEqual(self.cache.get("b"), None)
+        self.assertEqual(self.cache.stats()["expirations"], 2)
+
+    def test_delete_and_clear(self):
+        self.cache.set("a", 1)
+        self.cache.set("b", 2)
+        self.cache.delete("a")
+        self.cache.delete("missing")
+        self.assertEqual(self.evicted, [("a", 1)])
+
+        self.cache.clear()
+        self.assertEqual(self.evicted, [("a", 1), ("b", 2)])
+        self.assertEqual(len(self.cache), 0)
+
+
+class BloomFilterTest(unittest.TestCase):
+    def test_no_false_negatives(self):
+        bloom_filter = cache_util.BloomFilter(1000)
+        for i in xrange(1000):
+            bloom_filter.add("item %d" % i)
+        for i in xrange(1000):
+            self.assertTrue("item %d" % i in bloom_filter)
+        # The count misses items that were false positives when added.
+        self.assertTrue(990 <= len(bloom_filter) <= 1000)
+
+    def test_false_positive_rate(self):
+        bloom_filter = cache_util.BloomFilter(1000, error_rate=0.01)
+        for i in xrange(1000):
+            bloom_filter.add("item %d" % i)
+
+        false_positives = sum("other %d" % i in bloom_filter
+                              for i in xrange(10000))
+        self.assertLess(false_positives, 200)
+        self.assertAlmostEqual(bloom_filter.error_rate(), 0.01, places=3)
+
+        stats = bloom_filter.stats()
+        self.assertEqual(stats["num_hashes"], 7)
+        self.assertEqual(stats["memory_bytes"], 1199)
+
+    def test_unicode(self):
+        bloom_filter = cache_util.BloomFilter(10)
+        bloom_filter.add(u"caf\xe9")
+        self.assertTrue("caf\xc3\xa9" in bloom_filter)
+
+
+if __name__ == '__main__':
+    unittest.main()
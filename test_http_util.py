@@ -0,0 +1,69 @@
+"""Unit tests for fetching JSON in http_util.py."""
+import gzip
+import json
+import StringIO
+import unittest
+import urllib2
+import zlib
+
+import http_util
+
+
+class _FakeResponse(object):
+    def __init__(self, body, headers):
+        self._body = body
+        self._headers = headers
+
+    def read(self):
+        return self._body
+
+    def info(self):
+        return self._headers
+
+
+class FetchJsonTest(unittest.TestCase):
+    def setUp(self):
+        self.old_urlopen = urllib2.urlopen
+        self.requests = []
+        self.response = None
+
+        def urlopen(request):
+            self.requests.append(request)
+            return self.response
+
+        urllib2.urlopen = urlopen
+
+    def tearDown(self):
+        urllib2.urlopen = self.old_urlopen
+
+    def _fetch(self, body, encoding=None):
+        headers = {} if encoding is None else {'Content-Encoding': encoding}
+        self.response = _FakeResponse(body, headers)
+        return http_util.fetch_json('http://localhost/anomalies/20200101')
+
+    def test_encodings(self):
+        data = {"anomalies": [{"key": "abc", "count": 3}]}
+        body = json.dumps(data)
+        gzipped = StringIO.StringIO()
+        with gzip.GzipFile(fileobj=gzipped, mode='wb') as f:
+            f.write(body)
+        raw_deflate = zlib.compressobj(9, zlib.DEFLATED, -zlib.MAX_WBITS)
+
+        self.assertEqual(self._fetch(body), data)
+        self.assertEqual(self._fetch(body, 'identity'), data)
+        self.assertEqual(self._fetch(gzipped.getvalue(), 'gzip'), data)
+        self.assertEqual(self._fetch(zlib.compress(body), 'deflate'), data)
+        self.assertEqual(
+            self._fetch(raw_deflate.compress(body) + raw_deflate.flush(),
+                        'deflate'),
+            data)
+        self.assertEqual(self.requests[0].get_header('Accept-encoding'),
+                         'gzip, deflate')
+
+    def test_unexpected_encoding(self):
+        with self.assertRaises(ValueError):
+            self._fetch("{}", 'br')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,4 +1,9 @@
+import datetime
 import fakeredis
+import json
+import multiprocessing
+import redis
+import time
 import unittest
 
 import models
@@ -98,9 +103,755 @@ class ModelTest(unittest.TestCase):
         self.assertEquals(count[2], 1)
 
 
+class ErrorDefCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.old_r = models.r
+        models.r = fakeredis.FakeStrictRedis()
+        models.r.flushall()
+        self.old_cache_size = models.ERROR_DEF_CACHE_SIZE
+        models.ERROR_DEF_CACHE_SIZE = 2
+        models._reset_caches()
+
+    def tearDown(self):
+        models.r.flushall()
+        models.r = self.old_r
+        models.ERROR_DEF_CACHE_SIZE = self.old_cache_size
+        models._invalidation_listener = None
+        models._invalidations_subscribed = False
+        models._reset_caches()
+
+    def _create_error(self, message, expiry=models.KEY_EXPIRY_SECONDS):
+        error_def, _, __ = models._parse_message(message, "500", "4")
+        return models._create_or_update_error(error_def, expiry)
+
+    def test_evicted_ids_are_forgotten(self):
+        # Errors we create are cached right away.
+        keys = [self._create_error(message)
+                for message in ("Yoooooo", "Oh no", "Time out")]
+
+        # The first error was evicted, and its IDs along with it.
+        self.assertFalse(keys[0] in models._error_def_cache)
+        self.assertEqual(models._error_id_cache["id0"].peek("500 4 Yoooooo"),
+                         None)
+        self.assertEqual(models._error_id_cache["id0"].peek("500 4 Oh no"),
+                         keys[1])
+        self.assertEqual(models._get_cached_error_def(keys[0])["key"],
+                         keys[0])
+
+        stats = models.get_cache_stats()
+        self.assertEqual(stats["error_def"]["size"], 2)
+        self.assertEqual(stats["error_def"]["evictions"], 2)
+        self.assertEqual(stats["error_id:id0"]["size"], 2)
+
+    def test_expires_with_redis(self):
+        key = self._create_error("Yoooooo", expiry=100)
+        models._reset_caches()
+        now = [1000.0]
+        models._error_def_cache._clock = lambda: now[0]
+        models._error_id_cache["id0"]._clock = lambda: now[0]
+
+        models._get_cached_error_def(key)
+        now[0] += 99
+        self.assertTrue(key in models._error_def_cache)
+        now[0] += 1
+        self.assertFalse(key in models._error_def_cache)
+        self.assertEqual(models._error_id_cache["id0"].peek("500 4 Yoooooo"),
+                         None)
+
+        # Once it has expired from Redis too, we don't find it.
+        models.r.delete("error:%s" % key)
+        self.assertEqual(models._get_cached_error_def(key), None)
+
+    def test_warm_up(self):
+        keys = [self._create_error(message)
+                for message in ("Yoooooo", "Oh no")]
+        # The IDs of errors that have expired stay around.
+        models.r.delete("error:%s" % self._create_error("Time out"))
+        models._reset_caches()
+
+        stats = models.warm_error_def_caches(max_seconds=10)
+        self.assertEqual(stats["entries"], 2)
+        self.assertTrue(stats["complete"])
+        for key in keys:
+            self.assertTrue(key in models._error_def_cache)
+        self.assertEqual(models._error_id_cache["id0"].peek("500 4 Oh no"),
+                         keys[1])
+        self.assertEqual(models.get_cache_stats()["warm_up"], stats)
+
+    def test_warm_up_limit(self):
+        for message in ("Yoooooo", "Oh no", "Time out"):
+            self._create_error(message)
+        models._reset_caches()
+
+        stats = models.warm_error_def_caches(max_seconds=10, max_entries=1)
+        self.assertEqual(stats["entries"], 1)
+        self.assertFalse(stats["complete"])
+        self.assertEqual(len(models._error_def_cache), 1)
+
+    def _handle_invalidations(self, pubsub):
+        while True:
+            message = pubsub.get_message()
+            if message is None:
+                break
+            models._handle_invalidation_message(message)
+        if models._errordef_filter_thread:
+            models._errordef_filter_thread.join()
+
+    def test_invalidation(self):
+        pubsub = models.r.pubsub()
+        pubsub.subscribe(models.ERROR_DEF_INVALIDATION_CHANNEL)
+        self._handle_invalidations(pubsub)
+
+        key = self._create_error("Error while parsing directive 1")
+        self.assertEqual(models._get_cached_error_def(key)["title"],
+                         "Error while parsing directive 1")
+
+        # Another process updates the title.
+        error_def = json.loads(models.r.get("error:%s" % key))
+        error_def["title"] = "Error while parsing directive 2"
+        models.r.set("error:%s" % key, json.dumps(error_def))
+        models.r.publish(models.ERROR_DEF_INVALIDATION_CHANNEL, json.dumps({
+            "origin": "elsewhere:1",
+            "key": key,
+            "ids": {"id0": error_def["id0"]},
+        }))
+
+        self._handle_invalidations(pubsub)
+        self.assertFalse(key in models._error_def_cache)
+        self.assertEqual(models._get_cached_error_def(key)["title"],
+                         "Error while parsing directive 2")
+        # We ignored the message for creating the error, which came from us.
+        self.assertEqual(
+            models.get_cache_stats()["invalidation"]["messages"], 1)
+
+    def test_invalidation_while_reading(self):
+        pubsub = models.r.pubsub()
+        pubsub.subscribe(models.ERROR_DEF_INVALIDATION_CHANNEL)
+        self._handle_invalidations(pubsub)
+        key = self._create_error("Error while parsing directive 1")
+        models._clear_error_def_caches()
+
+        # We read the def, then another process updates it and tells us
+        # before we've cached what we read.
+        generation = models._invalidation_generation
+        old_def = json.loads(models.r.get("error:%s" % key))
+        error_def = dict(old_def, title="Error while parsing directive 2")
+        models.r.set("error:%s" % key, json.dumps(error_def))
+        models.r.publish(models.ERROR_DEF_INVALIDATION_CHANNEL, json.dumps({
+            "origin": "elsewhere:1",
+            "key": key,
+            "ids": {"id0": error_def["id0"]},
+        }))
+        self._handle_invalidations(pubsub)
+
+        models._cache_error_def(key, old_def, models.KEY_EXPIRY_SECONDS,
+                                generation=generation)
+        self.assertFalse(key in models._error_def_cache)
+        self.assertEqual(models._get_cached_error_def(key)["title"],
+                         "Error while parsing directive 2")
+
+    def test_listener_survives_errors(self):
+        class Stop(BaseException):
+            pass
+
+        def handle(message):
+            raise KeyError("id9")
+
+        def sleep(seconds):
+            raise Stop()
+
+        old_handle = models._handle_invalidation_message
+        old_sleep = models.time.sleep
+        models._handle_invalidation_message = handle
+        models.time.sleep = sleep
+        try:
+            # We get as far as waiting to resubscribe.
+            with self.assertRaises(Stop):
+                models._listen_for_invalidations()
+        finally:
+            models._handle_invalidation_message = old_handle
+            models.time.sleep = old_sleep
+        self.assertEqual(
+            models.get_cache_stats()["invalidation"]["disconnects"], 1)
+
+    def test_not_cached_while_unsubscribed(self):
+        # Pretend a listener has started but not yet subscribed.
+        models._invalidation_listener = object()
+        key = self._create_error("Yoooooo")
+        self.assertEqual(models._get_cached_error_def(key)["key"], key)
+        self.assertFalse(key in models._error_def_cache)
+
+        pubsub = models.r.pubsub()
+        pubsub.subscribe(models.ERROR_DEF_INVALIDATION_CHANNEL)
+        self._handle_invalidations(pubsub)
+        models._get_cached_error_def(key)
+        self.assertTrue(key in models._error_def_cache)
+
+
+def _dump_redis(redis_client):
+    """Return the contents of every key in the db, for comparison."""
+    contents = {}
+    for key in redis_client.keys("*"):
+        key_type = redis_client.type(key)
+        if key == "error_registry":
+            # The scores are the times the errors were written.
+            value = sorted(redis_client.zrange(key, 0, -1))
+        elif key_type == "zset":
+            value = redis_client.zrange(key, 0, -1, withscores=True)
+        elif key_type == "hash":
+            value = redis_client.hgetall(key)
+        elif key.startswith("error:"):
+            value = json.loads(redis_client.get(key))
+        else:
+            value = redis_client.get(key)
+        contents[key] = (value, redis_client.ttl(key))
+    return contents
+
+
+def _local_redis_or_none():
+    """Return a client for a scratch db on a local redis-server, if any.
+
+    Tests that need a real Redis (for instance to run Lua scripts, which
+    fakeredis doesn't support) are skipped when there isn't one.
+    """
+    client = redis.StrictRedis(host='localhost', port=6379, db=15)
+    try:
+        client.ping()
+    except redis.exceptions.ConnectionError:
+        return None
+    return client
+
+
+class _RoundTripCounter(object):
+    """Wraps a Redis client and counts how many round trips go through it.
+
+    Every command sent directly counts as one round trip, as does every
+    pipeline execute() no matter how many commands were queued on it.
+    """
+    def __init__(self, redis_client):
+        self._redis = redis_client
+        self.round_trips = 0
+
+    def pipeline(self, *args, **kwargs):
+        pipe = self._redis.pipeline(*args, **kwargs)
+        execute = pipe.execute
+
+        def counted_execute(*args, **kwargs):
+            self.round_trips += 1
+            return execute(*args, **kwargs)
+
+        pipe.execute = counted_execute
+        return pipe
+
+    def __getattr__(self, name):
+        command = getattr(self._redis, name)
+
+        def counted_command(*args, **kwargs):
+            self.round_trips += 1
+            return command(*args, **kwargs)
+
+        return counted_command
+
+
+class WriteRoundTripTest(unittest.TestCase):
+    def setUp(self):
+        self.old_r = models.r
+        self.old_write_mode = models.WRITE_MODE
+        models.r = _RoundTripCounter(fakeredis.FakeStrictRedis())
+        models.r.flushall()
+        models._reset_caches()
+
+    def tearDown(self):
+        models.r.flushall()
+        models.r = self.old_r
+        models.WRITE_MODE = self.old_write_mode
+
+    def _record_during_monitoring(self, ip):
+        models.r.round_trips = 0
+        models.record_occurrence_during_monitoring(
+            "v001", 0, "500", "4", "/test", ip, "/test", "default",
+            "Error while parsing directive 1")
+
+    def test_pipelined_error_details(self):
+        models.WRITE_MODE = models.WRITE_MODE_PIPELINE
+
+        # A new error misses on the key and on id0, id1 and id2 before
+        # creating it; all of its writes then go out together.
+        models.r.round_trips = 0
+        error_key = models._update_error_details(
+            "v001", "500", "4", "/test", "1.1.1.1", "/test", "default",
+            "Error while parsing directive 1")
+        self.assertEqual(models.r.round_trips, 5)
+
+        # An existing error is found in the cache, so we need only update
+        # its title along with the other writes.
+        models.r.round_trips = 0
+        self.assertEqual(error_key, models._update_error_details(
+            "v001", "500", "4", "/test", "1.1.1.1", "/test", "default",
+            "Error while parsing directive 2"))
+        self.assertEqual(models.r.round_trips, 1)
+
+        self.assertEqual(
+            models.r.zscore("ver:v001:error:%s:routes" % error_key, "/test"),
+            2)
+        self.assertEqual(
+            models.r.ttl("ver:v001:error:%s:routes" % error_key),
+            models.KEY_EXPIRY_SECONDS)
+        self.assertEqual(
+            models.r.ttl("error:%s" % error_key), models.KEY_EXPIRY_SECONDS)
+
+    def test_unchanged_error_def(self):
+        models.WRITE_MODE = models.WRITE_MODE_DIRECT
+        error_key = models._update_error_details(
+            "v001", "500", "4", "/test", "1.1.1.1", "/test", "default",
+            "Error while parsing directive 1")
+        models.r.expire("error:%s" % error_key, 100)
+
+        # The same error again needs only the 16 counter writes.
+        models.r.round_trips = 0
+        models._update_error_details(
+            "v001", "500", "4", "/test", "1.1.1.1", "/test", "default",
+            "Error while parsing directive 1")
+        self.assertEqual(models.r.round_trips, 16)
+        self.assertEqual(models.r.ttl("error:%s" % error_key), 100)
+
+        stats = models.get_cache_stats()["error_def_writes"]
+        self.assertEqual(stats["def_writes"], 1)
+        self.assertEqual(stats["def_writes_skipped"], 1)
+        self.assertEqual(stats["id_writes"], 3)
+        self.assertEqual(stats["id_writes_skipped"], 3)
+        self.assertEqual(stats["expiry_refreshes_skipped"], 1)
+
+        # But we do refresh the expiry every so often.
+        models._expiry_refreshed.clear()
+        models._update_error_details(
+            "v001", "500", "4", "/test", "1.1.1.1", "/test", "default",
+            "Error while parsing directive 1")
+        self.assertEqual(
+            models.r.ttl("error:%s" % error_key), models.KEY_EXPIRY_SECONDS)
+
+    def test_filtered_error_details(self):
+        models.WRITE_MODE = models.WRITE_MODE_PIPELINE
+        error_key = models._update_error_details(
+            "v001", "500", "4", "/test", "1.1.1.1", "/test", "default",
+            "Error while parsing directive 1")
+
+        # Subscribing to invalidations builds the filters.
+        pubsub = models.r.pubsub()
+        pubsub.subscribe(models.ERROR_DEF_INVALIDATION_CHANNEL)
+        models._handle_invalidation_message(pubsub.get_message())
+        models._errordef_filter_thread.join()
+
+        def unsubscribe():
+            models._invalidations_subscribed = False
+            models._reset_caches()
+        self.addCleanup(unsubscribe)
+
+        # A new error goes straight to writing.
+        models.r.round_trips = 0
+        models._update_error_details(
+            "v001", "500", "4", "/test", "1.1.1.1", "/test", "default",
+            "Yoooooo")
+        self.assertEqual(models.r.round_trips, 1)
+
+        # An existing one is looked up as before.
+        models.r.round_trips = 0
+        self.assertEqual(error_key, models._update_error_details(
+            "v001", "500", "4", "/test", "1.1.1.1", "/test", "default",
+            "Error while parsing directive 2"))
+        self.assertEqual(models.r.round_trips, 3)
+
+        stats = models.get_cache_stats()
+        self.assertEqual(stats["errordef_filter:id0"]["skipped"], 1)
+        self.assertEqual(stats["errordef_filter:id0"]["items"], 2)
+        self.assertEqual(stats["errordef_filter:id0"]["false_positives"], 0)
+
+    def test_filters_rebuilt_during_lookup(self):
+        models.WRITE_MODE = models.WRITE_MODE_PIPELINE
+        error_key = models._update_error_details(
+            "v001", "500", "4", "/test", "1.1.1.1", "/test", "default",
+            "Error while parsing directive 1")
+        pubsub = models.r.pubsub()
+        pubsub.subscribe(models.ERROR_DEF_INVALIDATION_CHANNEL)
+        models._handle_invalidation_message(pubsub.get_message())
+        models._errordef_filter_thread.join()
+        models._clear_error_def_caches()
+
+        def unsubscribe():
+            models._invalidations_subscribed = False
+            models._reset_caches()
+        self.addCleanup(unsubscribe)
+
+        # Another thread swaps in new, empty filters just after we've
+        # checked the old ones are usable.
+        old_usable = models._errordef_filters_usable
+        fill = models._fill_errordef_filters
+
+        def usable_then_rebuilt(filters):
+            usable = old_usable(filters)
+            models._fill_errordef_filters = lambda filters: None
+            try:
+                models._rebuild_errordef_filters()
+            finally:
+                models._fill_errordef_filters = fill
+            return usable
+
+        models._errordef_filters_usable = usable_then_rebuilt
+        try:
+            error_def, _, __ = models._parse_message(
+                "Error while parsing directive 2", "500", "4")
+            self.assertEqual(models._find_error_by_def(error_def), error_key)
+        finally:
+            models._errordef_filters_usable = old_usable
+
+    def test_failed_writes_not_cached(self):
+        models.WRITE_MODE = models.WRITE_MODE_PIPELINE
+        old_get_writer = models._get_writer
+
+        def failing_writer():
+            writer = old_get_writer()
+
+            def execute():
+                writer.reset()
+                raise redis.exceptions.ConnectionError("Redis blipped")
+
+            writer.execute = execute
+            return writer
+
+        models._get_writer = failing_writer
+        try:
+            with self.assertRaises(redis.exceptions.ConnectionError):
+                models.record_occurrence_from_errors(
+                    "v001", "20200101_11", "500", "4", "/test", "1.1.1.1",
+                    "/test", "default", "Yoooooo")
+        finally:
+            models._get_writer = old_get_writer
+
+        # Since none of the first one's writes were made, we make them all
+        # next time.
+        for _ in xrange(3):
+            error_key, _ = models.record_occurrence_from_errors(
+                "v001", "20200101_11", "500", "4", "/test", "1.1.1.1",
+                "/test", "default", "Yoooooo")
+        self.assertNotEqual(models.r.get("error:%s" % error_key), None)
+        self.assertEqual(models.r.hgetall("errordef:id0"),
+                         {"500 4 Yoooooo": error_key})
+        self.assertEqual(models.get_error_keys(), {error_key})
+
+    def test_direct_error_details(self):
+        models.WRITE_MODE = models.WRITE_MODE_DIRECT
+
+        models.r.round_trips = 0
+        error_key = models._update_error_details(
+            "v001", "500", "4", "/test", "1.1.1.1", "/test", "default",
+            "Error while parsing directive 1")
+        # The same 4 reads as above, plus the 5 def writes, the invalidation
+        # message, 2 registry writes and 16 counter writes.
+        self.assertEqual(models.r.round_trips, 28)
+        self.assertEqual(
+            models.r.zscore("ver:v001:error:%s:routes" % error_key, "/test"),
+            1)
+
+    def test_pipelined_monitoring(self):
+        models.WRITE_MODE = models.WRITE_MODE_PIPELINE
+
+        # The first occurrence from an IP also bumps the unique count.
+        self._record_during_monitoring("1.1.1.1")
+        self.assertEqual(models.r.round_trips, 6)
+        self._record_during_monitoring("1.1.1.1")
+        self.assertEqual(models.r.round_trips, 1)
+        self._record_during_monitoring("1.1.1.2")
+        self.assertEqual(models.r.round_trips, 2)
+
+        self.assertEqual(models.get_monitoring_errors("v001", 0)[0][1], 2)
+        error_key = models.get_monitoring_errors("v001", 0)[0][0]["key"]
+        self.assertTrue(
+            models.lookup_monitoring_error("v001", 0, error_key))
+        self.assertEqual(
+            models.r.zscore("ver:MON_v001:errors_by_minute:0", error_key), 3)
+
+
+class MonitoringBatchTest(unittest.TestCase):
+    maxDiff = None
+
+    def setUp(self):
+        self.old_r = models.r
+        models._reset_caches()
+
+    def tearDown(self):
+        models.r = self.old_r
+
+    def _log(self, ip, message, route="/test", status=500):
+        return {"status": status, "level": 4, "resource": route + "?_=1",
+                "ip": ip, "route": route, "module_id": "default",
+                "message": message}
+
+    def _record_one_at_a_time_and_batched(self, version, minute, logs):
+        models.r = fakeredis.FakeStrictRedis()
+        models.r.flushall()
+        for log in logs:
+            models.record_occurrence_during_monitoring(
+                version, minute, str(log['status']), str(log['level']),
+                log['resource'], log['ip'], log['route'], log['module_id'],
+                log['message'])
+        expected = _dump_redis(models.r)
+        models.r.flushall()
+
+        models._reset_caches()
+        models.r = _RoundTripCounter(fakeredis.FakeStrictRedis())
+        models.record_occurrences_during_monitoring_batch(
+            version, minute, logs)
+        round_trips = models.r.round_trips
+        self.assertEqual(_dump_redis(models.r), expected)
+        models.r.flushall()
+        return round_trips
+
+    def test_matches_one_at_a_time(self):
+        logs = [
+            self._log("1.1.1.1", "Error while parsing directive 1"),
+            self._log("1.1.1.2", "Error Help me, Obi Wan Kenobi. You're my "
+                      "only hope", route="/leia"),
+            self._log("1.1.1.2", "Error while parsing directive 2"),
+            self._log("1.1.1.1", "Error Help me, Obi Wan Kenobi. Train me in "
+                      "ways of the force", route="/luke"),
+            self._log("1.1.1.3", "Error Help me, Obi Wan Kenobi. You're my "
+                      "only hope", route="/leia"),
+            self._log("1.1.1.1", "This URI is blacklisted.",
+                      route="/api/internal/translate/lint_poentry"),
+            self._log("1.1.1.1", "There's no place like home.", status=404),
+            self._log("1.1.1.1", "There's no place like home.", status=404),
+        ]
+        self._record_one_at_a_time_and_batched("v001", 3, logs)
+
+    def test_repeated_lines(self):
+        logs = [self._log("1.1.1.%d" % (i % 3),
+                          "Exceeded soft private memory limit")
+                for i in xrange(500)]
+        round_trips = self._record_one_at_a_time_and_batched("v001", 0, logs)
+        # Looking up and creating the one error takes 5 round trips, and then
+        # all the counters go out in 2 more.
+        self.assertEqual(round_trips, 7)
+
+    def test_empty(self):
+        self._record_one_at_a_time_and_batched("v001", 0, [])
+
+
+@unittest.skipIf(_local_redis_or_none() is None,
+                 "needs a redis-server on localhost:6379")
+class LuaWriteModeTest(unittest.TestCase):
+    def setUp(self):
+        self.old_r = models.r
+        self.old_write_mode = models.WRITE_MODE
+        models.r = _local_redis_or_none()
+        models.r.flushdb()
+        models._reset_caches()
+
+    def tearDown(self):
+        models.r.flushdb()
+        models.r = self.old_r
+        models.WRITE_MODE = self.old_write_mode
+
+    def _record(self, write_mode, logs):
+        models.r.flushdb()
+        models._reset_caches()
+        models.WRITE_MODE = write_mode
+        for ip, message in logs:
+            models.record_occurrence_during_monitoring(
+                "v001", 0, "500", "4", "/test", ip, "/test", "default",
+                message)
+            models.record_occurrence_from_errors(
+                "v001", "20200101_11", "500", "4", "/test", ip, "/test",
+                "default", message)
+        return _dump_redis(models.r)
+
+    def test_same_as_pipeline(self):
+        logs = [("1.1.1.1", "Error while parsing directive 1"),
+                ("1.1.1.1", "Error while parsing directive 2"),
+                ("1.1.1.2", "Yoooooo"),
+                ("1.1.1.3", "Error while parsing directive 3")]
+        self.assertEqual(self._record(models.WRITE_MODE_LUA, logs),
+                         self._record(models.WRITE_MODE_PIPELINE, logs))
+
+    def test_script_flushed(self):
+        models.WRITE_MODE = models.WRITE_MODE_LUA
+        models.record_occurrence_during_monitoring(
+            "v001", 0, "500", "4", "/test", "1.1.1.1", "/test", "default",
+            "Yoooooo")
+        # If Redis forgets the scripts we fall back to EVAL.
+        models.r.script_flush()
+        models.record_occurrence_during_monitoring(
+            "v001", 0, "500", "4", "/test", "1.1.1.2", "/test", "default",
+            "Yoooooo")
+        self.assertEqual(models.get_monitoring_errors("v001", 0)[0][1], 2)
+
+    def test_batch(self):
+        logs = [{"status": 500, "level": 4, "resource": "/test",
+                 "ip": "1.1.1.%d" % (i % 3), "route": "/test",
+                 "module_id": "default", "message": "Yoooooo"}
+                for i in xrange(10)]
+        models.WRITE_MODE = models.WRITE_MODE_LUA
+        models.record_occurrences_during_monitoring_batch("v001", 0, logs)
+        models.record_occurrences_during_monitoring_batch("v001", 0, logs)
+        self.assertEqual(models.get_monitoring_errors("v001", 0)[0][1], 3)
+
+
+def _run_monitor_worker(consumer):
+    """Record snapshots from the monitoring stream until there are none."""
+    models.r = _local_redis_or_none()
+    models._reset_caches()
+    deadline = time.time() + 30
+    while (models.r.execute_command("XLEN", models.MONITOR_STREAM) and
+           time.time() < deadline):
+        models.process_monitoring_stream(consumer, count=2, block_seconds=0.1,
+                                         claim_idle_seconds=0.5)
+
+
+@unittest.skipIf(_local_redis_or_none() is None,
+                 "needs a redis-server on localhost:6379")
+class MonitorStreamTest(unittest.TestCase):
+    def setUp(self):
+        self.old_r = models.r
+        models.r = _local_redis_or_none()
+        models.r.flushdb()
+        models._reset_caches()
+
+    def tearDown(self):
+        models.r.flushdb()
+        models.r = self.old_r
+
+    def test_processed_key(self):
+        logs = [{"status": 500, "level": 4, "resource": "/test",
+                 "ip": "1.1.1.%d" % (i % 3), "route": "/test",
+                 "module_id": "default",
+                 "message": "Error while parsing %d" % i}
+                for i in xrange(10)]
+        models.record_monitoring_writes_pending("v001", 0, 1)
+        models.record_occurrences_during_monitoring_batch("v001", 0, logs)
+        models.record_monitoring_data_received("v001", 0)
+        models.record_monitoring_writes_pending("v001", 0, -1)
+        models.r.set("done", 1,
+                     ex=models.MONITOR_STREAM_PROCESSED_EXPIRY_SECONDS)
+        expected = _dump_redis(models.r)
+        models.r.flushdb()
+
+        models._reset_caches()
+        models.record_monitoring_writes_pending("v001", 0, 1)
+        self.assertTrue(models.record_occurrences_during_monitoring_batch(
+            "v001", 0, logs, processed_key="done"))
+        self.assertFalse(models.record_occurrences_during_monitoring_batch(
+            "v001", 0, logs, processed_key="done"))
+        # Including the unique errors, which are counted in the transaction.
+        self.assertEqual(_dump_redis(models.r), expected)
+
+    def _read_as(self, consumer, count):
+        return models.r.execute_command(
+            "XREADGROUP", "GROUP", models.MONITOR_STREAM_GROUP, consumer,
+            "COUNT", count, "STREAMS", models.MONITOR_STREAM, ">")[0][1]
+
+    def test_each_snapshot_recorded_once(self):
+        messages = ["Yoooooo", "Error while parsing directive",
+                    "Help me, Obi Wan Kenobi", "There's no place like home"]
+        for i in xrange(20):
+            logs = [{"status": 500, "level": 4, "resource": "/test",
+                     "ip": "1.1.1.%d" % j, "route": "/test",
+                     "module_id": "default",
+                     "message": messages[i % 4]}
+                    for j in xrange(3)]
+            self.assertTrue(models.add_monitoring_snapshot_to_stream(
+                "v001", 0, logs, max_length=100))
+        self.assertEqual(models.count_monitoring_writes_pending(["v001"], 0),
+                         20)
+        self.assertIsNone(models.add_monitoring_snapshot_to_stream(
+            "v001", 0, [], max_length=20))
+
+        # One consumer takes a few snapshots and dies without recording
+        # them; another dies after recording one, but before acknowledging
+        # it.
+        models.create_monitoring_stream_group()
+        models.create_monitoring_stream_group()
+        self._read_as("crashed-1", 3)
+        entry_id, fields = self._read_as("crashed-2", 1)[0]
+        self.assertTrue(
+            models._record_monitoring_stream_entry(entry_id, fields))
+
+        workers = [multiprocessing.Process(target=_run_monitor_worker,
+                                           args=("worker-%d" % i,))
+                   for i in xrange(3)]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join(60)
+            self.assertEqual(worker.exitcode, 0)
+
+        self.assertEqual(
+            models.r.execute_command("XLEN", models.MONITOR_STREAM), 0)
+        self.assertEqual(models.count_monitoring_writes_pending(["v001"], 0),
+                         0)
+        self.assertTrue(models.check_monitoring_data_received("v001", 0))
+        self.assertEqual(
+            [count for _, count in models.r.zrange(
+                "ver:MON_v001:errors_by_minute:0", 0, -1, withscores=True)],
+            [15, 15, 15, 15])
+        self.assertEqual(
+            [count for _, count in models.get_monitoring_errors("v001", 0)],
+            [3, 3, 3, 3])
+
+    def test_snapshot_that_always_fails(self):
+        # This log has no IP, so recording it raises every time.
+        logs = [{"status": 500, "level": 4, "resource": "/test",
+                 "route": "/test", "module_id": "default",
+                 "message": "Yoooooo"}]
+        models.create_monitoring_stream_group()
+        entry_id = models.add_monitoring_snapshot_to_stream(
+            "v001", 0, logs, max_length=100)
+
+        for i in xrange(models.MONITOR_STREAM_MAX_DELIVERIES):
+            self.assertEqual(models.process_monitoring_stream(
+                "worker", block_seconds=0.1, claim_idle_seconds=0), 0)
+            self.assertEqual(
+                models.r.execute_command("XLEN", models.MONITOR_STREAM),
+                0 if i == models.MONITOR_STREAM_MAX_DELIVERIES - 1 else 1)
+
+        self.assertEqual(models.count_monitoring_writes_pending(["v001"], 0),
+                         0)
+        (_, fields), = models.r.execute_command(
+            "XRANGE", models.MONITOR_DEAD_LETTER_STREAM, "-", "+")
+        self.assertEqual(fields[:2], ["entry_id", entry_id])
+
+
 class TestParseMessage(unittest.TestCase):
+    def setUp(self):
+        models._reset_caches()
+
+    def test_cached(self):
+        message = ('Error on line 214: File not found\n'
+                   '  File "a.py", line 1, in f')
+        expected = models._parse_message_uncached(message, '200', '3')
+
+        error_def, stack, stack_key = models._parse_message(
+            message, '200', '3')
+        self.assertEqual((error_def, stack, stack_key), expected)
+
+        # Callers can't corrupt the cached results.
+        error_def['key'] = 'corrupt'
+        stack[0]['lineno'] = 'corrupt'
+        stack.append('corrupt')
+        self.assertEqual(models._parse_message(message, '200', '3'),
+                         expected)
+
+        stats = models.get_cache_stats()["parse_message"]
+        self.assertEqual(stats["hits"], 1)
+        self.assertEqual(stats["misses"], 1)
+
+    def test_cache_key_types(self):
+        # Status and level are returned as whatever type they were passed as.
+        error_def, _, __ = models._parse_message('Oops', '500', '4')
+        self.assertEqual(error_def['status'], '500')
+        error_def, _, __ = models._parse_message('Oops', 500, 4)
+        self.assertEqual(error_def['status'], 500)
+        self.assertEqual(error_def['level'], 4)
+
     def test_simple(self):
-        # TODO(benkraft): Test stacktrace parsing.
         error_def, _, __ = models._parse_message(
             'Error on line 214: File not found', '200', '3')
         error_def.pop('key')  # We don't check the key.
@@ -231,6 +982,536 @@ class TestParseMessage(unittest.TestCase):
                         "count_practiceable_content."),
             })
 
+    def test_non_combinable_precedence(self):
+        # When several special cases match, the first one listed wins.
+        error_def, _, __ = models._parse_message(
+            "Memcache set failed for x: 'Foo' object has no attribute 'y'",
+            '200', '3')
+        self.assertEqual(error_def['id1'], None)
+        self.assertEqual(error_def['id3'], None)
+
+    def test_stack(self):
+        error_def, stack, stack_key = models._parse_message(
+            u"'NoneType' object has no attribute 'key'\n"
+            u"Traceback (most recent call last):\n"
+            u'  File "/base/data/home/apps/s~khan-academy/'
+            u'1029-2305-f48a12e2b9ba.379742046073152437/api/errors.py", '
+            u'line 12, in wrapped\n'
+            u"    return func(*args, **kwargs)\n"
+            u'  File "/base/data/home/runtimes/python27/webapp2.py", '
+            u'line 570, in dispatch\n'
+            u"    return method(*args, **kwargs)\n"
+            u'  File "/base/data/home/apps/s~khan-academy/'
+            u'1029-2305-f48a12e2b9ba.379742046073152437/api/internal/us',
+            '500', '4')
+        self.assertEqual(
+            error_def['title'], "'NoneType' object has no attribute 'key'")
+        # The truncated last frame is dropped.
+        self.assertEqual(stack, [
+            {"filename": "api/errors.py", "lineno": "12",
+             "function": "wrapped"},
+            {"filename": "/base/data/home/runtimes/python27/webapp2.py",
+             "lineno": "570", "function": "dispatch"},
+        ])
+
+        # Line numbers don't affect the stack key.
+        _, __, other_stack_key = models._parse_message(
+            u"Oops\n"
+            u'  File "api/errors.py", line 13, in wrapped\n'
+            u'  File "/base/data/home/runtimes/python27/webapp2.py", '
+            u'line 1, in dispatch',
+            '500', '4')
+        self.assertEqual(other_stack_key, stack_key)
+
+    def test_empty_first_line(self):
+        error_def, stack, _ = models._parse_message(
+            '\n  File "a.py", line 1, in f\nTimeoutError: oh no', '500', '4')
+        self.assertEqual(error_def['title'], 'TimeoutError: oh no')
+        self.assertEqual(
+            stack, [{"filename": "a.py", "lineno": "1", "function": "f"}])
+
+
+class ErrorSummaryTest(unittest.TestCase):
+    def setUp(self):
+        self.old_r = models.r
+        models.r = _RoundTripCounter(fakeredis.FakeStrictRedis())
+        models.r.flushall()
+        models._reset_caches()
+
+    def tearDown(self):
+        models.r.flushall()
+        models.r = self.old_r
+
+    def _record(self, version, hours_ago):
+        log_hour = (datetime.datetime.utcnow() -
+                    datetime.timedelta(hours=hours_ago)).strftime("%Y%m%d_%H")
+        return models.record_occurrence_from_errors(
+            version, log_hour, "500", "4", "/test", "1.1.1.1", "/test",
+            "default", "Yoooooo")[0], log_hour
+
+    def test_summary(self):
+        error_key, first_hour = self._record("v001", 2)
+        _, last_hour = self._record("v001", 1)
+        self._record("v002", 1)
+        models.record_occurrence_during_monitoring(
+            "v002", 0, "500", "4", "/test", "1.1.1.1", "/test", "default",
+            "Yoooooo")
+        before = _dump_redis(models.r)
+
+        models.r.round_trips = 0
+        info = models.get_error_summary_info(error_key)
+        self.assertEqual(models.r.round_trips, 1)
+        # Summaries don't write anything.
+        self.assertEqual(_dump_redis(models.r), before)
+
+        self.assertEqual(info["versions"],
+                         {"v001": 2, "v002": 1, "MON_v002": 1})
+        self.assertEqual(info["first_seen"], first_hour)
+        self.assertEqual(info["last_seen"], last_hour)
+        self.assertEqual(info["count"], 3)
+        self.assertEqual(
+            sorted((d["version"], d["hour"], d["count"])
+                   for d in info["by_hour_and_version"]),
+            [("v001", first_hour, "1"), ("v001", last_hour, "1"),
+             ("v002", last_hour, "1")])
+
+    def test_many_summaries(self):
+        error_keys = []
+        for message in ("Yoooooo", "Oh no", "Time out"):
+            error_keys.append(models.record_occurrence_from_errors(
+                "v001", "20200101_11", "500", "4", "/test", "1.1.1.1",
+                "/test", "default", message)[0])
+        error_keys.insert(1, "deadbeef")
+        expected = [models.get_error_summary_info(k) for k in error_keys]
+        self.assertEqual(expected[1], None)
+
+        old_chunk_size = models.SUMMARY_CHUNK_SIZE
+        models.SUMMARY_CHUNK_SIZE = 2
+        try:
+            models._reset_caches()
+            models.r.round_trips = 0
+            self.assertEqual(models.get_error_summaries(error_keys), expected)
+            # One round trip for each chunk.
+            self.assertEqual(models.r.round_trips, 2)
+        finally:
+            models.SUMMARY_CHUNK_SIZE = old_chunk_size
+
+    def test_old_first_seen(self):
+        error_key, _ = self._record("v001", 1)
+        models.r.set("first_seen:%s" % error_key, "20150101_00")
+        self.assertEqual(
+            models.get_error_summary_info(error_key)["first_seen"], None)
+
+
+class TopErrorsTest(unittest.TestCase):
+    def setUp(self):
+        self.old_r = models.r
+        models.r = fakeredis.FakeStrictRedis()
+        models.r.flushall()
+        models._reset_caches()
+
+        now = datetime.datetime.utcnow()
+        self.log_hours = [
+            (now - datetime.timedelta(hours=h)).strftime("%Y%m%d_%H")
+            for h in (3, 2, 1)]
+
+        self.keys = {}
+        for version, hour, message, count in [
+                ("v001", 0, "Yoooooo", 1),
+                ("v001", 0, "Oh no", 2),
+                ("v002", 1, "Yoooooo", 3),
+                ("v002", 2, "Oh no", 1),
+                ("v002", 2, "Time out", 1)]:
+            for _ in xrange(count):
+                self.keys[message], _ = models.record_occurrence_from_errors(
+                    version, self.log_hours[hour], "500", "4", "/test",
+                    "1.1.1.1", "/test", "default", message)
+
+    def tearDown(self):
+        models.r.flushall()
+        models.r = self.old_r
+
+    def test_rollups(self):
+        self.assertEqual(
+            models.r.hgetall("%s:log_hours" % self.keys["Yoooooo"]),
+            {"%s:v001" % self.log_hours[0]: "1",
+             "%s:v002" % self.log_hours[1]: "3"})
+        self.assertEqual(
+            models.r.zrevrange("log_hour:%s:errors" % self.log_hours[0],
+                               0, -1, withscores=True),
+            [(self.keys["Oh no"], 2), (self.keys["Yoooooo"], 1)])
+
+    def test_top_errors(self):
+        self.assertEqual(models.get_top_errors(), [
+            (self.keys["Yoooooo"], 4),
+            (self.keys["Oh no"], 3),
+            (self.keys["Time out"], 1)])
+        self.assertEqual(models.get_top_errors(limit=1),
+                         [(self.keys["Yoooooo"], 4)])
+        self.assertEqual(
+            models.get_top_errors(self.log_hours[0], self.log_hours[2]), [
+                (self.keys["Yoooooo"], 4),
+                (self.keys["Oh no"], 2)])
+        self.assertEqual(
+            models.get_top_errors(start=self.log_hours[2], limit=10), [
+                (self.keys["Oh no"], 1),
+                (self.keys["Time out"], 1)])
+        self.assertEqual(
+            models.get_top_errors(self.log_hours[2], self.log_hours[2]), [])
+
+    def test_top_errors_pages(self):
+        pages = [models.get_top_errors(self.log_hours[0], limit=2,
+                                       offset=offset)
+                 for offset in (0, 2, 4)]
+        self.assertEqual(pages, [
+            [(self.keys["Yoooooo"], 4), (self.keys["Oh no"], 3)],
+            [(self.keys["Time out"], 1)],
+            []])
+
+        # The counts for the range are kept for a while, so later pages are
+        # consistent with the first even if more errors come in.
+        union_keys = models.r.keys("tmp:*")
+        self.assertEqual(len(union_keys), 1)
+        self.assertTrue(
+            0 < models.r.ttl(union_keys[0]) <= models.TOP_ERRORS_CACHE_SECONDS)
+        models.record_occurrence_from_errors(
+            "v001", self.log_hours[2], "500", "4", "/test", "1.1.1.1",
+            "/test", "default", "Time out")
+        self.assertEqual(
+            models.get_top_errors(self.log_hours[0], limit=2, offset=2),
+            [(self.keys["Time out"], 1)])
+
+    def test_top_errors_by_version(self):
+        self.assertEqual(models.get_top_errors(version="v002"), [
+            (self.keys["Yoooooo"], 3),
+            (self.keys["Oh no"], 1),
+            (self.keys["Time out"], 1)])
+        self.assertEqual(
+            models.get_top_errors(self.log_hours[0], self.log_hours[2],
+                                  version="v001"), [
+                (self.keys["Oh no"], 2),
+                (self.keys["Yoooooo"], 1)])
+        self.assertEqual(
+            models.get_top_errors(self.log_hours[0], version="v003"), [])
+
+    def test_summaries_in_range(self):
+        summary, = models.get_error_summaries(
+            [self.keys["Yoooooo"]], start=self.log_hours[1])
+        self.assertEqual(summary["count"], 3)
+        self.assertEqual(summary["by_hour_and_version"], [
+            {"hour": self.log_hours[1], "version": "v002", "count": "3"}])
+        self.assertEqual(summary["first_seen"], self.log_hours[0])
+
+        summary, = models.get_error_summaries(
+            [self.keys["Yoooooo"]], end=self.log_hours[1])
+        self.assertEqual(summary["count"], 1)
+
+    def test_summaries_without_rollup(self):
+        summaries = models.get_error_summaries(self.keys.values())
+        # Errors recorded before we kept the rollup are summarized from the
+        # hours seen for each version.
+        for error_key in self.keys.values():
+            models.r.delete("%s:log_hours" % error_key)
+        models._reset_caches()
+        self.assertEqual(models.get_error_summaries(self.keys.values()),
+                         summaries)
+
+    def test_rebuild_error_rollups(self):
+        expected = _dump_redis(models.r)
+
+        # An hour that has dropped out of the window, and broken rollups.
+        models.r.hset("ver:v001:error:%s:hours_seen" % self.keys["Oh no"],
+                      "20100101_00", 5)
+        models.r.delete("%s:log_hours" % self.keys["Yoooooo"])
+        models.r.zincrby("error_counts", self.keys["Oh no"], 100)
+        models.r.zadd("log_hour:20100101_00:errors", 5, self.keys["Oh no"])
+        expected["ver:v001:error:%s:hours_seen" % self.keys["Oh no"]] = (
+            models.r.hgetall(
+                "ver:v001:error:%s:hours_seen" % self.keys["Oh no"]),
+            models.KEY_EXPIRY_SECONDS)
+
+        self.assertEqual(models.rebuild_error_rollups(batch_size=2),
+                         {"errors": 3, "log_hours": 3})
+        self.assertEqual(_dump_redis(models.r), expected)
+
+
+class ReplicaTest(unittest.TestCase):
+    def setUp(self):
+        self.old_r = models.r
+        # fakeredis dbs are separate, so db 1 makes a replica that is very
+        # far behind.
+        models.configure_redis(fakeredis.FakeStrictRedis(),
+                               fakeredis.FakeStrictRedis(db=1))
+        models.r.flushall()
+        models._reset_caches()
+
+    def tearDown(self):
+        models.r.flushall()
+        models.configure_redis(self.old_r)
+
+    def test_stale_reads(self):
+        error_key, _ = models.record_occurrence_from_errors(
+            "v001", "20200101_11", "500", "4", "/test", "1.1.1.1", "/test",
+            "default", "Yoooooo")
+
+        self.assertEqual(models.get_error_keys(), {error_key})
+        self.assertEqual(models.get_error_keys(stale_ok=True), set())
+        models._clear_error_def_caches()
+        self.assertEqual(
+            models.get_error_summary_info(error_key, stale_ok=True), None)
+        self.assertEqual(models.get_error_extended_information(
+            "v001", error_key, stale_ok=True), [])
+
+        # Once the replica catches up we read from it, but don't cache
+        # the error defs we read there.
+        models.r_replica.set("error:%s" % error_key,
+                             models.r.get("error:%s" % error_key))
+        info = models.get_error_summary_info(error_key, stale_ok=True)
+        self.assertEqual(info["error_def"]["title"], "Yoooooo")
+        self.assertEqual(len(models._error_def_cache), 0)
+
+    def test_make_redis_client(self):
+        client = models.make_redis_client(port=6380, pool_size=5,
+                                          socket_timeout=2)
+        pool = client.connection_pool
+        self.assertTrue(isinstance(pool, redis.BlockingConnectionPool))
+        self.assertEqual(pool.max_connections, 5)
+        self.assertEqual(pool.connection_kwargs["port"], 6380)
+        self.assertEqual(pool.connection_kwargs["socket_timeout"], 2)
+
+        client = models.make_redis_client(unix_socket_path="/tmp/redis.sock")
+        self.assertEqual(client.connection_pool.connection_class,
+                         redis.UnixDomainSocketConnection)
+        self.assertEqual(
+            client.connection_pool.connection_kwargs["path"],
+            "/tmp/redis.sock")
+
+    def test_invalidation_client(self):
+        fake_r = models.r
+        models.r = models.make_redis_client(port=6380, pool_size=5,
+                                            socket_timeout=2)
+        try:
+            # The subscription gets its own connection, which doesn't time
+            # out.
+            pool = models._invalidation_client().connection_pool
+        finally:
+            models.r, primary = fake_r, models.r
+        self.assertFalse(pool is primary.connection_pool)
+        self.assertEqual(pool.max_connections, 1)
+        self.assertEqual(pool.connection_kwargs["port"], 6380)
+        self.assertEqual(pool.connection_kwargs["socket_timeout"], None)
+
+
+class ErrorRegistryTest(unittest.TestCase):
+    def setUp(self):
+        self.old_r = models.r
+        models.r = fakeredis.FakeStrictRedis()
+        models.r.flushall()
+        models._reset_caches()
+
+    def tearDown(self):
+        models.r.flushall()
+        models.r = self.old_r
+
+    def _create_error(self, message):
+        error_def, _, __ = models._parse_message(message, "500", "4")
+        return models._create_or_update_error(
+            error_def, models.KEY_EXPIRY_SECONDS)
+
+    def test_get_error_keys(self):
+        old_key = self._create_error("Error while parsing directive 1")
+        new_key = self._create_error("Yoooooo")
+        self.assertEqual(models.get_error_keys(), {old_key, new_key})
+
+        # Pretend the first error was last written over a week ago.
+        models.r.zadd("error_registry",
+                      time.time() - models.KEY_EXPIRY_SECONDS - 10, old_key)
+        self.assertEqual(models.get_error_keys(), {new_key})
+
+        # It's pruned the next time we write an error, once it's been long
+        # enough since we last pruned.
+        self._create_error("Oh no")
+        self.assertEqual(models.r.zcard("error_registry"), 3)
+        models._error_registry_pruned_at -= models.REGISTRY_PRUNE_SECONDS
+        self._create_error("Time out")
+        self.assertEqual(models.r.zscore("error_registry", old_key), None)
+        self.assertEqual(models.r.zcard("error_registry"), 3)
+
+    def test_rebuild_error_registry(self):
+        key = self._create_error("Error while parsing directive 1")
+        models.r.expire("error:%s" % key, 3600)
+        models.r.delete("error_registry")
+        self.assertEqual(models.get_error_keys(), set())
+
+        self.assertEqual(models.rebuild_error_registry(), {"errors": 1})
+        self.assertEqual(models.get_error_keys(), {key})
+        self.assertAlmostEqual(
+            models.r.zscore("error_registry", key),
+            time.time() - models.KEY_EXPIRY_SECONDS + 3600, delta=10)
+
+
+class MaintenanceTest(unittest.TestCase):
+    def setUp(self):
+        self.old_r = models.r
+        models.r = fakeredis.FakeStrictRedis()
+        models.r.flushall()
+        models._reset_caches()
+
+    def tearDown(self):
+        models.r.flushall()
+        models.r = self.old_r
+
+    def _create_error(self, message):
+        error_def, _, __ = models._parse_message(message, "500", "4")
+        return models._create_or_update_error(
+            error_def, models.KEY_EXPIRY_SECONDS)
+
+    def test_compact_errordef_ids(self):
+        expired_key = self._create_error("Error while parsing directive 1")
+        live_key = self._create_error("Yoooooo")
+        models.r.delete("error:%s" % expired_key)
+
+        stats = models.compact_errordef_ids()
+        # id0, id1 and id2 of each error.
+        self.assertEqual(stats["scanned"], 6)
+        self.assertEqual(stats["deleted"], 3)
+        self.assertEqual(
+            stats["bytes_reclaimed"],
+            len("500 4 Error while parsing directive %%") +
+            len("500 4 Error while parsing") +
+            len("500 4 parsing directive %%") +
+            3 * len(expired_key))
+        self.assertTrue(stats["complete"])
+
+        self.assertEqual(models.r.hgetall("errordef:id0"),
+                         {"500 4 Yoooooo": live_key})
+        self.assertEqual(models.r.hlen("errordef:id1"), 1)
+
+    def test_compact_errordef_ids_resumes(self):
+        for message in ("Oops", "Yikes", "Ouch"):
+            models.r.delete("error:%s" % self._create_error(message))
+
+        stats = models.compact_errordef_ids(batch_size=1, max_seconds=0)
+        self.assertEqual(stats["scanned"], 1)
+        self.assertFalse(stats["complete"])
+        cursor = models.r.get("maintenance:errordef:id0:cursor")
+        self.assertNotEqual(cursor, None)
+
+        stats = models.compact_errordef_ids(batch_size=1)
+        self.assertTrue(stats["complete"])
+        self.assertEqual(models.r.get("maintenance:errordef:id0:cursor"),
+                         None)
+
+    def test_prune_error_versions(self):
+        for version in ("v001", "v002"):
+            error_key, _ = models.record_occurrence_from_errors(
+                version, "20200101_11", "500", "4", "/test", "1.1.1.1",
+                "/test", "default", "Yoooooo")
+        models.record_occurrence_during_monitoring(
+            "v003", 0, "500", "4", "/test", "1.1.1.1", "/test", "default",
+            "Yoooooo")
+        for key in models.r.keys("ver:v002:*"):
+            models.r.delete(key)
+        models.r.delete("first_seen:%s" % error_key)
+        models.r.set("first_seen:%s" % error_key, "20150101_00")
+
+        stats = models.prune_error_versions()
+        self.assertEqual(stats, {"errors": 1, "versions_deleted": 1,
+                                 "first_seen_deleted": 1,
+                                 "first_seen_hours_deleted": 0,
+                                 "complete": True})
+        self.assertEqual(
+            sorted(models.r.zrange("%s:versions" % error_key, 0, -1)),
+            ["MON_v003", "v001"])
+        self.assertFalse(models.r.exists("first_seen:%s" % error_key))
+
+    def test_prune_first_seen_hours(self):
+        recent_hour = (datetime.datetime.utcnow() -
+                       datetime.timedelta(hours=1)).strftime("%Y%m%d_%H")
+        for log_hour in ("20150101_00", recent_hour):
+            error_key, _ = models.record_occurrence_from_errors(
+                "v001", log_hour, "500", "4", "/test", "1.1.1.1", "/test",
+                "default", "Yoooooo")
+
+        # Recording leaves the old hour for maintenance, but readers ignore
+        # it.
+        self.assertEqual(models.r.zcard("first_seen:%s" % error_key), 2)
+        self.assertEqual(
+            models.get_error_summary_info(error_key)["first_seen"],
+            recent_hour)
+
+        stats = models.prune_error_versions()
+        self.assertEqual(stats["first_seen_hours_deleted"], 1)
+        self.assertEqual(models.r.zrange("first_seen:%s" % error_key, 0, -1),
+                         [recent_hour])
+
+    def test_compact_errordef_batch_leaves_changed_entries(self):
+        expired_key = self._create_error("Yoooooo")
+        models.r.delete("error:%s" % expired_key)
+        entries = models.r.hgetall("errordef:id0")
+
+        # The error recurs, under a different key, between the scan and the
+        # batch.
+        models.r.hset("errordef:id0", "500 4 Yoooooo", "abcd1234")
+        models.r.set("error:abcd1234", "{}")
+        self.assertEqual(
+            models._compact_errordef_batch("errordef:id0", entries), {})
+        self.assertEqual(models.r.hget("errordef:id0", "500 4 Yoooooo"),
+                         "abcd1234")
+
+
+
+@unittest.skipIf(_local_redis_or_none() is None,
+                 "needs a redis-server on localhost:6379")
+class RunMaintenanceTest(unittest.TestCase):
+    """run_maintenance releases its lock with a Lua script."""
+    def setUp(self):
+        self.old_r = models.r
+        models.r = _local_redis_or_none()
+        models.r.flushdb()
+        models._reset_caches()
+
+    def tearDown(self):
+        models.r.flushdb()
+        models.r = self.old_r
+
+    def test_run_maintenance(self):
+        error_def, _, __ = models._parse_message("Yoooooo", "500", "4")
+        expired_key = models._create_or_update_error(
+            error_def, models.KEY_EXPIRY_SECONDS)
+        models.r.delete("error:%s" % expired_key)
+
+        # Only one process does it at a time.
+        models.r.set("maintenance:lock", "elsewhere:1")
+        self.assertEqual(models.run_maintenance(), None)
+        models.r.delete("maintenance:lock")
+
+        results = models.run_maintenance(max_seconds=10)
+        self.assertEqual(sorted(results),
+                         ["compact_errordef_ids", "prune_error_versions"])
+        self.assertEqual(results["compact_errordef_ids"]["deleted"], 3)
+        self.assertFalse(models.r.exists("maintenance:lock"))
+
+        stats = models.get_maintenance_stats()
+        self.assertEqual(stats["runs"], 1)
+        self.assertEqual(stats["runs_skipped"], 1)
+        self.assertEqual(stats["compact_errordef_ids"]["deleted"], 3)
+
+    def test_keeps_lock_taken_over(self):
+        old_task = models.compact_errordef_ids
+
+        # Our lock expires part-way through, and another process takes it.
+        def compact_errordef_ids(batch_size, max_seconds):
+            models.r.set("maintenance:lock", "elsewhere:1")
+            return old_task(batch_size=batch_size, max_seconds=max_seconds)
+
+        models.compact_errordef_ids = compact_errordef_ids
+        try:
+            models.run_maintenance()
+        finally:
+            models.compact_errordef_ids = old_task
+        self.assertEqual(models.r.get("maintenance:lock"), "elsewhere:1")
+
 
 if __name__ == '__main__':
     unittest.main()
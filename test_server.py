@@ -1,9 +1,13 @@
 #!/usr/bin/env python
 
 """Unit tests for the endpoints in server.py."""
+import Queue
+import datetime
+import decimal
 import fakeredis
 import json
 import unittest
+import zlib
 
 import bigquery_import
 import detect_anomalies
@@ -19,6 +23,8 @@ class ErrorMonitorTest(unittest.TestCase):
         models.r = fakeredis.FakeStrictRedis()
         models.r.flushall()       # clear the redis db for the new test
         models._reset_caches()
+        server._response_cache.clear()
+        server._compressed_response_cache.clear()
 
         # Simple implementation of 'scan', since it's missing from
         # `FakeStrictRedis`
@@ -431,6 +437,402 @@ class ErrorMonitorTest(unittest.TestCase):
         assert "errors" in ret
         assert len(ret["errors"]) == 0
 
+    def test_fetch_errors_in_range(self):
+        now = datetime.datetime.utcnow()
+        hours = [(now - datetime.timedelta(hours=h)).strftime("%Y%m%d_%H")
+                 for h in (3, 2, 1)]
+        for log_hour, message, count in [
+                (hours[0], "Yoooooo", 1),
+                (hours[0], "Oh no", 2),
+                (hours[1], "Yoooooo", 3),
+                (hours[2], "Time out", 1)]:
+            for _ in xrange(count):
+                models.record_occurrence_from_errors(
+                    "vx001", log_hour, "500", "4", "/test", "1.1.1.1",
+                    "/test", "default", message)
+
+        rv = self.app.get('/recent_errors?start=%s&end=%s&limit=1'
+                          % (hours[0], hours[2]))
+        ret = json.loads(rv.data)
+        assert [e["error_def"]["title"] for e in ret["errors"]] == ["Yoooooo"]
+        assert ret["errors"][0]["count"] == 4
+        assert ret["next_cursor"] == "1"
+
+        rv = self.app.get('/recent_errors?start=%s&end=%s&limit=1&cursor=1'
+                          % (hours[0], hours[2]))
+        ret = json.loads(rv.data)
+        assert [e["error_def"]["title"] for e in ret["errors"]] == ["Oh no"]
+        assert ret["next_cursor"] == "2"
+
+        rv = self.app.get('/recent_errors?start=%s&end=%s&limit=1&cursor=2'
+                          % (hours[0], hours[2]))
+        ret = json.loads(rv.data)
+        assert ret["errors"] == []
+        assert ret["next_cursor"] is None
+
+        # Only the hours in the range are included.
+        rv = self.app.get('/version_errors/vx001?start=%s' % hours[1])
+        ret = json.loads(rv.data)
+        assert [(e["error_def"]["title"], e["count"],
+                 [h["hour"] for h in e["by_hour_and_version"]])
+                for e in ret["errors"]] == [
+                    ("Yoooooo", 3, [hours[1]]),
+                    ("Time out", 1, [hours[2]])]
+        assert ret["next_cursor"] is None
+
+        # Streaming gives the same results.
+        for url in ('/recent_errors?start=%s&end=%s&limit=1&cursor=1'
+                    % (hours[0], hours[2]),
+                    '/version_errors/vx001?start=%s' % hours[1]):
+            rv = self.app.get(url)
+            streamed = self.app.get(url + '&stream=1')
+            assert json.loads(streamed.data) == json.loads(rv.data)
+
+        rv = self.app.get('/recent_errors?start=%s&stream=1' % hours[0])
+        ret = json.loads(rv.data)
+        assert [(e["error_def"]["title"], e["count"])
+                for e in ret["errors"]] == [
+                    ("Yoooooo", 4), ("Oh no", 2), ("Time out", 1)]
+        assert ret["next_cursor"] is None
+
+        rv = self.app.get('/recent_errors?start=yesterday')
+        assert rv.status_code == 400
+        rv = self.app.get('/recent_errors?limit=0')
+        assert rv.status_code == 400
+        # The right shape, but not a real hour.
+        rv = self.app.get('/recent_errors?start=20231399_99')
+        assert rv.status_code == 400
+        rv = self.app.get('/recent_errors?end=20230101_24')
+        assert rv.status_code == 400
+
+    def test_fetch_errors_in_range_clamped(self):
+        now = datetime.datetime.utcnow()
+        hour = (now - datetime.timedelta(hours=1)).strftime("%Y%m%d_%H")
+        for log_hour, message in [(hour, "Yoooooo"),
+                                  ("20150101_00", "Long gone")]:
+            models.record_occurrence_from_errors(
+                "vx001", log_hour, "500", "4", "/test", "1.1.1.1",
+                "/test", "default", message)
+
+        # We only count the hours we keep, rather than the million or so
+        # since 1900.
+        rv = self.app.get('/recent_errors?start=19000101_00&end=30000101_00')
+        ret = json.loads(rv.data)
+        assert [(e["error_def"]["title"], e["count"])
+                for e in ret["errors"]] == [("Yoooooo", 1)]
+        top_errors_keys = models.r.keys("tmp:top_errors:*")
+        assert len(top_errors_keys) == 1
+        _, _, first, last, _ = top_errors_keys[0].split(":")
+        assert first > "20150101_00"
+        assert last < "30000101_00"
+
+    def test_top_errors_after_new_logs(self):
+        hour = (datetime.datetime.utcnow()
+                - datetime.timedelta(hours=1)).strftime("%Y%m%d_%H")
+
+        def record(count):
+            for _ in xrange(count):
+                models.record_occurrence_from_errors(
+                    "vx001", hour, "500", "4", "/test", "1.1.1.1", "/test",
+                    "default", "Yoooooo")
+            models.record_log_data_received(hour)
+
+        record(1)
+        ret = json.loads(self.app.get('/recent_errors?limit=10').data)
+        assert [e["count"] for e in ret["errors"]] == [1]
+
+        # Within TOP_ERRORS_CACHE_SECONDS, but with new logs.
+        record(5)
+        ret = json.loads(self.app.get('/recent_errors?limit=10').data)
+        assert [e["count"] for e in ret["errors"]] == [6]
+        assert sum(int(h["count"])
+                   for h in ret["errors"][0]["by_hour_and_version"]) == 6
+
+    def test_stream_all_errors(self):
+        hour = (datetime.datetime.utcnow()
+                - datetime.timedelta(hours=1)).strftime("%Y%m%d_%H")
+        for message, count in [("Yoooooo", 1), ("Oh no", 3)]:
+            for _ in xrange(count):
+                models.record_occurrence_from_errors(
+                    "vx001", hour, "500", "4", "/test", "1.1.1.1",
+                    "/test", "default", message)
+        # Errors seen only while monitoring are included too.
+        monitor_data = {
+            'logs': [
+                {"status": 500, "level": 4, "resource": "/leia",
+                    "ip": "1.1.1.1", "route": "/leia", "module_id": "default",
+                    "message": "Help me, Obi Wan Kenobi"}
+            ] * 2,
+            'minute': 0,
+            'version': 'vx001'
+        }
+        rv = self.app.post('/monitor',
+                           data=json.dumps(monitor_data),
+                           headers={"Content-type": "application/json"})
+        assert rv.status_code == 200
+
+        for url in ('/recent_errors', '/version_errors/vx001',
+                    '/version_errors/MON_vx001'):
+            rv = self.app.get(url)
+            streamed = self.app.get(url + '?stream=1')
+            assert json.loads(streamed.data) == json.loads(rv.data)
+        assert len(json.loads(rv.data)["errors"]) == 1
+
+        # We only fetch the summaries once, as we send them.
+        old_get_chunk = models._get_error_summaries_chunk
+        chunks = []
+
+        def get_chunk(error_keys, *args):
+            chunks.append(error_keys)
+            return old_get_chunk(error_keys, *args)
+
+        models._get_error_summaries_chunk = get_chunk
+        try:
+            ret = json.loads(self.app.get('/recent_errors?stream=1').data)
+        finally:
+            models._get_error_summaries_chunk = old_get_chunk
+        assert len(chunks) == 1 and len(chunks[0]) == 3
+        assert [e["error_def"]["title"] for e in ret["errors"]][0] == "Oh no"
+        assert "Help me, Obi Wan Kenobi" in [
+            e["error_def"]["title"] for e in ret["errors"]]
+
+    def test_async_monitor(self):
+        # Rather than start the worker threads, we record the queued
+        # snapshots ourselves, when we want to.
+        server._monitor_queue = Queue.Queue(1)
+        old_wait_seconds = server.MONITOR_RESULTS_WAIT_SECONDS
+        server.MONITOR_RESULTS_WAIT_SECONDS = 0
+        try:
+            monitor_data = {
+                'logs': [
+                    {"status": 500, "level": 4, "resource": "/test",
+                        "ip": "1.1.1.1", "route": "/test",
+                        "module_id": "default",
+                        "message": "Error while parsing directive 1"}
+                ],
+                'minute': 0,
+                'version': 'vx001'
+            }
+            # We check each log record before queueing it.
+            for field in ("ip", "message", "status", "module_id"):
+                bad_log = dict(monitor_data['logs'][0])
+                del bad_log[field]
+                rv = self.app.post(
+                    '/monitor',
+                    data=json.dumps(dict(monitor_data, logs=[bad_log])),
+                    headers={"Content-type": "application/json"})
+                assert rv.status_code == 400
+            rv = self.app.post('/monitor',
+                               data=json.dumps(dict(monitor_data, logs=[1])),
+                               headers={"Content-type": "application/json"})
+            assert rv.status_code == 400
+
+            rv = self.app.post('/monitor',
+                               data=json.dumps(monitor_data),
+                               headers={"Content-type": "application/json"})
+            assert rv.status_code == 200
+            assert rv.data == "OK"
+            rv = self.app.post('/monitor',
+                               data=json.dumps(monitor_data),
+                               headers={"Content-type": "application/json"})
+            assert rv.status_code == 429
+            assert not models.check_monitoring_data_received('vx001', 0)
+
+            # We don't give results for the minute until it's recorded.
+            rv = self.app.get('/errors/vx001/monitor/0?verify_versions=vx000')
+            assert rv.status_code == 503
+
+            server._record_queued_monitor_snapshot()
+            assert models.check_monitoring_data_received('vx001', 0)
+            rv = self.app.get('/errors/vx001/monitor/0?verify_versions=vx000')
+            assert rv.status_code == 200
+
+            stats = json.loads(self.app.get('/stats').data)["monitor_queue"]
+            assert stats == {"accepted": 1, "rejected": 1, "recorded": 1,
+                             "failed": 0, "queued": 0, "max_queued": 1}
+
+            server._flush_monitor_queue()
+            rv = self.app.post('/monitor',
+                               data=json.dumps(monitor_data),
+                               headers={"Content-type": "application/json"})
+            assert rv.status_code == 503
+        finally:
+            server._monitor_queue = None
+            server._monitor_queue_closed.clear()
+            for k in server._monitor_queue_stats:
+                server._monitor_queue_stats[k] = 0
+            server.MONITOR_RESULTS_WAIT_SECONDS = old_wait_seconds
+
+    def test_cached_responses(self):
+        models.record_occurrence_from_errors(
+            "vx001", "20150101_00", "500", "4", "/test", "1.1.1.1", "/test",
+            "default", "Yoooooo")
+        models.record_log_data_received("20150101_00")
+
+        rv = self.app.get('/recent_errors')
+        assert len(json.loads(rv.data)["errors"]) == 1
+        etag = rv.headers["ETag"]
+
+        # Until we record new data we keep answering from the cache, even
+        # though Redis has changed underneath us.
+        models.record_occurrence_from_errors(
+            "vx001", "20150101_01", "500", "4", "/test", "1.1.1.1", "/test",
+            "default", "Oh no")
+        rv = self.app.get('/recent_errors')
+        assert len(json.loads(rv.data)["errors"]) == 1
+        rv = self.app.get('/recent_errors', headers={"If-None-Match": etag})
+        assert rv.status_code == 304
+        assert rv.data == ""
+
+        models.record_log_data_received("20150101_01")
+        rv = self.app.get('/recent_errors', headers={"If-None-Match": etag})
+        assert rv.status_code == 200
+        assert len(json.loads(rv.data)["errors"]) == 2
+        assert rv.headers["ETag"] != etag
+
+        # Monitoring data invalidates the responses it affects.
+        rv = self.app.get('/version_errors/MON_vx002')
+        assert json.loads(rv.data)["errors"] == []
+        monitor_data = {
+            'logs': [
+                {"status": 500, "level": 4, "resource": "/test",
+                    "ip": "1.1.1.1", "route": "/test", "module_id": "default",
+                    "message": "Time out"}
+            ],
+            'minute': 0,
+            'version': 'vx002'
+        }
+        rv = self.app.post('/monitor',
+                           data=json.dumps(monitor_data),
+                           headers={"Content-type": "application/json"})
+        assert rv.status_code == 200
+        rv = self.app.get('/version_errors/MON_vx002')
+        assert len(json.loads(rv.data)["errors"]) == 1
+
+        # Errors aren't cached.
+        rv = self.app.get('/error/nonexistent')
+        assert rv.status_code == 404
+        assert "ETag" not in rv.headers
+
+        stats = json.loads(self.app.get('/stats').data)["response"]
+        assert stats["hits"] == 2
+        assert stats["not_modified"] == 1
+
+    def test_compression(self):
+        monitor_data = {
+            'logs': [
+                {"status": 500, "level": 4, "resource": "/test",
+                    "ip": "1.1.1.%d" % i, "route": "/test",
+                    "module_id": "default", "message": "Time out"}
+                for i in xrange(20)
+            ],
+            'minute': 0,
+            'version': 'vx001'
+        }
+        for encoding, wbits in (("gzip", 16 + zlib.MAX_WBITS),
+                                ("deflate", zlib.MAX_WBITS),
+                                ("deflate", -zlib.MAX_WBITS)):
+            compressor = zlib.compressobj(6, zlib.DEFLATED, wbits)
+            data = (compressor.compress(json.dumps(monitor_data)) +
+                    compressor.flush())
+            rv = self.app.post('/monitor', data=data,
+                               headers={"Content-type": "application/json",
+                                        "Content-Encoding": encoding})
+            assert rv.status_code == 200
+        error_key = models.get_monitoring_errors("vx001", 0)[0][0]["key"]
+        assert models.r.zscore("ver:MON_vx001:errors_by_minute:0",
+                               error_key) == 60
+
+        rv = self.app.post('/monitor', data="not gzip",
+                           headers={"Content-type": "application/json",
+                                    "Content-Encoding": "gzip"})
+        assert rv.status_code == 400
+        rv = self.app.post('/monitor', data=json.dumps(monitor_data),
+                           headers={"Content-type": "application/json",
+                                    "Content-Encoding": "br"})
+        assert rv.status_code == 415
+
+        # Small responses aren't worth compressing.
+        rv = self.app.get('/version_errors/MON_vx001',
+                          headers={"Accept-Encoding": "gzip"})
+        assert "Content-Encoding" not in rv.headers
+        expected = rv.data
+
+        old_min_bytes = server.COMPRESS_MIN_BYTES
+        server.COMPRESS_MIN_BYTES = 0
+        try:
+            rv = self.app.get('/version_errors/MON_vx001')
+            assert "Content-Encoding" not in rv.headers
+            assert rv.headers["Vary"] == "Accept-Encoding"
+            etag = rv.headers["ETag"]
+
+            for accept_encoding in ("gzip", "deflate;q=0.5, gzip", "gzip"):
+                rv = self.app.get('/version_errors/MON_vx001',
+                                  headers={"Accept-Encoding":
+                                           accept_encoding})
+                assert rv.headers["Content-Encoding"] == "gzip"
+                assert rv.headers["ETag"] == "W/" + etag
+                assert zlib.decompress(
+                    rv.data, 16 + zlib.MAX_WBITS) == expected
+
+            rv = self.app.get('/version_errors/MON_vx001',
+                              headers={"Accept-Encoding": "deflate"})
+            assert rv.headers["Content-Encoding"] == "deflate"
+            assert zlib.decompress(rv.data) == expected
+
+            # The compressed response's ETag still gets a 304.
+            rv = self.app.get('/version_errors/MON_vx001',
+                              headers={"Accept-Encoding": "gzip",
+                                       "If-None-Match": "W/" + etag})
+            assert rv.status_code == 304
+        finally:
+            server.COMPRESS_MIN_BYTES = old_min_bytes
+
+        stats = json.loads(self.app.get('/stats').data)["compression"]
+        assert stats["requests_decompressed"] == 3
+        # Each encoding is compressed only once.
+        assert stats["responses_compressed"] == 2
+        assert stats["hits"] == 2
+
+
+def _decimal_poisson_cdf(actual, mean):
+    """p(draw <= actual), summing the terms exactly in Decimal.
+
+    This is how server.poisson_cdf used to do it: slow, but a good check.
+    """
+    if actual < 0:
+        return 0.0
+    mean = decimal.Decimal(mean)
+    p = (-mean).exp()
+    cum_prob = p
+    for i in xrange(actual):
+        p *= mean
+        p /= i + 1
+        cum_prob += p
+    return float(cum_prob)
+
+
+class PoissonCdfTest(unittest.TestCase):
+    def test_matches_decimal_version(self):
+        for actual in (0, 1, 2, 5, 10, 50, 98, 99, 100, 101, 500, 3000):
+            for mean in ([0.001, 0.5, 1, 10, 100, 746, 1000] +
+                         [actual * (0.5 + 0.1 * i) + 0.37
+                          for i in xrange(11)]):
+                self.assertAlmostEqual(
+                    server.poisson_cdf(actual, mean),
+                    _decimal_poisson_cdf(actual, mean), places=9,
+                    msg="actual=%r, mean=%r" % (actual, mean))
+
+    def test_edge_cases(self):
+        self.assertEqual(server.poisson_cdf(-1, 10), 0.0)
+        self.assertEqual(server.poisson_cdf(0, 0), 1.0)
+        self.assertEqual(server.poisson_cdf(5, 0.0), 1.0)
+        # Large enough that the Decimal version took seconds.
+        self.assertAlmostEqual(server.poisson_cdf(100000, 100000.5),
+                               0.5, places=2)
+        self.assertLess(server.poisson_cdf(100, 100000), 1e-300)
+        self.assertEqual(server.poisson_cdf(100000, 100), 1.0)
+
 
 class RequestMonitorTest(unittest.TestCase):
     def setUp(self):